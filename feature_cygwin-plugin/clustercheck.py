@@ -0,0 +1,174 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Localhost check of the cluster runs of the Feature-plugin.
+#
+# Featurizes and scores the grid of a synthetic structure (see bench.py,
+# whose stand-ins replace dssp, featurize and scoreit) once on the local
+# cores (runner.LocalBackend) and once through a coordinator
+# (cluster.ClusterBackend) with worker processes started on this machine
+# (see worker.py), and checks that
+#
+#   - a worker with a wrong token is refused
+#   - the shard of a worker killed while running it is run again by another
+#     worker
+#   - the merged hits of the cluster run are the ones of the local run
+#     (scores and coordinates, the gridpoint names depend on the shards)
+#
+#   python -m feature_wsl-plugin.clustercheck -w 4 -o cluster_check
+#
+# Like the benchmarks, it needs a native bash (Linux or macOS). It exits
+# with 1 if any check fails.
+
+import os
+import sys
+import time
+import secrets
+import argparse
+import threading
+import subprocess
+
+from . import bash_launch, bash_path
+from . import batch
+from . import bench
+from . import cluster
+from . import runner
+
+# seconds for the worker to be killed to start its shard
+START_WAIT = 60
+
+
+def hits_rows(filename):
+    '''Returns the sorted (score, x, y, z) fields of the gridpoint lines of a hits file.'''
+    rows = []
+    with open(filename, 'r') as infile:
+        for line in infile:
+            fields = line.split()
+            if len(fields) >= 5 and not line.startswith('#'):
+                rows.append(tuple(fields[1:5]))
+    return sorted(rows)
+
+
+def prepare(out_dir, natoms, spacing):
+    '''
+    Writes the stand-ins and a synthetic structure with its dssp and grid
+    files (prot.pdb, prot.dssp and prot.ptf) to out_dir, returns (prot,
+    model, settings).
+    '''
+    stub_dir = bench.write_stubs(os.path.join(out_dir, "stubs"))
+    # the stand-ins are run by name, by this process and by the workers
+    os.environ['PATH'] = stub_dir + os.pathsep + os.environ.get('PATH', '')
+    settings = bench.bench_settings(stub_dir, spacing)
+    prot = os.path.join(out_dir, "prot")
+    bench.write_synthetic_pdb(prot+".pdb", natoms)
+    coords, elements = batch.read_pdb(prot+".pdb")
+    batch.make_grid(prot, coords, elements, spacing, settings)
+    if batch.run_dssp(prot+".pdb", prot, settings) != 0:
+        raise RuntimeError("the dssp stand-in failed")
+    return prot, os.path.join(stub_dir, "bench.model"), settings
+
+
+def run_local(prot, model, settings, workers):
+    '''Runs the grid of prot on workers local shards, returns the failed shards.'''
+    directory = os.path.dirname(prot)
+    header = ['pushd %s > /dev/null' % bash_path(directory),
+              'export FEATURE_DIR=%s' % settings['feature_data_path'],
+              'export DSSP_DIR=%s' % bash_path(directory),
+              'export PDB_DIR=%s' % bash_path(directory)]
+    shards = runner.split_ptf(prot+".ptf", workers, prot+"_local")
+    backend = runner.LocalBackend(bash_launch(settings), header, lambda name: runner.feature_commands(name, model),
+                                  workers)
+    failed = backend.run(shards, report=print)
+    runner.merge_files(shards, "_grid.hits", prot+"_local_grid.hits")
+    return failed
+
+
+def start_worker(port, token, name, settings_file, log_dir, path=None):
+    '''Starts a worker process serving one run of the coordinator on port, returns it.'''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    if path is not None:
+        env['PATH'] = path + os.pathsep + env['PATH']
+    args = [sys.executable, '-m', __package__+".worker", '-s', "localhost:%d" % port, '-j', '1',
+            '-t', token, '--once', '-c', settings_file]
+    log = open(os.path.join(log_dir, name+".log"), 'w')
+    return subprocess.Popen(args, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def write_hanging_featurize(directory):
+    '''Writes a featurize which never finishes to directory, returns it.'''
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.join(directory, "featurize")
+    with open(filename, 'w') as outfile:
+        outfile.write("#!/bin/bash\nsleep 3600\n")
+    os.chmod(filename, 0o755)
+    return directory
+
+
+def run_cluster(prot, model, settings, workers, nshards, port):
+    '''
+    Runs the grid of prot on nshards shards of a coordinator on port : a
+    worker is killed while running a shard, then a worker with a wrong
+    token and workers good ones are started. Returns (failed shards, exit
+    code of the refused worker, shards run again, exit codes of the good
+    workers).
+    '''
+    out_dir = os.path.dirname(prot)
+    settings_file = os.path.join(out_dir, "worker.conf")
+    with open(settings_file, 'w') as outfile:
+        outfile.write("feature_data_path = %s\n" % settings['feature_data_path'])
+    token = secrets.token_hex(16)
+    backend = cluster.ClusterBackend(port, [prot+".pdb", prot+".dssp"], [model], {}, nshards=nshards,
+                                     retries=2, token=token)
+    shards = runner.split_ptf(prot+".ptf", backend.nshards, prot+"_cluster")
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(failed=backend.run(shards, report=print)), daemon=True)
+    thread.start()
+    # a worker whose featurize hangs, killed once it runs a shard
+    victim = start_worker(port, token, "killed", settings_file, out_dir,
+                          write_hanging_featurize(os.path.join(out_dir, "hanging")))
+    started = time.monotonic()
+    while getattr(backend, 'running', 0) == 0 and time.monotonic() - started < START_WAIT:
+        time.sleep(0.2)
+    runner.kill_tree(victim.pid)
+    victim.wait()
+    refused = start_worker(port, "not-" + token, "refused", settings_file, out_dir)
+    good = [start_worker(port, token, "worker%d" % number, settings_file, out_dir) for number in range(workers)]
+    thread.join()
+    runner.merge_files(shards, "_grid.hits", prot+"_cluster_grid.hits")
+    retried = [os.path.basename(shard) for shard, attempts in backend.attempts.items() if attempts]
+    return result.get('failed', shards), refused.wait(), retried, [process.wait() for process in good]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m %s" % __spec__.name if __spec__ else None,
+        description="Checks a cluster run with workers on localhost against a local run.")
+    parser.add_argument('-o', '--out', default="cluster_check", help="output directory")
+    parser.add_argument('-w', '--workers', type=int, default=4, help="workers started (default: 4)")
+    parser.add_argument('-n', '--atoms', type=int, default=4000, help="atoms of the structure (default: 4000)")
+    parser.add_argument('-s', '--spacing', type=float, default=1.0, help="grid spacing (default: 1.0)")
+    parser.add_argument('--shards', type=int, default=16, help="shards of the cluster run (default: 16)")
+    parser.add_argument('-p', '--port', type=int, default=cluster.DEFAULT_PORT,
+                        help="port of the coordinator (default: %d)" % cluster.DEFAULT_PORT)
+    args = parser.parse_args(argv)
+
+    out_dir = os.path.abspath(args.out)
+    os.makedirs(out_dir, exist_ok=True)
+    prot, model, settings = prepare(out_dir, args.atoms, args.spacing)
+    local_failed = run_local(prot, model, settings, args.workers)
+    failed, refused, retried, codes = run_cluster(prot, model, settings, args.workers, args.shards, args.port)
+    local_rows = hits_rows(prot+"_local_grid.hits") if not local_failed else None
+    cluster_rows = hits_rows(prot+"_cluster_grid.hits") if not failed else None
+    checks = [("local run", not local_failed),
+              ("cluster run", not failed and not any(codes)),
+              ("wrong token refused", refused != 0),
+              ("killed worker's shard run again (%s)" % ", ".join(retried), bool(retried)),
+              ("same hits (%d gridpoints)" % len(local_rows or ()),
+               local_rows is not None and local_rows == cluster_rows)]
+    for name, passed in checks:
+        print("%-4s %s" % ("ok" if passed else "FAIL", name))
+    print("Worker logs in %s" % out_dir)
+    return 0 if all(passed for name, passed in checks) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
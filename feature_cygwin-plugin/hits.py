@@ -0,0 +1,190 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Reading of the scoreit output (_grid.hits files) for the Feature-plugin.
+#
+# Every line holds the environment name, the FEATURE score and the x, y, z
+# coordinates of a gridpoint, separated by tabs. Anything after a '#' is a
+# comment, as for read.table in the former R script.
+#
+# Almost all gridpoints score below the cutoff of the refinement, so the
+# files are read in blocks of whole lines : only the score column of a
+# block is parsed, and the coordinates only for the lines scoring at least
+# the cutoff. Memory and time then follow the number of hits rather than
+# the number of gridpoints. Large files are split into byte ranges read by
+# several threads, the hits keeping the order of the file.
+
+import io
+import os
+import warnings
+from itertools import zip_longest
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# bytes of a _grid.hits file parsed at once
+BLOCK_SIZE = 2**20
+
+
+def byte_ranges(filename, nranges):
+    '''
+    Returns the (start, end) offsets splitting filename into at most
+    nranges parts of whole lines.
+    '''
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, 'rb') as infile:
+        for number in range(1, nranges):
+            infile.seek(max(size * number // nranges, bounds[-1]))
+            infile.readline()
+            bounds.append(min(infile.tell(), size))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def iter_blocks(filename, start=0, end=None, block_size=BLOCK_SIZE):
+    '''
+    Yields the bytes of the range [start, end) of filename (start at the
+    beginning of a line) in blocks of whole lines.
+    '''
+    end = os.path.getsize(filename) if end is None else end
+    with open(filename, 'rb') as infile:
+        infile.seek(start)
+        position = start
+        while position < end:
+            block = infile.read(min(block_size, end - position))
+            if not block:
+                break
+            while b'\n' not in block and position + len(block) < end:
+                # a line longer than the block
+                block += infile.read(min(block_size, end - position - len(block)))
+            cut = block.rfind(b'\n') + 1
+            if position + len(block) < end and 0 < cut < len(block):
+                # the last partial line starts the next block
+                infile.seek(cut - len(block), 1)
+                block = block[:cut]
+            position += len(block)
+            yield block
+
+
+def load_columns(data, usecols, ndmin):
+    '''Returns numpy.loadtxt of the columns usecols of data (bytes), empty for comment lines only.'''
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        return np.loadtxt(io.BytesIO(data), delimiter='\t', usecols=usecols, comments='#', ndmin=ndmin)
+
+
+def block_scores(block, cutoff):
+    '''Returns the scores of the lines of block (see iter_blocks) and the rows scoring at least cutoff.'''
+    scores = load_columns(block, 1, 1)
+    return scores, np.flatnonzero(scores >= cutoff)
+
+
+def block_lines(block, rows):
+    '''
+    Returns the lines of block (see iter_blocks) of the rows of its scores,
+    joined. Blank and comment lines have no row.
+    '''
+    text = np.frombuffer(block, dtype=np.uint8)
+    ends = np.flatnonzero(text == ord('\n')) + 1
+    if len(ends) == 0 or ends[-1] < len(block):
+        ends = np.append(ends, len(block))
+    starts = np.concatenate([[0], ends[:-1]])
+    # lines left out by numpy.loadtxt : empty, '\r' only or starting with '#'
+    first = text[np.minimum(starts, len(block) - 1)]
+    length = ends - starts
+    data = ~((first == ord('#')) | (first == ord('\n')) | ((first == ord('\r')) & (length <= 2)))
+    lines = np.flatnonzero(data)[rows]
+    return b''.join(block[start:end] for start, end in zip(starts[lines].tolist(), ends[lines].tolist()))
+
+
+def parse_block(block, cutoff=None, dense=False):
+    '''
+    Returns the scores ((n,) array) and coordinates ((n, 3) array) of the
+    lines of block (see iter_blocks) scoring at least cutoff, all of them
+    without cutoff. dense parses all columns before applying the cutoff,
+    which is faster when most lines are hits.
+    '''
+    if cutoff is None or dense:
+        data = load_columns(block, (1, 2, 3, 4), 2).reshape(-1, 4)
+        if cutoff is not None:
+            data = data[data[:, 0] >= cutoff]
+        return data[:, 0], data[:, 1:4]
+    scores, rows = block_scores(block, cutoff)
+    if len(rows) == 0:
+        return scores[rows], np.zeros((0, 3))
+    return scores[rows], load_columns(block_lines(block, rows), (2, 3, 4), 2)
+
+
+def iter_hits(filename, cutoff=None, start=0, end=None, block_size=BLOCK_SIZE):
+    '''
+    Yields the scores and coordinates of the gridpoints of filename scoring
+    at least cutoff (all of them without cutoff), one block at a time.
+    '''
+    dense = False
+    for block in iter_blocks(filename, start, end, block_size):
+        scores, xyz = parse_block(block, cutoff, dense)
+        # the next block is parsed at once when most lines of this one were hits
+        dense = cutoff is not None and 4 * len(scores) > block.count(b'\n')
+        yield scores, xyz
+
+
+def read_hits(filename, cutoff=None, workers=1, block_size=BLOCK_SIZE):
+    '''
+    Returns the scores ((n,) array) and coordinates ((n, 3) array)
+    of the gridpoints in filename scoring at least cutoff (all of them
+    without cutoff). With several workers, byte ranges of the file are
+    read in parallel.
+    '''
+    if cutoff is None and workers == 1:
+        data = np.loadtxt(filename, delimiter='\t', usecols=(1, 2, 3, 4),
+                          comments='#', ndmin=2)
+        return data[:, 0], data[:, 1:4]
+    def read_range(limits):
+        return list(iter_hits(filename, cutoff, limits[0], limits[1], block_size))
+    ranges = byte_ranges(filename, max(1, min(workers, os.path.getsize(filename) // block_size + 1)))
+    if len(ranges) > 1:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+            parts = [part for result in pool.map(read_range, ranges) for part in result]
+    else:
+        parts = [part for limits in ranges for part in read_range(limits)]
+    scores = np.concatenate([part[0] for part in parts] + [np.zeros(0)])
+    xyz = np.vstack([part[1] for part in parts] + [np.zeros((0, 3))])
+    return scores, xyz
+
+
+def write_hits_above(filename, cutoff, outname):
+    '''
+    Writes to outname the lines of filename scoring at least cutoff, in
+    their order, and returns their number.
+    '''
+    count = 0
+    with open(outname, 'wb') as outfile:
+        for block in iter_blocks(filename):
+            rows = block_scores(block, cutoff)[1]
+            outfile.write(block_lines(block, rows))
+            count += len(rows)
+    return count
+
+
+def merge_hits(filenames, labels, filename):
+    '''
+    Writes the hits of the same gridpoints scored with several models
+    (one file per model, in the same point order) as one table : name,
+    x, y, z and one score column per model, labels giving the column names
+    in a '#' header line. Returns the number of gridpoints.
+    '''
+    infiles = [open(name, 'r') for name in filenames]
+    try:
+        tables = [(line for line in infile if line.split('#')[0].strip()) for infile in infiles]
+        npoints = 0
+        with open(filename, 'w') as outfile:
+            outfile.write("#name\tx\ty\tz\t"+"\t".join(labels)+"\n")
+            for lines in zip_longest(*tables):
+                rows = [line.split('#')[0].rstrip().split('\t') for line in lines if line is not None]
+                if len(rows) < len(lines) or any(row[2:5] != rows[0][2:5] for row in rows):
+                    raise ValueError("%s do not hold the same gridpoints" % ", ".join(filenames))
+                outfile.write("\t".join([rows[0][0]] + rows[0][2:5] + [row[1] for row in rows])+"\n")
+                npoints += 1
+    finally:
+        for infile in infiles:
+            infile.close()
+    return npoints
@@ -0,0 +1,239 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Per-stage instrumentation of the Feature-plugin.
+#
+# Every stage of a run (findborders, write_ptf, dssp, featurize, scoring,
+# refinement, write_site_file ...) is recorded with its wall time, the CPU
+# time of the python thread running it, the CPU time and peak resident
+# memory of the child processes waited for meanwhile, its gridpoint, hit
+# and site counts and the bytes of its input and output files. The records
+# of a run are written as one JSON report (prot_report.json), rewritten
+# after every stage. Python stages can also be run under cProfile
+# (prot_stage.prof files, read with pstats).
+#
+# featurize and scoreit run inside bash scripts : every run of them is timed
+# there (see runner.timing_header) and the times are added to the featurize
+# record under 'programs'. The usage of the child processes comes from the
+# resource module, which only exists on POSIX systems : on Windows it is
+# left out, only the bash times are known.
+
+import os
+import sys
+import json
+import time
+import platform
+import threading
+import cProfile
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+REPORT_FORMAT = 1
+# settings whose values are never written to the reports
+SECRET_SETTINGS = ('cluster_token',)
+
+
+def public_settings(settings):
+    '''Returns a copy of settings with the values of the secret ones hidden.'''
+    return {key: "<hidden>" if key in SECRET_SETTINGS and value else value for key, value in settings.items()}
+
+
+def resource_usage(who):
+    '''
+    Returns the CPU seconds and the peak resident memory (bytes) of who
+    ('self' or 'children'), None without the resource module.
+    '''
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in KB, in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss * scale
+
+
+def children_usage():
+    '''Returns the usage (see resource_usage) of the child processes waited for so far.'''
+    return resource_usage('children')
+
+
+def process_usage():
+    '''Returns the usage (see resource_usage) of this process.'''
+    return resource_usage('self')
+
+
+def file_bytes(filenames):
+    '''Returns the total size of the existing files of filenames.'''
+    return sum(os.path.getsize(name) for name in filenames if os.path.isfile(name))
+
+
+def count_lines(filename, blocksize=2**20):
+    '''Returns the number of lines of filename, 0 if it is missing.'''
+    if not os.path.isfile(filename):
+        return 0
+    count = 0
+    with open(filename, 'rb') as infile:
+        for block in iter(lambda: infile.read(blocksize), b''):
+            count += block.count(b'\n')
+    return count
+
+
+def read_times(filename):
+    '''
+    Returns the runs, wall, user and system seconds and the peak memory
+    (bytes, None if unknown) of every program timed in filename (see
+    runner.timing_header).
+    '''
+    programs = {}
+    with open(filename, 'r') as infile:
+        for line in infile:
+            fields = line.split()
+            try:
+                values = [float(value) for value in fields[1:]]
+            except ValueError:
+                continue
+            if len(values) not in (3, 4):
+                continue
+            entry = programs.setdefault(fields[0], {'runs': 0, 'wall': 0.0, 'user': 0.0,
+                                                    'system': 0.0, 'peak_rss': None})
+            entry['runs'] += 1
+            entry['wall'] += values[0]
+            entry['user'] += values[1]
+            entry['system'] += values[2]
+            if len(values) == 4:
+                entry['peak_rss'] = max(entry['peak_rss'] or 0, int(values[3]) * 1024)
+    return programs
+
+
+class Stage:
+    '''
+    Measures a stage of report. read and written are the files whose sizes
+    are recorded as the bytes read and written when the stage stops.
+    Stages are used as context managers, or started and stopped explicitly
+    when the stage starts and ends in different places (see jobs.Job).
+    '''
+    def __init__(self, report, name, read=(), written=()):
+        self.report = report
+        self.name = name
+        self.read = list(read)
+        self.written = list(written)
+        self.times_file = None
+        self.record = {'stage': name}
+        self.added = False
+
+    def start(self):
+        if self.times_file is not None and os.path.isfile(self.times_file):
+            os.remove(self.times_file)
+        self.record['start'] = round(time.time() - self.report.started, 3)
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        self.children = children_usage()
+
+    def stop(self, status='ok'):
+        '''Completes the record (status is ok, failed or cancelled) and adds it to the report.'''
+        record = self.record
+        record['status'] = status
+        record['wall'] = round(time.perf_counter() - self.wall, 6)
+        record['cpu'] = round(time.thread_time() - self.cpu, 6)
+        children = children_usage()
+        if children is not None and self.children is not None:
+            record['child_cpu'] = round(children[0] - self.children[0], 6)
+            # the peak only shows if a child of this stage went above all former ones
+            record['child_peak_rss'] = children[1] if children[1] > self.children[1] else None
+        record['bytes_read'] = file_bytes(self.read)
+        record['bytes_written'] = file_bytes(self.written)
+        if self.times_file is not None and os.path.isfile(self.times_file):
+            record['programs'] = read_times(self.times_file)
+            os.remove(self.times_file)
+        self.added = True
+        self.report.add(record)
+
+    def count(self, **counts):
+        '''Records counts (gridpoints=..., hits=..., sites=...), also after the stage stopped.'''
+        self.record.update(counts)
+        if self.added:
+            self.report.write()
+
+    def count_lines(self, **filenames):
+        '''Records the number of lines of files as counts, only if the report is written.'''
+        if self.report.enabled:
+            self.count(**{key: count_lines(name) for key, name in filenames.items()})
+
+    def call(self, function, *args):
+        '''Returns function(*args), run under cProfile if the report profiles the stages.'''
+        if not self.report.profile:
+            return function(*args)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args)
+        finally:
+            # a stage run several times (one refinement per model) gets numbered files
+            number = self.report.profiles[self.name] = self.report.profiles.get(self.name, 0) + 1
+            filename = "%s_%s%s.prof" % (self.report.prefix, self.name, "_%d" % number if number > 1 else "")
+            profile.dump_stats(filename)
+            self.record['profile'] = os.path.basename(filename)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, kind, value, trace):
+        self.stop('ok' if kind is None else 'failed')
+        return False
+
+
+class RunReport:
+    '''
+    Stage records of a run of prot, written to filename (nothing is written
+    without a filename). settings are the options of the run, kept in the
+    report without the secret ones. With profile, python stages run under
+    cProfile and their stats are written next to the report.
+    '''
+    def __init__(self, filename=None, prot="", settings=None, profile=False):
+        self.filename = filename
+        self.prot = prot
+        self.settings = public_settings(settings or {})
+        self.profile = bool(profile) and filename is not None
+        self.prefix = os.path.join(os.path.dirname(filename or ""), os.path.basename(prot))
+        self.started = time.time()
+        self.stages = []
+        self.profiles = {}
+        self.lock = threading.RLock()
+
+    @property
+    def enabled(self):
+        return self.filename is not None
+
+    def stage(self, name, read=(), written=()):
+        return Stage(self, name, read, written)
+
+    def add(self, record):
+        with self.lock:
+            self.stages.append(record)
+        self.write()
+
+    def data(self):
+        with self.lock:
+            stages = [dict(record) for record in self.stages]
+        total = {key: round(sum(record.get(key) or 0 for record in stages), 6)
+                 for key in ('wall', 'cpu', 'child_cpu', 'bytes_read', 'bytes_written')}
+        return {'format': REPORT_FORMAT,
+                'structure': self.prot,
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'host': platform.node(),
+                'platform': sys.platform,
+                'python': platform.python_version(),
+                'settings': self.settings,
+                'stages': stages,
+                'total': total}
+
+    def write(self):
+        if not self.enabled:
+            return None
+        with self.lock:
+            data = self.data()
+            with open(self.filename+".part", 'w') as outfile:
+                json.dump(data, outfile, indent=1, default=str)
+            os.replace(self.filename+".part", self.filename)
+        return self.filename
@@ -0,0 +1,224 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Background jobs for the Feature-plugin.
+#
+# The stages of the plugin are queued as jobs and run one after the other
+# without blocking the PyMol/Qt event loop : external programs (dssp,
+# featurize, R ...) run in a QProcess whose output is streamed to the
+# status line, python work runs in a worker thread. The running job can be
+# cancelled, which kills the whole process tree and clears the queue.
+
+import threading
+import traceback
+
+from pymol.Qt import QtCore
+
+from . import runner
+
+
+class JobFailed(Exception):
+    '''
+    Raised by a done callback when the result of its job is not usable : the
+    job fails with the message and the stages queued after it are dropped.
+    '''
+
+
+class Job:
+    '''
+    A queued stage. kind is 'step' (python run in the GUI thread, which may
+    queue further jobs), 'call' (python run in a worker thread) or
+    'process' (external program). done(result) is called in the GUI thread
+    when the job has succeeded; result is the exit code of a process or the
+    return value of a function. stage is an optional instrument.Stage
+    measuring the job while it runs.
+    '''
+    def __init__(self, name, kind, function=None, program=None, args=(), stdin=None, done=None,
+                 stage=None):
+        self.name = name
+        self.kind = kind
+        self.function = function
+        self.program = program
+        self.args = list(args)
+        self.stdin = stdin
+        self.done = done
+        self.stage = stage
+
+
+class JobQueue(QtCore.QObject):
+    '''
+    Runs queued jobs in order. message(text) is emitted for the status line.
+    Jobs queued while a step or a done callback runs are inserted right
+    after its job, so a stage can split its own work into further jobs
+    which run before the stages queued later.
+    '''
+    message = QtCore.Signal(str)
+    call_finished = QtCore.Signal(object, object, object)
+
+    def __init__(self, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self.queue = []
+        self.current = None
+        self.process = None
+        self.cancel_event = threading.Event()
+        self.inserted = None
+        self.call_finished.connect(self.finish_call)
+
+    # -- queueing --------------------------------------------------------
+
+    def add(self, job):
+        if self.inserted is not None:
+            self.inserted.append(job)
+        else:
+            self.queue.append(job)
+        self.start()
+        return job
+
+    def step(self, name, function, done=None):
+        return self.add(Job(name, 'step', function=function, done=done))
+
+    def call(self, name, function, done=None, stage=None):
+        '''Queues function(report, cancel) to run in a worker thread.'''
+        return self.add(Job(name, 'call', function=function, done=done, stage=stage))
+
+    def run(self, name, program, args=(), stdin=None, done=None, stage=None):
+        '''Queues an external program, stdin being an optional input file.'''
+        return self.add(Job(name, 'process', program=program, args=args, stdin=stdin, done=done,
+                            stage=stage))
+
+    def busy(self):
+        return self.current is not None
+
+    # -- running ---------------------------------------------------------
+
+    def start(self):
+        if self.current is not None or self.inserted is not None or not self.queue:
+            return
+        self.current = job = self.queue.pop(0)
+        self.cancel_event.clear()
+        if job.kind == 'step':
+            self.run_step(job)
+        elif job.kind == 'call':
+            self.message.emit("Running %s ..." % job.name)
+            thread = threading.Thread(target=self.run_call, args=(job,), daemon=True)
+            thread.start()
+        else:
+            self.start_process(job)
+
+    def run_step(self, job):
+        self.inserted = []
+        try:
+            result = job.function()
+        except Exception:
+            traceback.print_exc()
+            self.inserted = None
+            self.fail(job, "%s failed" % job.name)
+            return
+        self.queue[:0] = self.inserted
+        self.inserted = None
+        self.succeed(job, result)
+
+    def run_call(self, job):
+        # worker thread : only talk to the GUI through signals
+        # (the stage is measured here, its CPU time is the one of this thread)
+        result, error = None, None
+        if job.stage is not None:
+            job.stage.start()
+        try:
+            if job.stage is not None:
+                result = job.stage.call(job.function, self.message.emit, self.cancel_event)
+            else:
+                result = job.function(self.message.emit, self.cancel_event)
+        except Exception:
+            error = traceback.format_exc()
+        if job.stage is not None:
+            job.stage.stop('failed' if error is not None else
+                           'cancelled' if self.cancel_event.is_set() else 'ok')
+        self.call_finished.emit(job, result, error)
+
+    def finish_call(self, job, result, error):
+        if self.cancel_event.is_set():
+            self.fail(job, "%s cancelled" % job.name)
+        elif error is not None:
+            print(error)
+            self.fail(job, "%s failed" % job.name)
+        else:
+            self.succeed(job, result)
+
+    def start_process(self, job):
+        self.message.emit("Running %s ..." % job.name)
+        self.process = process = QtCore.QProcess(self)
+        process.setProcessChannelMode(QtCore.QProcess.MergedChannels)
+        if job.stdin is not None:
+            process.setStandardInputFile(job.stdin)
+        process.readyReadStandardOutput.connect(self.read_output)
+        process.finished.connect(self.finish_process)
+        process.errorOccurred.connect(self.process_error)
+        if job.stage is not None:
+            job.stage.start()
+        process.start(job.program, job.args)
+
+    def process_error(self, error):
+        # finished is not emitted for a program which could not be started
+        if error == QtCore.QProcess.FailedToStart and self.current is not None:
+            job = self.current
+            self.process = None
+            if job.stage is not None:
+                job.stage.stop('failed')
+            self.fail(job, "Could not start %s (%s)" % (job.name, job.program))
+
+    def read_output(self):
+        output = bytes(self.process.readAllStandardOutput()).decode(errors='replace')
+        lines = [line.strip() for line in output.splitlines() if line.strip()]
+        for line in lines:
+            print(line)
+        if lines:
+            self.message.emit("%s : %s" % (self.current.name, lines[-1]))
+
+    def finish_process(self, exit_code, exit_status=None):
+        job = self.current
+        self.process = None
+        if job.stage is not None:
+            job.stage.stop('cancelled' if self.cancel_event.is_set() else
+                           'failed' if exit_code != 0 else 'ok')
+        if self.cancel_event.is_set():
+            self.fail(job, "%s cancelled" % job.name)
+        elif exit_code != 0:
+            self.fail(job, "%s failed with exit code %d" % (job.name, exit_code))
+        else:
+            self.succeed(job, exit_code)
+
+    def succeed(self, job, result):
+        self.current = None
+        if job.done is not None:
+            self.inserted = []
+            try:
+                job.done(result)
+            except JobFailed as error:
+                self.inserted = None
+                self.fail(job, str(error))
+                return
+            except Exception:
+                traceback.print_exc()
+                self.inserted = None
+                self.fail(job, "%s failed" % job.name)
+                return
+            self.queue[:0] = self.inserted
+            self.inserted = None
+        self.start()
+
+    def fail(self, job, text):
+        # later stages depend on this one : drop them
+        self.current = None
+        self.queue = []
+        self.message.emit(text)
+
+    # -- cancelling ------------------------------------------------------
+
+    def cancel(self):
+        '''Clears the queue and stops the running job with its child processes.'''
+        self.queue = []
+        if self.current is None:
+            return
+        self.cancel_event.set()
+        if self.process is not None:
+            runner.kill_tree(self.process.processId())
+            self.process.kill()
@@ -0,0 +1,94 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Chemistry pre-screen of the gridpoints for the Feature-plugin.
+#
+# Metal sites are held by several ligand atoms : a calcium site has
+# oxygens around it within coordination distance. Most gridpoints of a
+# grid have none, yet featurize computes the whole environment of every
+# one. With prescreen = 1, the oxygen and nitrogen atoms within
+# prescreen_o_radius and prescreen_n_radius of every gridpoint are counted
+# on the lattice in one vectorized pass (see grid.atom_counts) and the
+# gridpoints with fewer than the minimum counts of the model are left out
+# of the grid, before featurize.
+#
+# The minimums are given per model label in prescreen_min as comma
+# separated label:O:N entries : "Ca:2:0" keeps the gridpoints with at
+# least 2 oxygens around them for Ca.model. Models without an entry keep
+# all gridpoints. A grid scored with several models keeps the gridpoints
+# any of them needs.
+#
+# The default minimums (2 oxygens within 5 A for Ca) are deliberately
+# loose : a calcium has its oxygens at about 2.4 A and the radius leaves
+# room for gridpoints more than 2 A away from it. They have not been run on
+# the FEATURE calcium benchmark, so the recall of its known sites is not
+# known and the pre-screen stays off by default (prescreen = 0). Check that
+# no known site is lost before turning it on, raising the minimums or
+# shrinking the radii.
+
+import numpy as np
+
+from . import grid
+
+
+def parse_minimums(text):
+    '''
+    Returns the minimums of prescreen_min ("Ca:2:0, Zn:0:1") as
+    {label: (oxygens, nitrogens)}. Raises ValueError on a bad entry.
+    '''
+    minimums = {}
+    for entry in text.split(','):
+        if not entry.strip():
+            continue
+        fields = [field.strip() for field in entry.split(':')]
+        if len(fields) != 3 or not fields[0]:
+            raise ValueError("bad prescreen_min entry %r, expected label:O:N" % entry.strip())
+        minimums[fields[0]] = (int(fields[1]), int(fields[2]))
+    return minimums
+
+
+def model_minimum(minimums, labels):
+    '''
+    Returns the (oxygens, nitrogens) minimum of a grid scored with the
+    models labels, the lowest of every count, None when a model has no
+    entry or no count is required.
+    '''
+    if not labels or any(label not in minimums for label in labels):
+        return None
+    minimum = tuple(min(minimums[label][count] for label in labels) for count in range(2))
+    return minimum if any(minimum) else None
+
+
+def screen_key(labels, settings):
+    '''Returns what the grid of the models labels depends on, None without pre-screen.'''
+    if not int(settings['prescreen']):
+        return None
+    minimum = model_minimum(parse_minimums(settings['prescreen_min']), labels)
+    if minimum is None:
+        return None
+    return [minimum, float(settings['prescreen_o_radius']), float(settings['prescreen_n_radius'])]
+
+
+def ligand_mask(axes, spacing, oxygens, nitrogens, minimum, o_radius, n_radius):
+    '''
+    Returns the lattice mask of the gridpoints having at least minimum[0]
+    of the oxygens within o_radius and minimum[1] of the nitrogens within
+    n_radius ((n, 3) arrays, None for no atom as given by cmd.get_coords).
+    '''
+    keep = np.ones(tuple(len(axis) for axis in axes), dtype=bool)
+    for atoms, count, radius in ((oxygens, minimum[0], o_radius), (nitrogens, minimum[1], n_radius)):
+        if atoms is None:
+            atoms = np.zeros((0, 3))
+        if count > 0:
+            keep &= grid.atom_counts(axes, spacing, atoms, radius) >= count
+    return keep
+
+
+def screen_mask(axes, spacing, oxygens, nitrogens, labels, settings):
+    '''
+    Returns the lattice mask of the gridpoints to featurize for the models
+    labels (see ligand_mask), None if all of them are kept.
+    '''
+    key = screen_key(labels, settings)
+    if key is None:
+        return None
+    minimum, o_radius, n_radius = key
+    return ligand_mask(axes, spacing, oxygens, nitrogens, minimum, o_radius, n_radius)
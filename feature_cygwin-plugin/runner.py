@@ -0,0 +1,294 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Sharded execution of featurize and scoreit for the Feature-plugin.
+#
+# The .ptf file is split into contiguous shards which are featurized and
+# scored by as many bash processes as there are cores. The hits of the
+# shards are then concatenated in shard order, which is the original order
+# of the gridpoints.
+#
+# The shards are run by a backend : LocalBackend runs them on this machine
+# through the bash given by bash_launch (wsl bash, cygwin bash or a native
+# one), cluster.ClusterBackend sends them to workers on other machines.
+# Both have the number of shards to split the grid into (nshards), the
+# suffixes of the files written for every shard (outputs) and
+# run(shards, progress, cancel, report), which returns the failed shards
+# and passes the messages of the run (workers connecting or lost) to
+# report(message).
+
+import os
+import sys
+import shutil
+import signal
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+def split_ptf(ptf_file, nshards, shard_dir):
+    '''
+    Splits ptf_file into at most nshards files of consecutive lines in
+    shard_dir and returns the shard names (file names without extension).
+    The shards differ by one line at most and none is empty : an empty
+    ptf_file has no shard.
+    '''
+    with open(ptf_file, 'r') as infile:
+        npoints = sum(1 for line in infile)
+    nshards = min(max(1, nshards), npoints)
+    size, larger = divmod(npoints, nshards) if nshards else (0, 0)
+    base = os.path.splitext(os.path.basename(ptf_file))[0]
+    if not os.path.isdir(shard_dir):
+        os.mkdir(shard_dir)
+    shards = []
+    with open(ptf_file, 'r') as infile:
+        for number in range(nshards):
+            shard = os.path.join(shard_dir, "%s_%03d" % (base, number))
+            with open(shard+".ptf", 'w') as outfile:
+                for count, line in zip(range(size + (1 if number < larger else 0)), infile):
+                    outfile.write(line)
+            shards.append(shard)
+    return shards
+
+
+def write_script(filename, header, commands):
+    '''
+    Writes a bash script made of the header lines (directory change and
+    FEATURE environment) followed by the commands.
+    '''
+    with open(filename, 'w') as outfile:
+        outfile.write('#!/bin/bash \n')
+        for line in header + commands:
+            outfile.write(line+' \n')
+    return filename
+
+
+def timing_header(times_file, programs=('featurize', 'scoreit')):
+    '''
+    Returns header lines (see write_script) timing every run of the
+    programs in the script : the program name, the wall, user and system
+    seconds and, with GNU time, the peak resident memory (KB) are appended
+    to times_file, one line per run (see instrument.read_times). The output
+    and the exit code of the programs are unchanged.
+    '''
+    lines = ['if /usr/bin/time -f %e true > /dev/null 2>&1; then gnu_time=1; else gnu_time=""; fi']
+    for program in programs:
+        lines.append('%s() { if [ -n "$gnu_time" ]; then '
+                     '/usr/bin/time -a -o %s -f "%s %%e %%U %%S %%M" %s "$@"; '
+                     'else local TIMEFORMAT="%s %%3R %%3U %%3S"; '
+                     '{ time command %s "$@" 2>&3 ; } 3>&2 2>> %s; fi; }'
+                     % (program, times_file, program, program, program, program, times_file))
+    return lines
+
+
+def feature_commands(name, model, stream=False, keep_ff=False):
+    '''
+    Returns the featurize and scoreit commands for the points in name.ptf.
+    With stream, the feature vectors are piped straight into scoreit (the
+    pipe buffer bounds the memory) and name_grid.ff is only written when
+    keep_ff is set.
+    '''
+    if not stream:
+        return ['featurize -P %s.ptf > %s_grid.ff' % (name, name),
+                'scoreit %s %s_grid.ff > %s_grid.hits' % (model, name, name)]
+    tee = ' | tee %s_grid.ff' % name if keep_ff else ''
+    return ['set -o pipefail',
+            'featurize -P %s.ptf%s | scoreit %s /dev/stdin > %s_grid.hits' % (name, tee, model, name)]
+
+
+def featurize_commands(name):
+    '''Returns the featurize command for the points in name.ptf, scored in python.'''
+    return ['featurize -P %s.ptf > %s_grid.ff' % (name, name)]
+
+
+def models_commands(name, models, labels):
+    '''
+    Returns the commands featurizing the points in name.ptf once and
+    scoring name_grid.ff with all models at the same time, the hits of a
+    model going to name_label_grid.hits. The script fails if featurize or
+    any scoreit fails.
+    '''
+    commands = ['featurize -P %s.ptf > %s_grid.ff || exit 1' % (name, name),
+                'pids=""']
+    for model, label in zip(models, labels):
+        commands.append('scoreit %s %s_grid.ff > %s_%s_grid.hits & pids="$pids $!"'
+                        % (model, name, name, label))
+    commands += ['status=0',
+                 'for pid in $pids; do wait $pid || status=1; done',
+                 'exit $status']
+    return commands
+
+
+def kill_tree(pid):
+    '''Kills the process pid and all its child processes.'''
+    if sys.platform.startswith('win'):
+        subprocess.call(['taskkill', '/F', '/T', '/PID', str(pid)],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return
+    try:
+        output = subprocess.check_output(['ps', '-e', '-o', 'pid=,ppid='])
+    except (OSError, subprocess.CalledProcessError):
+        output = b''
+    children = {}
+    for line in output.decode().splitlines():
+        child, parent = line.split()
+        children.setdefault(int(parent), []).append(int(child))
+    tree, todo = [], [pid]
+    while todo:
+        current = todo.pop()
+        tree.append(current)
+        todo.extend(children.get(current, []))
+    for current in tree:
+        try:
+            os.kill(current, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+def run_program(args, stdin=None, cancel=None):
+    '''
+    Runs the program of the argument list args, reading the file stdin if
+    given, and returns its exit code. Setting the threading.Event cancel
+    kills the program with its child processes.
+    '''
+    if cancel is not None and cancel.is_set():
+        return -1
+    with open(stdin if stdin is not None else os.devnull, 'r') as infile:
+        process = subprocess.Popen(args, stdin=infile)
+        while True:
+            try:
+                return process.wait(timeout=0.5)
+            except subprocess.TimeoutExpired:
+                if cancel is not None and cancel.is_set():
+                    kill_tree(process.pid)
+                    return process.wait()
+
+
+def run_programs(arglists, workers=None, cancel=None):
+    '''Runs the programs of arglists in parallel and returns their exit codes.'''
+    workers = workers or default_workers()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda args: run_program(args, cancel=cancel), arglists))
+
+
+def run_script(launch, script, cancel=None):
+    '''
+    Runs script through the bash given by launch (an argument list like
+    ['wsl', 'bash', '-li']) and returns its exit code. Setting the
+    threading.Event cancel kills the script with its child processes.
+    '''
+    return run_program(launch, script, cancel)
+
+
+def run_shards(shards, header, commands, launch, workers=None, progress=None, cancel=None,
+               outputs=('_grid.hits',)):
+    '''
+    Featurizes and scores the shards with a pool of workers (all cores by
+    default). commands(shard) returns the commands run for a shard (see
+    feature_commands) and progress(done, total, shard, returncode) is
+    called each time a shard is finished. Setting the threading.Event
+    cancel stops all shards. Returns the names of the shards that failed
+    or did not write all the files shard+suffix for suffix in outputs.
+    '''
+    workers = workers or default_workers()
+    scripts = [write_script(shard+".sh", header, commands(shard)) for shard in shards]
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        jobs = {pool.submit(run_script, launch, script, cancel): shard
+                for shard, script in zip(shards, scripts)}
+        for done, job in enumerate(as_completed(jobs), 1):
+            shard = jobs[job]
+            returncode = job.result()
+            if returncode != 0 or not all(os.path.isfile(shard+suffix) for suffix in outputs):
+                failed.append(shard)
+            if progress is not None:
+                progress(done, len(shards), shard, returncode)
+    return failed
+
+
+class LocalBackend:
+    '''
+    Runs the shards with workers bash processes (all cores by default)
+    started by launch, header and commands making their scripts (see
+    run_shards).
+    '''
+    def __init__(self, launch, header, commands, workers=None, outputs=('_grid.hits',)):
+        self.launch = launch
+        self.header = header
+        self.commands = commands
+        self.nshards = workers or default_workers()
+        self.outputs = tuple(outputs)
+
+    def run(self, shards, progress=None, cancel=None, report=None):
+        return run_shards(shards, self.header, self.commands, self.launch, self.nshards, progress, cancel,
+                          self.outputs)
+
+
+def merge_files(shards, suffix, filename):
+    '''
+    Concatenates the shard files shard+suffix into filename in shard order.
+    Comment lines are only kept from the first shard. Missing shard files
+    (like unkept .ff files) are skipped and nothing is written when there
+    is none.
+    '''
+    shards = [shard for shard in shards if os.path.isfile(shard+suffix)]
+    if not shards:
+        return None
+    with open(filename, 'w') as outfile:
+        for number, shard in enumerate(shards):
+            with open(shard+suffix, 'r') as infile:
+                for line in infile:
+                    if number == 0 or not line.startswith('#'):
+                        outfile.write(line)
+    return filename
+
+
+def split_lines(filename, counts, filenames):
+    '''
+    Splits the output of a run over several grids (see concat_files) into
+    filenames, the next counts[i] gridpoint lines going to filenames[i] in
+    order. The comment lines before the first gridpoint (the header of .ff
+    files) are written to every file. Raises ValueError if filename does
+    not hold sum(counts) gridpoints.
+    '''
+    def is_point(line):
+        return bool(line.strip()) and not line.startswith('#')
+    with open(filename, 'r') as infile:
+        header = []
+        line = infile.readline()
+        while line.startswith('#'):
+            header.append(line)
+            line = infile.readline()
+        for count, name in zip(counts, filenames):
+            with open(name, 'w') as outfile:
+                outfile.writelines(header)
+                while count and line:
+                    outfile.write(line)
+                    count -= is_point(line)
+                    line = infile.readline()
+            if count:
+                raise ValueError("%s holds fewer gridpoints than its grids" % filename)
+        if is_point(line) or any(is_point(line) for line in infile):
+            raise ValueError("%s holds more gridpoints than its grids" % filename)
+    return list(filenames)
+
+
+def concat_files(filenames, filename):
+    '''Concatenates filenames (the .ptf files of several structures) into filename.'''
+    with open(filename, 'wb') as outfile:
+        for name in filenames:
+            with open(name, 'rb') as infile:
+                shutil.copyfileobj(infile, outfile)
+    return filename
+
+
+def remove_shards(shards, suffixes=('.ptf', '.sh', '_grid.ff', '_grid.hits')):
+    for shard in shards:
+        for suffix in suffixes:
+            if os.path.isfile(shard+suffix):
+                os.remove(shard+suffix)
+    shard_dirs = set(os.path.dirname(shard) for shard in shards)
+    for shard_dir in shard_dirs:
+        if shard_dir and not os.listdir(shard_dir):
+            os.rmdir(shard_dir)
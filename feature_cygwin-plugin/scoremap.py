@@ -0,0 +1,102 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Volumetric score maps for the Feature-plugin.
+#
+# The scores of all the gridpoints of a _grid.hits file are scattered in
+# one vectorized step into a 3D array on the lattice of the grid : same
+# spacing, and a gridpoint of the grid as origin (both read off the hit
+# coordinates when they are not given). The hotspots then show as the
+# isosurface of one map object instead of millions of points. Gridpoints
+# left out of the grid (pruning) get the lowest score of the map.
+#
+# Maps are written as CCP4/MRC files (mode 2, 32-bit floats, x fastest).
+# The origin is not a whole number of spacings away from 0, so it is kept in
+# the ORIGIN words of the MRC2014 header with start indices 0, as read by
+# PyMol and Chimera.
+
+import struct
+
+import numpy as np
+
+from . import hits
+
+# CCP4/MRC header : 56 words followed by 10 labels of 80 characters
+CCP4_HEADER = '<10i6f3i3f2i25i3f4s4Bfi800s'
+
+
+def lattice_spacing(xyz, default=None):
+    '''
+    Returns the spacing of the lattice holding the (n, 3) gridpoints xyz,
+    given with 3 decimals as in the .ptf files : the span of the longest
+    axis over its number of steps, default if all points share every
+    coordinate.
+    '''
+    xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+    best = None
+    for axis in range(3):
+        values = np.unique(np.round(xyz[:, axis], 3))
+        if len(values) < 2:
+            continue
+        steps = np.diff(values)
+        # gaps of pruned gridpoints are whole numbers of steps, the rounding errors average out
+        step = steps[steps < 1.5*steps.min()].mean()
+        span = values[-1] - values[0]
+        nsteps = np.round(span / step)
+        if best is None or nsteps > best[1]:
+            best = (span, nsteps)
+    if best is None:
+        return default
+    return float(best[0] / best[1])
+
+
+def score_grid(scores, xyz, spacing=None, fill=None):
+    '''
+    Returns the map of the scores of the (n, 3) gridpoints xyz as (data,
+    origin, spacing) : data is an (nx, ny, nz) float32 array whose [0, 0, 0]
+    is the gridpoint at origin (the lowest x, y and z of xyz). The spacing
+    is read off xyz if not given. Missing gridpoints get fill, by default
+    the lowest score (0 if all are positive). A gridpoint scored several
+    times (hits of several models) keeps its best score.
+    '''
+    xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+    scores = np.asarray(scores, dtype=float).ravel()
+    if len(scores) == 0:
+        raise ValueError("no gridpoints to map")
+    if spacing is None:
+        spacing = lattice_spacing(xyz, default=1.0)
+    origin = xyz.min(axis=0)
+    index = np.rint((xyz - origin) / spacing).astype(np.intp)
+    if fill is None:
+        fill = min(float(scores.min()), 0.0)
+    data = np.full(tuple(index.max(axis=0) + 1), fill, dtype=np.float32)
+    np.maximum.at(data, tuple(index.T), scores.astype(np.float32))
+    return data, origin, float(spacing)
+
+
+def write_ccp4(filename, data, origin, spacing, label="FEATURE scores"):
+    '''Writes the map data (see score_grid) as a CCP4/MRC file, in one pass.'''
+    data = np.asarray(data, dtype=np.float32)
+    nx, ny, nz = data.shape
+    extra = [0]*25
+    # MRC2014 NVERSION
+    extra[3] = 20140
+    header = struct.pack(CCP4_HEADER, nx, ny, nz, 2, 0, 0, 0, nx, ny, nz,
+                         nx*spacing, ny*spacing, nz*spacing, 90.0, 90.0, 90.0,
+                         1, 2, 3,
+                         float(data.min()), float(data.max()), float(data.mean(dtype=np.float64)),
+                         1, 0, *extra,
+                         *[float(value) for value in origin],
+                         b'MAP ', 0x44, 0x44, 0, 0, float(data.std(dtype=np.float64)), 1,
+                         label.encode('ascii', 'replace')[:80].ljust(800))
+    with open(filename, 'wb') as outfile:
+        outfile.write(header)
+        # x fastest : the columns of the map are along x
+        outfile.write(data.astype('<f4').tobytes(order='F'))
+    return filename
+
+
+def write_score_map(hitsfile, filename, spacing=None, workers=1):
+    '''Writes the map of all the scores of hitsfile to filename, returns the number of gridpoints.'''
+    scores, xyz = hits.read_hits(hitsfile, workers=workers)
+    data, origin, spacing = score_grid(scores, xyz, spacing)
+    write_ccp4(filename, data, origin, spacing)
+    return len(scores)
@@ -0,0 +1,17 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Unit tests of the Feature-plugin modules, run with pytest from the
+# directory holding the plugins :
+#
+#   python -m pytest -q
+#
+# They need numpy only (no PyMol, FEATURE, DSSP or R). The plugin directory
+# is not a python name : the tests import its modules with import_module,
+# as python -m does, from the directory put on the path here.
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
@@ -0,0 +1,68 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Tests of the content-addressed cache (cache.py).
+
+import os
+import time
+from importlib import import_module
+
+import numpy as np
+
+PLUGIN = os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+cache = import_module(PLUGIN + ".cache")
+
+
+def artifact(directory, name, size):
+    filename = os.path.join(str(directory), name)
+    with open(filename, 'wb') as outfile:
+        outfile.write(name.encode()[:1] * size)
+    return filename
+
+
+def age(store, key, seconds):
+    '''Makes the entry key last used seconds ago.'''
+    used = time.time() - seconds
+    os.utime(os.path.join(store.root, key), (used, used))
+
+
+def test_digest():
+    assert cache.digest("a", 1) == cache.digest("a", 1)
+    assert cache.digest("a", 1) != cache.digest("a1")
+    assert cache.digest(np.arange(3.0)) != cache.digest(np.arange(3))
+    # pdb files keep 3 decimals
+    assert cache.coords_digest([[1.0, 2.0, 3.0]]) == cache.coords_digest([[1.0001, 2.0, 3.0]])
+    assert cache.coords_digest([[1.0, 2.0, 3.0]]) != cache.coords_digest([[1.001, 2.0, 3.0]])
+    assert cache.coords_digest(None) == cache.coords_digest(np.zeros((0, 3)))
+
+
+def test_fetch_copies_all_or_nothing(tmp_path):
+    store = cache.ArtifactCache(str(tmp_path / "cache"), 10**6)
+    store.store('key', {'prot.dssp': artifact(tmp_path, "dssp", 10)})
+    target = str(tmp_path / "copy.dssp")
+    assert store.fetch('key', {'prot.dssp': target})
+    with open(target, 'rb') as infile:
+        assert infile.read() == b'd' * 10
+    missing = str(tmp_path / "copy.ptf")
+    assert not store.fetch('key', {'prot.dssp': str(tmp_path / "again.dssp"), 'prot.ptf': missing})
+    assert not os.path.exists(str(tmp_path / "again.dssp")) and not os.path.exists(missing)
+    assert not store.fetch('other', {'prot.dssp': target})
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    store = cache.ArtifactCache(str(tmp_path / "cache"), 250)
+    for number, key in enumerate(("a", "b")):
+        store.store(key, {'file': artifact(tmp_path, key, 100)})
+        age(store, key, 100 - number)
+    # using a makes b the oldest entry
+    assert store.fetch("a", {'file': str(tmp_path / "copy")})
+    store.store("c", {'file': artifact(tmp_path, "c", 100)})
+    assert sorted(key for used, size, key in store.entries()) == ["a", "c"]
+    # an entry larger than the cache is kept until the next one
+    store.store("d", {'file': artifact(tmp_path, "d", 300)})
+    assert [key for used, size, key in store.entries()] == ["d"]
+
+
+def test_disabled_cache(tmp_path):
+    store = cache.ArtifactCache(str(tmp_path / "cache"), 0)
+    store.store('key', {'prot.dssp': artifact(tmp_path, "dssp", 10)})
+    assert not os.path.exists(str(tmp_path / "cache"))
+    assert not store.fetch('key', {'prot.dssp': str(tmp_path / "copy.dssp")})
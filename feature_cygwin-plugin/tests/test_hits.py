@@ -0,0 +1,83 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Tests of the reading of _grid.hits files (hits.py) in blocks and byte
+# ranges against the lines parsed one by one.
+
+import os
+from importlib import import_module
+
+import numpy as np
+import pytest
+
+PLUGIN = os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+hits = import_module(PLUGIN + ".hits")
+
+
+def write_hits(filename, count=2000, seed=1, newline="\n"):
+    '''Writes count gridpoints with comment and blank lines, returns their scores and coordinates.'''
+    rng = np.random.default_rng(seed)
+    scores = np.round(rng.exponential(5.0, size=count), 3)
+    xyz = np.round(rng.uniform(-50.0, 50.0, size=(count, 3)), 3)
+    with open(filename, 'w', newline="") as outfile:
+        outfile.write("# FEATURE scoreit"+newline)
+        for number, (score, point) in enumerate(zip(scores, xyz)):
+            if number % 500 == 250:
+                outfile.write("# a comment"+newline+newline)
+            comment = "\t#\tcomment" if number % 7 == 0 else ""
+            outfile.write("Env_prot_%d\t%g\t%.3f\t%.3f\t%.3f%s%s" % ((number, score) + tuple(point)
+                                                                  + (comment, newline)))
+    return scores, xyz
+
+
+@pytest.mark.parametrize('newline', ["\n", "\r\n"])
+@pytest.mark.parametrize('cutoff', [None, 0.0, 4.0, 12.0, 1e9])
+@pytest.mark.parametrize('block_size', [64, 1000, hits.BLOCK_SIZE])
+def test_blocks_match_line_by_line(tmp_path, newline, cutoff, block_size):
+    filename = str(tmp_path / "prot_grid.hits")
+    scores, xyz = write_hits(filename, newline=newline)
+    keep = np.ones(len(scores), dtype=bool) if cutoff is None else scores >= cutoff
+    parts = list(hits.iter_hits(filename, cutoff, block_size=block_size))
+    assert np.array_equal(np.concatenate([part[0] for part in parts]), scores[keep])
+    assert np.array_equal(np.vstack([part[1] for part in parts] + [np.zeros((0, 3))]), xyz[keep])
+
+
+@pytest.mark.parametrize('workers', [1, 3, 8])
+def test_read_hits_in_ranges(tmp_path, workers):
+    filename = str(tmp_path / "prot_grid.hits")
+    scores, xyz = write_hits(filename, count=5000, seed=2)
+    for cutoff in (None, 6.0):
+        keep = np.ones(len(scores), dtype=bool) if cutoff is None else scores >= cutoff
+        found, coords = hits.read_hits(filename, cutoff, workers, block_size=4096)
+        assert np.array_equal(found, scores[keep]) and np.array_equal(coords, xyz[keep])
+
+
+def test_byte_ranges_cut_whole_lines(tmp_path):
+    filename = str(tmp_path / "prot_grid.hits")
+    write_hits(filename, count=300)
+    with open(filename, 'rb') as infile:
+        data = infile.read()
+    ranges = hits.byte_ranges(filename, 7)
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(data)
+    for (start, end), (next_start, next_end) in zip(ranges[:-1], ranges[1:]):
+        assert end == next_start and data[end-1:end] == b'\n'
+
+
+def test_write_hits_above(tmp_path):
+    filename = str(tmp_path / "prot_grid.hits")
+    scores, xyz = write_hits(filename)
+    count = hits.write_hits_above(filename, 8.0, str(tmp_path / "above.hits"))
+    with open(filename, 'r') as infile:
+        expected = [line for line in infile
+                    if line.strip() and not line.startswith('#') and float(line.split('\t')[1]) >= 8.0]
+    with open(str(tmp_path / "above.hits"), 'r') as infile:
+        assert infile.readlines() == expected
+    assert count == np.sum(scores >= 8.0)
+
+
+def test_merge_hits_needs_the_same_gridpoints(tmp_path):
+    first, second = str(tmp_path / "a.hits"), str(tmp_path / "b.hits")
+    write_hits(first, count=50)
+    write_hits(second, count=50)
+    assert hits.merge_hits([first, second], ["A", "B"], str(tmp_path / "merged.hits")) == 50
+    write_hits(second, count=50, seed=3)
+    with pytest.raises(ValueError):
+        hits.merge_hits([first, second], ["A", "B"], str(tmp_path / "merged.hits"))
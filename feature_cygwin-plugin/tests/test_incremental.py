@@ -0,0 +1,105 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Tests of the incremental recompute (incremental.py) : changed atoms,
+# affected gridpoints against brute force distances and the splicing of
+# the new hits into the old ones.
+
+import os
+from importlib import import_module
+
+import numpy as np
+
+PLUGIN = os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+grid = import_module(PLUGIN + ".grid")
+incremental = import_module(PLUGIN + ".incremental")
+
+SPACING = 0.8
+
+
+def lattice_points(seed=1):
+    atoms = np.random.default_rng(seed).uniform(-8.0, 8.0, size=(30, 3))
+    axes = grid.grid_axes(grid.find_borders(atoms, 2.0), SPACING)
+    return atoms, np.round(np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3), 3)
+
+
+def write_points(filename, xyz, scores=None):
+    '''Writes xyz as a .ptf file, or as a hits file with scores.'''
+    with open(filename, 'w') as outfile:
+        if scores is not None:
+            outfile.write("# scoreit\n")
+        for number, point in enumerate(xyz):
+            if scores is None:
+                outfile.write("prot %8.3f %8.3f %8.3f\n" % tuple(point))
+            else:
+                outfile.write("Env_%d\t%g\t%.3f\t%.3f\t%.3f\n" % ((number, scores[number]) + tuple(point)))
+    return filename
+
+
+def test_changed_atoms():
+    keys = ["A/ALA`1/CA", "A/ALA`1/CB", "A/GLY`2/CA", "A/GLY`2/CA"]
+    coords = np.arange(12.0).reshape(4, 3)
+    new_keys = ["A/ALA`1/CA", "A/GLY`2/CA", "A/GLY`2/CA", "A/SER`3/OG"]
+    new_coords = np.vstack([coords[0] + 0.0005, coords[2], coords[3] + [1.0, 0.0, 0.0], [50.0, 50.0, 50.0]])
+    changed = incremental.changed_atoms(keys, coords, new_keys, new_coords)
+    # CB removed, the second CA of GLY moved (old and new position), OG added
+    expected = np.vstack([coords[1], coords[3], new_coords[2], new_coords[3]])
+    assert sorted(map(tuple, changed)) == sorted(map(tuple, expected))
+    assert len(incremental.changed_atoms(keys, coords, keys, coords)) == 0
+
+
+def test_affected_points_match_brute_force():
+    atoms, xyz = lattice_points()
+    changed = atoms[:3] + 0.3
+    for radius in (2.0, incremental.FEATURE_RADIUS):
+        mask = incremental.affected_points(xyz, changed, SPACING, radius)
+        dist = np.sqrt(np.sum((xyz[:, None, :] - changed[None, :, :])**2, axis=2))
+        assert np.array_equal(mask, (dist <= radius).any(axis=1))
+    # not a lattice of this spacing
+    assert incremental.affected_points(xyz, changed, 0.7).all()
+
+
+def test_select_points(tmp_path):
+    atoms, xyz = lattice_points(seed=2)
+    ptf = write_points(str(tmp_path / "prot.ptf"), xyz)
+    # the previous hits miss the last 5 gridpoints
+    old = write_points(str(tmp_path / "prot_grid.hits"), xyz[:-5], np.ones(len(xyz) - 5))
+    changed = atoms[:1]
+    total, selected = incremental.select_points(ptf, old, str(tmp_path / "prot_delta.ptf"), changed, SPACING, 3.0)
+    near = np.sqrt(np.sum((xyz - changed)**2, axis=1)) <= 3.0
+    near[-5:] = True
+    assert total == len(xyz) and selected == near.sum()
+    assert np.array_equal(incremental.read_ptf_coords(str(tmp_path / "prot_delta.ptf")), xyz[near])
+
+
+def test_splice_keeps_the_grid_order(tmp_path):
+    atoms, xyz = lattice_points(seed=3)
+    rng = np.random.default_rng(3)
+    ptf = write_points(str(tmp_path / "prot.ptf"), xyz)
+    old_scores = rng.uniform(0.0, 10.0, size=len(xyz))
+    # the old hits in another order, without the first 10 gridpoints
+    order = rng.permutation(np.arange(10, len(xyz)))
+    old = write_points(str(tmp_path / "prot_grid.hits"), xyz[order], old_scores[order])
+    delta = rng.choice(len(xyz), 40, replace=False)
+    delta_scores = old_scores[delta] + 100.0
+    write_points(str(tmp_path / "prot_delta_grid.hits"), xyz[delta], delta_scores)
+    count = incremental.splice(ptf, old, str(tmp_path / "prot_delta_grid.hits"), old)
+    expected = old_scores.copy()
+    expected[delta] = delta_scores
+    present = np.ones(len(xyz), dtype=bool)
+    present[:10] = False
+    present[delta] = True
+    with open(old, 'r') as infile:
+        lines = infile.readlines()
+    assert lines[0] == "# scoreit\n" and count == len(lines) - 1 == present.sum()
+    rows = [line.split('\t') for line in lines[1:]]
+    assert np.allclose([[float(value) for value in row[2:5]] for row in rows], xyz[present])
+    assert np.allclose([float(row[1]) for row in rows], expected[present], atol=1e-3)
+    assert not os.path.exists(old+".part")
+
+
+def test_snapshot_round_trip(tmp_path):
+    filename = incremental.save_snapshot(str(tmp_path / "prot.snapshot.npz"), ["A/ALA`1/CA"], [[1.0, 2.0, 3.0]],
+                                         "run key", [0.5, 0.5, 0.5], SPACING)
+    snapshot = incremental.load_snapshot(filename)
+    assert list(snapshot['keys']) == ["A/ALA`1/CA"] and snapshot['run'] == "run key"
+    assert np.array_equal(snapshot['coords'], [[1.0, 2.0, 3.0]]) and snapshot['spacing'] == SPACING
+    assert incremental.load_snapshot(str(tmp_path / "missing.npz")) is None
@@ -0,0 +1,79 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Tests of the site refinement (refine.py) against a plain version of
+# getSites of findsites.R : all the hits sorted again and all distances
+# computed for every site.
+
+import os
+from importlib import import_module
+
+import numpy as np
+
+PLUGIN = os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+refine = import_module(PLUGIN + ".refine")
+
+
+def reference_sites(scores, xyz, cutoff, refine_radius):
+    keep = scores >= cutoff
+    scores, xyz = scores[keep], xyz[keep]
+    sites = []
+    while len(scores):
+        order = np.argsort(-scores, kind='stable')
+        scores, xyz = scores[order], xyz[order]
+        if len(scores) == 1:
+            site = xyz[0]
+        else:
+            near = np.sqrt(np.sum((xyz - xyz[0])**2, axis=1)) <= refine_radius
+            weights = np.exp(scores[near])
+            site = weights @ xyz[near] / weights.sum()
+        members = np.sqrt(np.sum((xyz - site)**2, axis=1)) <= refine.SITE_RADIUS
+        if not members.any():
+            sites.append(list(site) + [0] + [np.nan]*6)
+            break
+        values = scores[members]
+        sites.append(list(site) + [members.sum(), values.min(), np.percentile(values, 25), np.median(values),
+                                   values.mean(), np.percentile(values, 75), values.max()])
+        scores, xyz = scores[~members], xyz[~members]
+    return np.array(sites, dtype=float).reshape(-1, 10)
+
+
+def clustered_hits(seed, nclusters=6, size=40):
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(-20.0, 20.0, size=(nclusters, 3))
+    xyz = np.vstack([center + rng.normal(0.0, 1.5, size=(size, 3)) for center in centers])
+    # a few scattered hits between the clusters
+    xyz = np.vstack([xyz, rng.uniform(-25.0, 25.0, size=(30, 3))])
+    return rng.uniform(0.0, 60.0, size=len(xyz)), xyz
+
+
+def test_predict_sites_matches_reference():
+    for seed in range(5):
+        scores, xyz = clustered_hits(seed)
+        for precision, cutoff, radius in (("99", 0, 3.5), ("95", 0, 3.5), ("other", 40.0, 2.5)):
+            sites = refine.predict_sites(scores, xyz, precision, cutoff, radius)
+            expected = reference_sites(scores, xyz, refine.score_cutoff(precision, cutoff), radius)
+            assert sites.shape == expected.shape
+            assert np.allclose(sites, expected, equal_nan=True)
+
+
+def test_every_hit_is_assigned_once():
+    scores, xyz = clustered_hits(7)
+    sites = refine.predict_sites(scores, xyz, "other", 0)
+    assert sites[:, 3].sum() == len(scores)
+    assert sites[0, 9] == scores.max()
+
+
+def test_no_hit_no_site():
+    sites = refine.predict_sites(np.array([1.0, 2.0]), np.zeros((2, 3)), "99")
+    assert sites.shape == (0, 10)
+
+
+def test_single_hit_is_its_site():
+    sites = refine.predict_sites(np.array([30.0]), np.array([[1.0, 2.0, 3.0]]), "99")
+    assert np.array_equal(sites, [[1.0, 2.0, 3.0, 1, 30, 30, 30, 30, 30, 30]])
+
+
+def test_pred_file_round_trip(tmp_path):
+    scores, xyz = clustered_hits(8)
+    sites = np.vstack([refine.predict_sites(scores, xyz, "95"), [[1.0, 2.0, 3.0, 0] + [np.nan]*6]])
+    filename = refine.write_pred(str(tmp_path / "prot.pred"), "prot", sites)
+    assert np.allclose(refine.read_pred(filename), sites, equal_nan=True)
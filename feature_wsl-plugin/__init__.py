@@ -36,12 +36,37 @@
 import sys
 import os
 
-# pymol.Qt is a wrapper which provides the PySide2/Qt5/Qt4 interface
-# if it has been installed in python before !
-from pymol.Qt import QtWidgets
-from pymol import cmd
 from glob import glob
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    # pymol.Qt is a wrapper which provides the PySide2/Qt5/Qt4 interface
+    # if it has been installed in python before !
+    from pymol.Qt import QtWidgets
+    from pymol import cmd
+    from . import jobs
+except ImportError:
+    # no PyMol : only the pipeline can be used, headless (see batch.py)
+    QtWidgets = cmd = jobs = None
+
+from . import adaptive
+from . import cache
+from . import checkpoint
+from . import cluster
+from . import display
+from . import envelope
+from . import ensemble
+from . import ffstore
+from . import grid
+from . import hits
+from . import incremental
+from . import instrument
+from . import prescreen
+from . import refine
+from . import runner
+from . import scoremap
+from . import scoring
 
 def __init_plugin__(app=None):
     '''
@@ -70,17 +95,92 @@ def run_plugin_gui():
 
 # --------------- Plugin code starts here --------------------
 
+# configuration file in the plugin directory
+CONFIG_FILE = "new2_feature_plugin.conf"
+
+# default settings, options are kept as strings as in the configuration file
+CONFIG_DEFAULTS = {
+    'dssp_exe': '',
+    'R_exe': '',
+    'Rscript_path': '',
+    'feature_data_path': '',
+    'pdb_dir_path': '',
+    'models_dir_path': '',
+    'prune_grid': '0',
+    'prune_min_dist': '2.0',
+    'prune_max_dist': '4.0',
+    'prescreen': '0',
+    'prescreen_min': 'Ca:2:0',
+    'prescreen_o_radius': '5.0',
+    'prescreen_n_radius': '5.0',
+    'adaptive_grid': '0',
+    'adaptive_spacing': '2.0',
+    'adaptive_cutoff': '0.0',
+    'adaptive_radius': '3.0',
+    'grid_envelope': 'box',
+    'envelope_boxes': '8',
+    'region_grid': '0',
+    'region_padding': '4.0',
+    'feature_workers': '0',
+    'stream_features': '0',
+    'keep_ff': '0',
+    'refine_engine': 'python',
+    'cache_size_mb': '2000',
+    'merge_model_hits': '0',
+    'feature_store': '0',
+    'incremental': '0',
+    'feature_radius': '7.5',
+    'run_report': '0',
+    'profile_stages': '0',
+    'save_site_files': '1',
+    'score_map': '0',
+    'feature_backend': 'local',
+    'cluster_port': '8765',
+    'cluster_token': '',
+    'cluster_shards': '64',
+    'cluster_retries': '2',
+    'checkpoint_shards': '0',
+}
+
+def plugin_directory():
+    '''Returns the directory of the configuration file and of the cache.'''
+    if not sys.platform.startswith('win'):
+        home = os.environ.get('HOME')
+    else:
+        home = os.environ.get('HOMEPATH')
+    return os.path.join(home,'.PyMol_plugin')
+
+def read_config(config_file_name):
+    '''Returns the settings of config_file_name over the default ones.'''
+    config_settings = dict(CONFIG_DEFAULTS)
+    if os.path.isfile(config_file_name):
+        with open(config_file_name, 'r') as infile:
+            for line in infile:
+                if line[0]!='#':
+                    entr = line.split('=')
+                    config_settings[entr[0].strip()] = entr[1].strip()
+    return config_settings
+
+def bash_launch(config_settings):
+    '''Argument list starting a login bash which reads a script on stdin.'''
+    if not sys.platform.startswith('win'):
+        # Linux or macOS : FEATURE is installed natively (or replaced, see bench.py)
+        return ['bash']
+    return ['wsl', 'bash', '-li']
+
+def bash_path(path):
+    '''Returns path (a windows path) as seen from the wsl bash.'''
+    if not sys.platform.startswith('win'):
+        return os.path.abspath(path)
+    return ("/mnt/c"+os.path.abspath(path).split(":")[-1]).replace("\\", "/")
+
+
 class Feature:
     def __init__(self, form):
         self.form = form
 
         # get a temporary file directory
-        if not sys.platform.startswith('win'):
-            home = os.environ.get('HOME')
-        else:
-            home = os.environ.get('HOMEPATH')
-
-        tmp_dir = os.path.join(home,'.PyMol_plugin')
+        tmp_dir = plugin_directory()
         if not os.path.isdir(tmp_dir):
             os.mkdir(tmp_dir)
             print("Created temporary files directory:  %s" % tmp_dir)
@@ -109,6 +209,10 @@ class Feature:
             statusline.clear()
             statusline.insert(text)
 
+        def option(key, cast=float):
+            # options are kept as strings in the configuration file
+            return cast(self.config_settings[key])
+
         #-----------------------------------------------------------
 
         # Config page
@@ -218,21 +322,10 @@ class Feature:
             self.config_settings['models_dir_path'] = dirname
 
         def read_plugin_config_file():
-            config_file_name = os.path.join(tmp_dir,"new2_feature_plugin.conf")
-            self.config_settings = {}
-            self.config_settings['dssp_exe'] = ''
-            self.config_settings['R_exe'] = ''
-            self.config_settings['Rscript_path'] = ''
-            self.config_settings['feature_data_path'] = ''
-            self.config_settings['pdb_dir_path'] = ''
-            self.config_settings['models_dir_path'] = ''
+            config_file_name = os.path.join(tmp_dir,CONFIG_FILE)
+            self.config_settings = read_config(config_file_name)
             if os.path.isfile(config_file_name):
                 set_statusline('Reading configuration file: %s' % config_file_name)
-                lst = fileopen(config_file_name,'r').readlines()
-                for line in lst:
-                    if line[0]!='#':
-                        entr = line.split('=')
-                        self.config_settings[entr[0].strip()] = entr[1].strip()
                 set_dssp_location(self.config_settings['dssp_exe'])
                 set_R_location(self.config_settings['R_exe'])
                 set_Rscript_path(self.config_settings['Rscript_path'])
@@ -244,7 +337,7 @@ class Feature:
             return self.config_settings
 
         def save_plugin_config_file():
-            config_file_name = os.path.join(tmp_dir,"new2_feature_plugin.conf")
+            config_file_name = os.path.join(tmp_dir,CONFIG_FILE)
             fp = fileopen(config_file_name,'w')
             print('#========================================', file=fp)
             print('# Feature Plugin configuration file', file=fp)
@@ -285,6 +378,71 @@ class Feature:
 
         #------------------------------------------------------------------
 
+        # Background jobs : the stages run one after the other without
+        # blocking PyMol, their output goes to the status line
+
+        self.jobs = jobqueue = jobs.JobQueue(self.form)
+        jobqueue.message.connect(set_statusline)
+
+        def cancel_jobs():
+            jobqueue.cancel()
+
+        #------------------------------------------------------------------
+
+        # Run reports : time and resources of every stage, see instrument.py
+
+        self.reports = {}
+
+        def run_report(prot, new=False):
+            # report of the present run of prot, only written with run_report = 1
+            enabled = bool(option('run_report', int))
+            if new or prot not in self.reports or self.reports[prot].enabled != enabled:
+                settings = dict(self.config_settings, spacing=set_gridspacing.value(),
+                                precision=self.precision, model=self.form.comboBox_2.currentText())
+                self.reports[prot] = instrument.RunReport(prot+"_report.json" if enabled else None, prot,
+                                                          settings, option('profile_stages', int))
+            return self.reports[prot]
+
+        #------------------------------------------------------------------
+
+        # Cache of the stage results
+
+        artifacts = cache.ArtifactCache(os.path.join(tmp_dir, 'cache'),
+                                        option('cache_size_mb')*2**20)
+        # key and file stamp of the last result of every (structure, stage)
+        self.stage_keys = {}
+
+        def remember(prot, stage, key, filename):
+            self.stage_keys[(prot, stage)] = (key, cache.file_stamp(filename))
+
+        def recall(prot, stage, filename):
+            # key of a stage result, hashed again if unknown or changed on disk
+            key, stamp = self.stage_keys.get((prot, stage), (None, None))
+            if key is None or stamp != cache.file_stamp(filename):
+                key = cache.file_digest(filename)
+            return key
+
+        def structure_key(prot):
+            # coordinates and atom identities : a renamed residue, chain or atom changes dssp and featurize
+            atoms = []
+            cmd.iterate(prot, "atoms.append((type, segi, chain, resn, resi, name, alt, elem))",
+                        space={'atoms': atoms})
+            return cache.digest(cache.coords_digest(cmd.get_coords(prot, 1)), atoms)
+
+        def cached(prot, stage, key, files):
+            # copy the cached results of a stage in place if there are any
+            if not artifacts.fetch(key, files):
+                return False
+            remember(prot, stage, key, list(files.values())[0])
+            set_statusline("Fetched %s from cache" % ", ".join(files.values()))
+            return True
+
+        def store(prot, stage, key, files):
+            artifacts.store(key, files)
+            remember(prot, stage, key, list(files.values())[0])
+
+        #------------------------------------------------------------------
+
         # Feature page
 
         intro_text = """
@@ -319,7 +477,7 @@ class Feature:
             model_list =[]
             list_raw = glob(os.path.join(self.models_dir_path,"*.model"))
             for item in list_raw:
-                model_name = item.split("\\")[-1]
+                model_name = os.path.basename(item)
                 model_list.append(model_name) 
             self.form.comboBox_2.addItems(model_list)
 
@@ -329,46 +487,112 @@ class Feature:
                 set_statusline("No structure selected")
             else:
                 set_statusline("Calculating gridpoints ....")
-                borders = findborders(prot)
-                write_ptf(borders, prot)
-
-        def findborders(selobj):
-            xyz=[]
-            cmd.iterate_state(1, selobj, 'xyz.append([x,y,z])', space=locals(), atomic=0)
-            xlist=[item[0] for item in xyz]
-            ylist=[item[1] for item in xyz]
-            zlist=[item[2] for item in xyz]
-            # extend gridspacing 1 A further than borders
-            highx = max(xlist)+1    
-            lowx = min(xlist)-1
-            highy = max(ylist)+1
-            lowy = min(ylist)-1
-            highz = max(zlist)+1
-            lowz = min(zlist)-1
-            borders = [highx,lowx,highy,lowy,highz,lowz]
+                if self.form.checkBox_2.isChecked():
+                    make_ensemble_grid(prot)
+                    return
+                prune = [self.config_settings[key] for key in
+                         ('prune_grid', 'prune_min_dist', 'prune_max_dist')]
+                origin = None
+                if option('incremental', int) and adaptive_key() is None:
+                    # stay on the lattice of the last run so that its hits can be reused
+                    snapshot = incremental.load_snapshot(prot+".snapshot.npz")
+                    if snapshot is not None and snapshot['spacing'] == set_gridspacing.value():
+                        origin = [float(value) for value in snapshot['origin']]
+                screen = prescreen.screen_key(grid_labels(), self.config_settings)
+                parent = environment(prot)
+                # a region is padded within its parent object, whose atoms prune the grid
+                margin = 1 if parent == prot else option('region_padding')
+                region = None if parent == prot else [parent, structure_key(parent), margin]
+                key = cache.digest('grid', prot, structure_key(prot), set_gridspacing.value(), prune, origin, screen,
+                                   adaptive_key(), envelope.envelope_key(self.config_settings), region)
+                files = {'grid.ptf': prot+".ptf"}
+                # making the grid starts a new run report
+                report = run_report(prot, new=True)
+                if not cached(prot, 'grid', key, files):
+                    with report.stage('findborders'):
+                        borders = findborders(prot, margin)
+                    if origin is not None:
+                        borders = grid.align_borders(borders, origin, set_gridspacing.value())
+                    write_ptf(borders, prot, done=lambda npoints: store(prot, 'grid', key, files))
+
+        def environment(prot):
+            # the object featurize reads around the grid of prot, named in the .ptf lines : with
+            # region_grid = 1, the object holding the selection prot, else prot itself
+            if not option('region_grid', int) or prot not in cmd.get_names("selections"):
+                return prot
+            objects = cmd.get_object_list("(%s)" % prot) or []
+            if len(objects) != 1:
+                print("%s is not within a single object, it is featurized on its own" % prot)
+                return prot
+            return objects[0]
+
+        def grid_labels():
+            # the models the grid is made for (see prescreen.py)
+            if self.form.checkBox.isChecked():
+                models = [self.form.comboBox_2.itemText(i) for i in range(self.form.comboBox_2.count())]
+            else:
+                models = [self.form.comboBox_2.currentText()]
+            return [os.path.splitext(model)[0] for model in models]
+
+        def ligand_atoms(prot, state=1):
+            # the oxygens and nitrogens counted by the pre-screen
+            return [cmd.get_coords("(%s) and elem %s" % (prot, element), state) for element in ('O', 'N')]
+
+        def findborders(selobj, margin=1):
+            # extend gridspacing 1 A (or margin) further than borders
+            borders = grid.find_borders(cmd.get_coords(selobj, 1), margin=margin)
             print("borders (+/-x,+/-y,+/-z) :", borders)
             print("with spacing :", set_gridspacing.value())
             return borders
         
-        def write_ptf(borders, prot):
+        def grid_mask(prot, stage=None):
+            # mask(axes, spacing, frame=None, keep=None) of the gridpoints of keep kept by the pruning
+            # and the pre-screen (None for all), the atoms are read from PyMol at once
+            atoms = None
+            parent = environment(prot)
+            if option('prune_grid', int):
+                # only keep the points in a shell around the heavy atoms
+                atoms = cmd.get_coords("(%s) and not hydro" % parent, 1)
+            min_dist, max_dist = option('prune_min_dist'), option('prune_max_dist')
+            labels = grid_labels()
+            ligands = ligand_atoms(parent) if prescreen.screen_key(labels, self.config_settings) else None
+            prescreened = 0
+            def mask(axes, spacing, frame=None, keep=None):
+                nonlocal prescreened
+                def local(coords):
+                    # the lattice of a PCA envelope is in its own frame (see envelope.py)
+                    return coords if frame is None or coords is None else envelope.to_frame(coords, frame)
+                if atoms is not None:
+                    shell = grid.shell_mask(axes, spacing, local(atoms), min_dist, max_dist)
+                    keep = shell if keep is None else keep & shell
+                if ligands is not None:
+                    screen = prescreen.screen_mask(axes, spacing, *[local(atoms) for atoms in ligands], labels,
+                                                   self.config_settings)
+                    before = screen.size if keep is None else int(keep.sum())
+                    keep = screen if keep is None else keep & screen
+                    prescreened += before - int(keep.sum())
+                    if stage is not None:
+                        stage.count(prescreened=prescreened)
+                return keep
+            return mask
+
+        def write_ptf(borders, prot, done=None):
             filename = prot+".ptf"
-            with open(filename, 'w') as outfile:
-                xval = borders[1]
-                yval = borders[3]
-                zval = borders[5]
-                while xval <= borders[0]:
-                    if xval <= borders[0]:
-                        yval=borders[3]
-                    while yval <= borders[2]:
-                        if yval <= borders[2]:
-                            zval=borders[5]
-                        while zval <= borders[4]:                      
-                            line = prot+" "+'{:8.3f}'.format(xval)+" "+'{:8.3f}'.format(yval)+" "+'{:8.3f}'.format(zval)+"\n" 
-                            outfile.write(line)
-                            zval = zval+set_gridspacing.value()
-                        yval = yval+set_gridspacing.value()
-                    xval = xval+set_gridspacing.value()
-                set_statusline("Created %s" % filename)
+            spacing = adaptive.grid_spacing(self.config_settings, set_gridspacing.value())
+            coords = cmd.get_coords(prot, 1)
+            parent = environment(prot)
+            stage = run_report(prot).stage('write_ptf', written=[filename])
+            mask = grid_mask(prot, stage)
+            def make_grid(report, cancel):
+                frame, boxes = envelope.envelope_boxes(coords, borders, spacing, self.config_settings)
+                npoints = envelope.write_envelope(filename, parent, frame, boxes, spacing, mask)
+                stage.count(gridpoints=npoints, boxes=len(boxes))
+                return npoints
+            def created(npoints):
+                set_statusline("Created %s with %d gridpoints" % (filename, npoints))
+                if done is not None:
+                    done(npoints)
+            jobqueue.call("grid", make_grid, done=created, stage=stage)
 
         def posixer (current_path):
             posix_path = current_path.replace("\\", "/")
@@ -380,53 +604,464 @@ class Feature:
                 set_statusline("No structure selected")
             else:
                 None
+            if prot != "" and self.form.checkBox_2.isChecked():
+                run_ensemble_feature(prot)
+                return
             gridfile = (prot+".ptf")
-            dsspfile = (prot+".dssp")
+            # the grid of a region is featurized in its parent object
+            parent = environment(prot)
+            dsspfile = (parent+".dssp")
             feature_model = self.form.comboBox_2.currentText()
             if ( not os.path.isfile(gridfile)):
                 set_statusline('Could not find %s in current directory' % gridfile)
             else:
-                if ( not os.path.isfile(dsspfile)):
-                    cmd.save(prot+".pdb", prot)
-                    command = 'call "%s" -i %s.pdb -o %s ' % (self.dssp_exe, prot, dsspfile)
-                    print(command)
-                    os.system(command)
-                    set_statusline("Created %s" % dsspfile)
+                structure = structure_key(parent)
+                dssp_key = cache.digest('dssp', structure)
+                # featurize and the workers read the pdb file, also when dssp comes from the cache
+                cmd.save(parent+".pdb", parent)
+                if not cached(parent, 'dssp', dssp_key, {'structure.dssp': dsspfile}):
+                    def dssp_done(exit_code):
+                        set_statusline("Created %s" % dsspfile)
+                        if os.path.isfile(dsspfile):
+                            store(parent, 'dssp', dssp_key, {'structure.dssp': dsspfile})
+                    stage = run_report(prot).stage('dssp', read=[parent+".pdb"], written=[dsspfile])
+                    jobqueue.run("dssp", self.dssp_exe, ['-i', parent+".pdb", '-o', dsspfile], done=dssp_done,
+                                 stage=stage)
+                if self.form.checkBox.isChecked():
+                    run_feature_models(prot, structure)
+                    return
                 model_path = self.models_dir_path
                 model= os.path.join(model_path, feature_model)
                 if ( not os.path.isfile(model)):
                     set_statusline('Could not find %s in current directory' % model)
                 else:
-                    current_path="/mnt/c"+os.path.abspath(os.curdir).split(":")[-1]
-                    current_posix_path=posixer(current_path)
-                    self.pdb_path = "/mnt/c"+self.pdb_dir_path.split(":")[-1]
-                    pdb_posix_path = posixer(str(self.pdb_path))
-                    feature_data_path = self.feature_data_path
-                    feature_posix_path = posixer(str(feature_data_path))
+                    engine = scoring.score_engine(self.config_settings)
+                    run_key = cache.digest(cache.file_digest(model), self.feature_data_path, engine)
+                    hits_key = cache.digest('hits', structure, recall(prot, 'grid', gridfile),
+                                            cache.file_digest(model), self.feature_data_path, engine, adaptive_key())
+                    hits_files = {'grid.hits': prot+"_grid.hits"}
+                    # the snapshot of an incremental run covers a uniform grid only
+                    atoms = atom_snapshot(parent) if option('incremental', int) and adaptive_key() is None else None
+                    previous = None if atoms is None else previous_snapshot(prot, run_key)
+                    if cached(prot, 'hits', hits_key, hits_files):
+                        if atoms is not None:
+                            save_snapshot(prot, atoms, run_key)
+                        return
                     model_rel_path=os.path.relpath(model_path)
                     rel_model=os.path.join(model_rel_path,feature_model)
                     rel_model_posix=posixer(str(rel_model))                
+                    header = feature_header(prot)
+                    python_scoring = engine == 'python'
+                    stream = option('stream_features', int) and not python_scoring
+                    keep_ff = option('keep_ff', int) or not stream
+                    def commands(name):
+                        if python_scoring:
+                            # scored in PyMol once featurize is done
+                            return runner.featurize_commands(posixer(name))
+                        return runner.feature_commands(posixer(name), rel_model_posix, stream, keep_ff)
+                    outputs = ("_grid.ff",) if python_scoring else ("_grid.hits",)
+                    created = "%s_grid.ff and %s_grid.hits" % (prot, prot) if keep_ff else "%s_grid.hits" % prot
+                    backend = feature_backend(parent, header, commands, outputs, [] if python_scoring else [model],
+                                              stream=stream, keep_ff=keep_ff)
+                    launch = bash_launch(self.config_settings)
+                    stamp = cache.file_stamp(prot+"_grid.hits")
+                    def scored(result=None):
+                        set_statusline("Created %s ..." % created)
+                        if cache.file_stamp(prot+"_grid.hits") not in (None, stamp):
+                            store(prot, 'hits', hits_key, hits_files)
+                            if atoms is not None:
+                                save_snapshot(prot, atoms, run_key)
+                        convert_features(prot)
+                    def coarse_scored(result=None):
+                        if adaptive_key() is None:
+                            scored()
+                        else:
+                            run_adaptive(prot, backend, header, commands, [prot+"_grid.hits"],
+                                         [model] if python_scoring else None, done=scored)
+                    def featurized(result=None):
+                        stage.count_lines(gridpoints=gridfile)
+                        if python_scoring:
+                            score_features(prot, [model], [prot+"_grid.hits"], done=coarse_scored)
+                        else:
+                            stage.count_lines(hits=prot+"_grid.hits")
+                            coarse_scored()
+                    if previous is not None:
+                        run_incremental(prot, previous, atoms, backend, header, commands,
+                                        model if python_scoring else None, done=scored)
+                        return
+                    stage = feature_stage(prot, [prot+"_grid.ff", prot+"_grid.hits"])
+                    if backend.nshards > 1 or option('checkpoint_shards', int):
+                        def run_shards(report, cancel):
+                            # the grid goes in the key with the digest of prot.ptf (see checkpoint.py)
+                            return run_feature_shards(prot, backend, report, cancel,
+                                                      cache.digest(run_key, structure, stream, keep_ff))
+                        def shards_done(failed):
+                            if failed:
+                                # the stages queued after featurize would work on partial hits
+                                raise jobs.JobFailed("featurize/scoreit failed for %s" % ", ".join(failed))
+                            featurized()
+                        jobqueue.call("featurize", run_shards, done=shards_done, stage=stage)
+                        return
                     filename = "featurize.sh"
-                    with open(filename, 'w') as outfile:
-                        outfile.write('#!/bin/bash \n')
-                        outfile.write('pushd %s > /dev/null \n' % current_posix_path)
-                        outfile.write('export FEATURE_DIR=%s \n' % feature_posix_path)
-                        outfile.write('export DSSP_DIR=%s \n' % current_posix_path)
-                        outfile.write('export PDB_DIR=%s \n' % pdb_posix_path)
-                        outfile.write('featurize -P %s.ptf > %s_grid.ff \n' % ( prot, prot))
-                        outfile.write('scoreit %s %s_grid.ff > %s_grid.hits \n' % (rel_model_posix, prot, prot))
-                    command = 'call wsl bash -li < %s' % (filename)
-                    print(command)
-                    os.system(command)
-                    set_statusline("Created %s_grid.ff and %s_grid.hits ..." % (prot, prot))
+                    runner.write_script(filename, header, commands(prot))
+                    jobqueue.run("featurize", launch[0], launch[1:], stdin=filename, done=featurized, stage=stage)
+
+        def atom_snapshot(prot):
+            # atom keys and coordinates, compared between incremental runs
+            keys = []
+            cmd.iterate(prot, "keys.append('/'.join((segi, chain, resn, resi, name, alt)))",
+                        space={'keys': keys})
+            return keys, cmd.get_coords(prot, 1)
+
+        def save_snapshot(prot, atoms, run_key):
+            # the snapshot belongs to the present prot_grid.hits
+            origin = incremental.ptf_origin(prot+".ptf")
+            if origin is not None:
+                keys, coords = atoms
+                incremental.save_snapshot(prot+".snapshot.npz", keys, coords,
+                                          cache.digest(run_key, cache.file_stamp(prot+"_grid.hits")),
+                                          origin, set_gridspacing.value())
+
+        def previous_snapshot(prot, run_key):
+            # snapshot of the run which wrote prot_grid.hits with the same model and settings
+            snapshot = incremental.load_snapshot(prot+".snapshot.npz")
+            if snapshot is None or snapshot['run'] != cache.digest(run_key, cache.file_stamp(prot+"_grid.hits")):
+                return None
+            return snapshot
+
+        def run_incremental(prot, previous, atoms, backend, header, commands, model=None, done=None):
+            # featurize and score again only the gridpoints near the atoms edited
+            # since the last run and splice them into prot_grid.hits
+            delta = prot+"_delta"
+            spacing = set_gridspacing.value()
+            radius = option('feature_radius')
+            select_stage = run_report(prot).stage('incremental', read=[prot+".ptf", prot+"_grid.hits"],
+                                        written=[delta+".ptf"])
+            splice_stage = run_report(prot).stage('splice', read=[prot+"_grid.hits", delta+"_grid.hits"],
+                                        written=[prot+"_grid.hits"])
+            def select(report, cancel):
+                keys, coords = atoms
+                changed = incremental.changed_atoms(previous['keys'], previous['coords'], keys, coords)
+                npoints, nselected = incremental.select_points(prot+".ptf", prot+"_grid.hits", delta+".ptf",
+                                                               changed, spacing, radius)
+                select_stage.count(gridpoints=npoints, selected=nselected, changed_atoms=len(changed))
+                return npoints, nselected
+            def splice(report, cancel):
+                count = incremental.splice(prot+".ptf", prot+"_grid.hits", delta+"_grid.hits",
+                                           prot+"_grid.hits")
+                splice_stage.count(hits=count)
+                if os.path.isfile(prot+"_grid.ff") and os.path.isfile(delta+"_grid.ff"):
+                    incremental.splice(prot+".ptf", prot+"_grid.ff", delta+"_grid.ff",
+                                       prot+"_grid.ff", incremental.ff_coords)
+                runner.remove_shards([delta], ('.ptf', '_grid.ff', '_grid.hits'))
+                if os.path.isdir(delta+"_grid.ffs"):
+                    shutil.rmtree(delta+"_grid.ffs")
+                return count
+            def spliced(count):
+                if done is not None:
+                    done(count)
+            def featurized(result=None):
+                jobqueue.call("splice", splice, done=spliced, stage=splice_stage)
+            def selected(result):
+                npoints, nselected = result
+                set_statusline("Featurizing %d of %d gridpoints again ..." % (nselected, npoints))
+                if nselected == 0:
+                    featurized()
+                else:
+                    featurize_points(prot, delta, backend, header, commands, [delta+"_grid.hits"],
+                                     None if model is None else [model], done=featurized)
+            jobqueue.call("incremental", select, done=selected, stage=select_stage)
+
+        def featurize_points(prot, name, backend, header, commands, hitsfiles, models=None, done=None):
+            # featurize and score the gridpoints of name.ptf, a part of the grid of prot, into
+            # hitsfiles, through the backend or a single script (models : scored in PyMol)
+            launch = bash_launch(self.config_settings)
+            parent = environment(prot)
+            stage = feature_stage(prot, [name+"_grid.ff"] + hitsfiles,
+                                  read=[name+".ptf", parent+".pdb", parent+".dssp"])
+            def featurized(result=None):
+                stage.count_lines(gridpoints=name+".ptf")
+                if models is not None:
+                    score_features(name, models, hitsfiles, report=run_report(prot), done=done)
+                else:
+                    stage.count_lines(hits=hitsfiles[0])
+                    done()
+            if backend.nshards > 1:
+                def run_shards(report, cancel):
+                    return run_feature_shards(name, backend, report, cancel)
+                def shards_done(failed):
+                    if failed:
+                        raise jobs.JobFailed("featurize/scoreit failed for %s" % ", ".join(failed))
+                    featurized()
+                jobqueue.call("featurize", run_shards, done=shards_done, stage=stage)
+            else:
+                filename = "featurize.sh"
+                runner.write_script(filename, header, commands(name))
+                jobqueue.run("featurize", launch[0], launch[1:], stdin=filename, done=featurized, stage=stage)
+
+        def adaptive_key():
+            # what the fine gridpoints of an adaptive grid depend on, None for a uniform grid
+            key = adaptive.adaptive_key(self.config_settings)
+            return None if key is None else key + [set_gridspacing.value()]
+
+        def run_adaptive(prot, backend, header, commands, hitsfiles, models=None, done=None):
+            # featurize and score the fine gridpoints around the best gridpoints of the
+            # coarse grid and add them to hitsfiles and prot_grid.ff (see adaptive.py)
+            fine = prot+"_fine"
+            fine_hits = [fine+hitsfile[len(prot):] for hitsfile in hitsfiles]
+            select_stage = run_report(prot).stage('adaptive', read=[prot+".ptf"] + hitsfiles, written=[fine+".ptf"])
+            merge_stage = run_report(prot).stage('merge_levels', read=hitsfiles + fine_hits, written=hitsfiles)
+            spacing = set_gridspacing.value()
+            mask = grid_mask(prot)
+            parent = environment(prot)
+            def select(report, cancel):
+                nselected = adaptive.write_fine_ptf(fine+".ptf", parent, prot+".ptf", hitsfiles, spacing,
+                                                    option('adaptive_spacing'), option('adaptive_cutoff'),
+                                                    option('adaptive_radius'), mask)
+                select_stage.count(gridpoints=nselected)
+                return nselected
+            def merge(report, cancel):
+                count = 0
+                for hitsfile, fine_hitsfile in zip(hitsfiles, fine_hits):
+                    if os.path.isfile(fine_hitsfile):
+                        count = adaptive.merge_levels(hitsfile, fine_hitsfile)
+                if os.path.isfile(prot+"_grid.ff") and os.path.isfile(fine+"_grid.ff"):
+                    adaptive.merge_levels(prot+"_grid.ff", fine+"_grid.ff")
+                adaptive.remove_fine(fine, ['_grid.ff'] + [hitsfile[len(fine):] for hitsfile in fine_hits])
+                if os.path.isdir(fine+"_grid.ffs"):
+                    shutil.rmtree(fine+"_grid.ffs")
+                merge_stage.count(hits=count)
+                return count
+            def featurized(result=None):
+                jobqueue.call("merge levels", merge, done=done, stage=merge_stage)
+            def selected(nselected):
+                set_statusline("Featurizing %d fine gridpoints ..." % nselected)
+                if nselected == 0:
+                    featurized()
+                else:
+                    featurize_points(prot, fine, backend, header, commands, fine_hits, models, done=featurized)
+            jobqueue.call("adaptive", select, done=selected, stage=select_stage)
+
+        def feature_header(prot=None):
+            # directory change and FEATURE environment of the bash scripts
+            current_posix_path = bash_path(os.curdir)
+            pdb_posix_path = bash_path(self.pdb_dir_path)
+            feature_posix_path = posixer(str(self.feature_data_path))
+            header = ['pushd %s > /dev/null' % current_posix_path,
+                      'export FEATURE_DIR=%s' % feature_posix_path,
+                      'export DSSP_DIR=%s' % current_posix_path,
+                      'export PDB_DIR=%s' % pdb_posix_path]
+            if prot is not None and run_report(prot).enabled:
+                # every featurize and scoreit run is timed for the run report
+                header += runner.timing_header(posixer(prot+"_times.txt"))
+            return header
+
+        def feature_stage(prot, written, read=None):
+            # stage of a featurize/scoreit job, with the times of the programs
+            # written by the scripts (see feature_header)
+            report = run_report(prot)
+            if read is None:
+                parent = environment(prot)
+                read = [prot+".ptf", parent+".pdb", parent+".dssp"]
+            stage = report.stage('featurize', read, written)
+            if report.enabled:
+                stage.times_file = prot+"_times.txt"
+            return stage
+
+        def run_feature_models(prot, structure):
+            # featurize once and score with all models of models_dir at the same time
+            model_path = self.models_dir_path
+            models = [self.form.comboBox_2.itemText(i) for i in range(self.form.comboBox_2.count())]
+            if not models:
+                set_statusline('Could not find any model in %s' % model_path)
+                return
+            labels = [os.path.splitext(model)[0] for model in models]
+            hitsfiles = ["%s_%s_grid.hits" % (prot, label) for label in labels]
+            grid_key = recall(prot, 'grid', prot+".ptf")
+            engine = scoring.score_engine(self.config_settings)
+            model_keys = [cache.file_digest(os.path.join(model_path, model)) for model in models]
+            models_key = cache.digest(*model_keys)
+            hits_keys = [cache.digest('hits', structure, grid_key, model_key, self.feature_data_path, engine,
+                                      adaptive_key()) for model_key in model_keys]
+            def finished(result=None):
+                created = list(hitsfiles)
+                if option('merge_model_hits', int):
+                    hits.merge_hits(hitsfiles, labels, prot+"_models_grid.hits")
+                    created.append(prot+"_models_grid.hits")
+                # the selected model is refined as in the single model mode
+                feature_model = self.form.comboBox_2.currentText()
+                if feature_model in models:
+                    shutil.copyfile(hitsfiles[models.index(feature_model)], prot+"_grid.hits")
+                set_statusline("Created %s" % ", ".join(created))
+            def stored(result=None):
+                for label, key, hitsfile in zip(labels, hits_keys, hitsfiles):
+                    store(prot, 'hits_'+label, key, {'grid.hits': hitsfile})
+                finished()
+                convert_features(prot)
+            if all(cached(prot, 'hits_'+label, key, {'grid.hits': hitsfile})
+                   for label, key, hitsfile in zip(labels, hits_keys, hitsfiles)):
+                finished()
+                return
+            rel_models = [posixer(os.path.join(os.path.relpath(model_path), model)) for model in models]
+            header = feature_header(prot)
+            python_scoring = engine == 'python'
+            def commands(name):
+                if python_scoring:
+                    return runner.featurize_commands(posixer(name))
+                return runner.models_commands(posixer(name), rel_models, labels)
+            model_files = [os.path.join(model_path, model) for model in models]
+            def coarse_scored(result=None):
+                if adaptive_key() is None:
+                    stored()
+                else:
+                    run_adaptive(prot, backend, header, commands, hitsfiles,
+                                 model_files if python_scoring else None, done=stored)
+            def featurized(result=None):
+                stage.count_lines(gridpoints=prot+".ptf")
+                if python_scoring:
+                    score_features(prot, model_files, hitsfiles, done=coarse_scored)
+                else:
+                    stage.count_lines(hits=hitsfiles[0])
+                    coarse_scored()
+            parent = environment(prot)
+            if python_scoring:
+                backend = feature_backend(parent, header, commands, ["_grid.ff"])
+            else:
+                backend = feature_backend(parent, header, commands, ["_%s_grid.hits" % label for label in labels],
+                                          [os.path.join(model_path, model) for model in models], labels)
+            launch = bash_launch(self.config_settings)
+            stage = feature_stage(prot, [prot+"_grid.ff"] + hitsfiles)
+            if backend.nshards > 1 or option('checkpoint_shards', int):
+                def run_shards(report, cancel):
+                    return run_feature_shards(prot, backend, report, cancel,
+                                              cache.digest(structure, models_key, self.feature_data_path, engine))
+                def shards_done(failed):
+                    if failed:
+                        raise jobs.JobFailed("featurize/scoreit failed for %s" % ", ".join(failed))
+                    featurized()
+                jobqueue.call("featurize", run_shards, done=shards_done, stage=stage)
+                return
+            filename = "featurize.sh"
+            runner.write_script(filename, header, commands(prot))
+            jobqueue.run("featurize", launch[0], launch[1:], stdin=filename, done=featurized, stage=stage)
+
+        def score_features(prot, models, hitsfiles, done=None, report=None):
+            # score prot_grid.ff in PyMol instead of running scoreit
+            fffile = prot+"_grid.ff"
+            stage = (report or run_report(prot)).stage('scoring', read=[fffile], written=hitsfiles)
+            def score(report, cancel):
+                store = ffstore.open_store(prot+"_grid.ffs", fffile)
+                for model, hitsfile in zip(models, hitsfiles):
+                    report("Scoring %d gridpoints with %s ..." % (len(store), os.path.basename(model)))
+                    scoring.write_hits(hitsfile, store, scoring.score_store(scoring.read_model(model), store))
+                stage.count(gridpoints=len(store), models=len(models))
+                return len(store)
+            jobqueue.call("scoring", score, done=done, stage=stage)
+
+        def convert_features(prot):
+            # keep the feature vectors in a memory-mapped store for rescoring
+            fffile = prot+"_grid.ff"
+            if option('feature_store', int) and os.path.isfile(fffile):
+                def convert(report, cancel):
+                    return len(ffstore.open_store(prot+"_grid.ffs", fffile))
+                def converted(npoints):
+                    set_statusline("Stored %d feature vectors in %s_grid.ffs" % (npoints, prot))
+                jobqueue.call("feature store", convert, done=converted)
+
+        def feature_backend(structure, header, commands, outputs, models=(), labels=(), stream=False,
+                            keep_ff=True):
+            # the shards run on the cores of this machine through bash (wsl, cygwin or native),
+            # or on the workers of a cluster (see cluster.py), which get the files of the structure
+            if self.config_settings['feature_backend'] != 'cluster':
+                workers = option('feature_workers', int) or runner.default_workers()
+                return runner.LocalBackend(bash_launch(self.config_settings), header, commands, workers, outputs)
+            pdbfile = os.path.join(self.pdb_dir_path, structure+".pdb")
+            files = [pdbfile if os.path.isfile(pdbfile) else structure+".pdb", structure+".dssp"]
+            job = {'labels': list(labels), 'stream': bool(stream), 'keep_ff': bool(keep_ff)}
+            return cluster.ClusterBackend(option('cluster_port', int), files, models, job, outputs,
+                                          option('cluster_shards', int), option('cluster_retries', int),
+                                          self.config_settings['cluster_token'])
+
+        def run_feature_shards(prot, backend, report, cancel, key=None):
+            # split the grid and featurize/score the shards with the backend
+            # (runs in a worker thread, report() writes to the status line)
+            nshards = option('checkpoint_shards', int)
+            # cluster runs are always resumable : their shards are lost with a worker or the connection
+            if key is None or not (nshards or isinstance(backend, cluster.ClusterBackend)):
+                shards = todo = runner.split_ptf(prot+".ptf", backend.nshards, prot+"_shards")
+                resume = None
+            else:
+                # the shards are kept with a manifest until merged : a run of the same job resumes them
+                resume = checkpoint.Checkpoint(prot+"_shards", cache.digest(key, backend.outputs), backend.outputs)
+                shards = resume.split(prot+".ptf", max(nshards, backend.nshards))
+                todo = resume.pending()
+                if len(todo) < len(shards):
+                    report("Resuming %s : %d of %d shards left ..." % (prot, len(todo), len(shards)))
+            def progress(done, total, shard, returncode):
+                if returncode != 0:
+                    report("Shard %s failed with exit code %d" % (os.path.basename(shard), returncode))
+                    return
+                if resume is not None:
+                    resume.complete(shard)
+                report("Featurized %d of %d shards ..." % (len(shards) - len(todo) + done, len(shards)))
+            failed = backend.run(todo, progress, cancel, report) if todo else []
+            if not failed:
+                for suffix in dict.fromkeys(("_grid.ff",) + backend.outputs):
+                    runner.merge_files(shards, suffix, prot+suffix)
+                # an empty grid has no shard, its outputs are empty
+                for suffix in backend.outputs if not shards else ():
+                    open(prot+suffix, 'w').close()
+                if resume is not None:
+                    resume.remove()
+                runner.remove_shards(shards, ('.ptf', '.sh', '_grid.ff') + backend.outputs)
+            return failed
 
         def refine_results():
             prot = self.form.comboBox.currentText()
             if prot == "":
                 set_statusline("No structure selected")
-            else:
+                return
+            if self.form.checkBox_2.isChecked():
+                refine_ensemble(prot)
+                return
+            hitsfile = prot+"_grid.hits"
+            if os.path.isfile(hitsfile):
+                engine = self.config_settings['refine_engine']
+                key = cache.digest('pred', recall(prot, 'hits', hitsfile), self.precision, engine)
+                if cached(prot, 'pred', key, {'sites.pred': prot+".pred"}):
+                    return
+            stamp = cache.file_stamp(prot+".pred")
+            def refined(result):
+                # only cache a .pred file which has just been written
+                if os.path.isfile(hitsfile) and cache.file_stamp(prot+".pred") not in (None, stamp):
+                    store(prot, 'pred', key, {'sites.pred': prot+".pred"})
+            if self.config_settings['refine_engine'] == 'R':
                 write_rscript(prot)
-                run_rscript(prot)
+                run_rscript(prot, done=refined)
+            else:
+                refine_sites(prot, done=refined)
+
+        def refine_sites(prot, done=None):
+            # same as predictSites in findsites.R, without starting R
+            hitsfile = prot+"_grid.hits"
+            precision = self.precision
+            if not os.path.isfile(hitsfile):
+                set_statusline('Could not find %s in current directory' % hitsfile)
+            else:
+                stage = run_report(prot).stage('refinement', read=[hitsfile], written=[prot+".pred"])
+                workers = option('feature_workers', int) or runner.default_workers()
+                def refine_hits(report, cancel):
+                    # only the hits over the cutoff of the precision are parsed
+                    scores, xyz = hits.read_hits(hitsfile, refine.score_cutoff(precision), workers)
+                    sites = refine.predict_sites(scores, xyz, precision=precision, refine_radius=3.5)
+                    refine.write_pred(prot+".pred", prot, sites)
+                    stage.count(hits=len(scores), sites=len(sites))
+                    return len(sites)
+                def refined(nsites):
+                    set_statusline("Created %s.pred with %d sites" % (prot, nsites))
+                    if done is not None:
+                        done(nsites)
+                jobqueue.call("refinement", refine_hits, done=refined, stage=stage)
 
         def write_rscript(prot):
             if not os.path.isfile("findsites.R"):
@@ -437,9 +1072,11 @@ class Feature:
                 filename = (prot+".R")
                 precision = self.precision
                 Rscript_rel_path=os.path.relpath(self.Rscript_path)
+                # with a known cutoff, R only reads the hits over it (see run_rscript)
+                hitsfile = prot+"_cut.hits" if str(precision) in refine.SCORE_CUTOFFS else prot+"_grid.hits"
                 with open(filename, 'w') as outfile:
                     outfile.write('source("findsites.R")\n')
-                    outfile.write('dat <- read.table("%s_grid.hits", sep = "\t")\n' % prot)
+                    outfile.write('dat <- read.table("%s", sep = "\t")\n' % hitsfile)
                     outfile.write('dat <- dat[,2:5]\n')
                     outfile.write('names(dat) <- c("scores", "x", "y", "z")\n')
                     outfile.write('pred <- predictSites(dat, precision = "%s", refine.radius = 3.5)\n' % precision)
@@ -448,29 +1085,80 @@ class Feature:
                     outfile.write('write.matrix(pred, file = "%s.pred", sep = " ")\n' % prot)
                 set_statusline("Created %s" % filename)
 
-        def run_rscript(prot):       
+        def run_rscript(prot, done=None):
             rscript = (prot+".R")
             if not os.path.isfile(rscript):
                 set_statusline('Could not find %s in current directory' % rscript)
             else:
-                command = 'call "%s" --no-restore --no-save < %s' % (self.R_exe, rscript)
-                print(command)
-                os.system(command)
-            set_statusline("Created %s.pred" % prot)
+                stage = run_report(prot).stage('refinement', read=[prot+"_grid.hits"], written=[prot+".pred"])
+                def finished(exit_code):
+                    set_statusline("Created %s.pred" % prot)
+                    stage.count_lines(hits=prot+"_grid.hits", sites=prot+".pred")
+                    if done is not None:
+                        done(exit_code)
+                precision = self.precision
+                if str(precision) in refine.SCORE_CUTOFFS:
+                    def cut_hits(report, cancel):
+                        count = hits.write_hits_above(prot+"_grid.hits", refine.score_cutoff(precision),
+                                                      prot+"_cut.hits")
+                        if count == 0:
+                            # read.table fails on an empty file, predictSites drops all points
+                            shutil.copyfile(prot+"_grid.hits", prot+"_cut.hits")
+                        return count
+                    jobqueue.call("hits", cut_hits)
+                jobqueue.run("R", self.R_exe, ['--no-restore', '--no-save'], stdin=rscript, done=finished,
+                             stage=stage)
 
         def make_site_file():
             prot = self.form.comboBox.currentText()
             if prot == "":
                 set_statusline("No structure selected")
-            else:        
-                sites_file = write_site_file(prot)
-                cmd.load(sites_file)
-                sites = sites_file.split(".")[0]
-                cmd.label(sites, "b")
-                cmd.show(representation="spheres", selection=sites)
-                cmd.spectrum("b", selection=sites)
-                cmd.set("sphere_transparency", value=0.6, selection=sites)
-            
+            elif self.form.checkBox_2.isChecked():
+                show_ensemble_sites(prot)
+            else:
+                show_sites(prot)
+                if option('score_map', int):
+                    show_score_map(prot)
+
+        def show_sites(prot):
+            # the sites are loaded from the .pred file in memory, the pdb file is only written if asked for
+            predfile = prot+".pred"
+            if not os.path.isfile(predfile):
+                set_statusline('Could not find %s in current directory' % predfile)
+                return
+            with run_report(prot).stage('load_sites', read=[predfile]) as stage:
+                nsites = stage.call(display.load_sites, prot+"-sites", [refine.read_pred(predfile)])
+                stage.count(sites=nsites)
+            if option('save_site_files', int):
+                write_site_file(prot)
+            else:
+                # an older site file would not match the loaded sites
+                if os.path.isfile(prot+"-sites.pdb"):
+                    os.remove(prot+"-sites.pdb")
+                set_statusline("Loaded %d sites of %s" % (nsites, predfile))
+
+        def show_score_map(prot):
+            # all the gridpoint scores as one map, the hotspots as its isosurface at the hit cutoff
+            hitsfile = prot+"_grid.hits"
+            mapfile = prot+"-scores.ccp4"
+            if not os.path.isfile(hitsfile):
+                set_statusline('Could not find %s in current directory' % hitsfile)
+                return
+            workers = option('feature_workers', int) or runner.default_workers()
+            with run_report(prot).stage('score_map', read=[hitsfile], written=[mapfile]) as stage:
+                scores, xyz = hits.read_hits(hitsfile, workers=workers)
+                # the two levels of an adaptive grid go on the fine lattice, a PCA grid is resampled on it
+                spacing = None
+                if adaptive_key() is not None or option('grid_envelope', str) == 'pca':
+                    spacing = set_gridspacing.value()
+                data, origin, spacing = stage.call(scoremap.score_grid, scores, xyz, spacing)
+                written = display.load_map(prot+"-scores", data, origin, spacing,
+                                           refine.score_cutoff(self.precision), mapfile)
+                if option('save_site_files', int) and not written:
+                    scoremap.write_ccp4(mapfile, data, origin, spacing)
+                stage.count(gridpoints=len(scores))
+            set_statusline("Loaded the scores of %d gridpoints as %s-scores" % (len(scores), prot))
+
         def write_site_file(prot):
             predfile = prot+".pred"
             sitefile = prot+"-sites.pdb"
@@ -479,24 +1167,153 @@ class Feature:
             if not os.path.isfile(predfile):
                 set_statusline('Could not find %s in current directory' % predfile)
             else:
-                count = float(1)
-                with open(predfile, 'r') as infile:
-                    for line in infile:
-                        line = line.strip()
-                        pred_data = line.split()
-                        pdb_x = float(pred_data[1])
-                        pdb_y = float(pred_data[2])
-                        pdb_z = float(pred_data[3])
-                        pdb_score = float(pred_data[10])
-                        with open(sitefile, 'a') as outfile: 
-                            outline = "ATOM   "+'{:4.0f}'.format(count)+"  CA  CA  X"+'{:4.0f}'.format(count)\
-                                        +'{:12.3f}'.format(pdb_x)+'{:8.3f}'.format(pdb_y)+'{:8.3f}'.format(pdb_z)\
-                                        +"  1.00"+'{:6.2f}'.format(pdb_score)+"\n"
-                            outfile.write(outline)
-                        count = count+1
+                key = cache.digest('sites', recall(prot, 'pred', predfile))
+                if cached(prot, 'sites', key, {'sites.pdb': sitefile}):
+                    return sitefile
+                with run_report(prot).stage('write_site_file', read=[predfile], written=[sitefile]) as stage:
+                    sites = refine.read_pred(predfile)
+                    stage.call(refine.write_site_pdb, sitefile, sites)
+                    stage.count(sites=len(sites))
                 set_statusline("Created %s" % sitefile)
+                store(prot, 'sites', key, {'sites.pdb': sitefile})
             return sitefile
 
+        #------------------------------------------------------------------
+
+        # All states : every state of the object is scanned on the same grid
+
+        def ensemble_states(prot):
+            return [ensemble.state_name(prot, state) for state in range(1, cmd.count_states(prot)+1)]
+
+        def make_ensemble_grid(prot):
+            nstates = cmd.count_states(prot)
+            spacing = set_gridspacing.value()
+            states = [cmd.get_coords(prot, state) for state in range(1, nstates+1)]
+            borders = ensemble.ensemble_borders(states, margin=1)
+            print("borders (+/-x,+/-y,+/-z) of %d states :" % nstates, borders)
+            print("with spacing :", spacing)
+            axes = grid.grid_axes(borders, spacing)
+            atoms = None
+            if option('prune_grid', int):
+                atoms = [cmd.get_coords("(%s) and not hydro" % prot, state) for state in range(1, nstates+1)]
+            min_dist, max_dist = option('prune_min_dist'), option('prune_max_dist')
+            labels = grid_labels()
+            ligands = None
+            if prescreen.screen_key(labels, self.config_settings):
+                ligands = [ligand_atoms(prot, state) for state in range(1, nstates+1)]
+            def make_grids(report, cancel):
+                keep = None
+                if atoms is not None:
+                    keep = ensemble.ensemble_mask(axes, spacing, atoms, min_dist, max_dist)
+                if ligands is not None:
+                    screen = ensemble.ensemble_screen(axes, spacing, ligands, labels, self.config_settings)
+                    keep = screen if keep is None else keep & screen
+                return ensemble.write_state_ptfs(prot, nstates, axes, keep)
+            def created(npoints):
+                set_statusline("Created %d .ptf files with %d gridpoints" % (nstates, npoints))
+            jobqueue.call("grid", make_grids, done=created)
+
+        def run_ensemble_feature(prot):
+            # dssp, then featurize/scoreit of all states in parallel
+            names = ensemble_states(prot)
+            feature_model = self.form.comboBox_2.currentText()
+            model_path = self.models_dir_path
+            model = os.path.join(model_path, feature_model)
+            if not all(os.path.isfile(name+".ptf") for name in names):
+                set_statusline('Could not find the .ptf files of the %d states' % len(names))
+                return
+            if not os.path.isfile(model):
+                set_statusline('Could not find %s in current directory' % model)
+                return
+            for state, name in enumerate(names, 1):
+                cmd.save(name+".pdb", prot, state=state)
+            workers = option('feature_workers', int) or runner.default_workers()
+            dssp_exe = self.dssp_exe
+            def run_dssp(report, cancel):
+                codes = runner.run_programs([[dssp_exe, '-i', name+".pdb", '-o', name+".dssp"]
+                                             for name in names], workers, cancel)
+                failed = [name for name, code in zip(names, codes) if code != 0]
+                if failed:
+                    # stops the queue before featurize
+                    raise RuntimeError("dssp failed for %s" % ", ".join(failed))
+                return len(names)
+            jobqueue.call("dssp", run_dssp,
+                          done=lambda count: set_statusline("Created %d .dssp files" % count))
+            rel_model_posix = posixer(os.path.join(os.path.relpath(model_path), feature_model))
+            header = feature_header()
+            python_scoring = scoring.score_engine(self.config_settings) == 'python'
+            stream = option('stream_features', int) and not python_scoring
+            keep_ff = option('keep_ff', int) or not stream
+            def commands(name):
+                if python_scoring:
+                    return runner.featurize_commands(posixer(name))
+                return runner.feature_commands(posixer(name), rel_model_posix, stream, keep_ff)
+            outputs = ("_grid.ff",) if python_scoring else ("_grid.hits",)
+            launch = bash_launch(self.config_settings)
+            def run_states(report, cancel):
+                def progress(done, total, name, returncode):
+                    if returncode != 0:
+                        report("State %s failed with exit code %d" % (name, returncode))
+                    else:
+                        report("Featurized %d of %d states ..." % (done, total))
+                return runner.run_shards(names, header, commands, launch, workers, progress, cancel, outputs)
+            def featurized(failed):
+                if failed:
+                    raise jobs.JobFailed("featurize/scoreit failed for %s" % ", ".join(failed))
+                set_statusline("Featurized %d states" % len(names))
+                if python_scoring:
+                    for name in names:
+                        score_features(name, [model], [name+"_grid.hits"])
+            jobqueue.call("featurize", run_states, done=featurized)
+
+        def refine_ensemble(prot):
+            # refine the states in parallel and match their sites
+            names = ensemble_states(prot)
+            missing = [name+"_grid.hits" for name in names if not os.path.isfile(name+"_grid.hits")]
+            if missing:
+                set_statusline('Could not find %s in current directory' % ", ".join(missing))
+                return
+            precision = self.precision
+            workers = option('feature_workers', int) or runner.default_workers()
+            save_pdb = option('save_site_files', int)
+            def refine_state(name):
+                scores, xyz = hits.read_hits(name+"_grid.hits", refine.score_cutoff(precision))
+                sites = refine.predict_sites(scores, xyz, precision=precision, refine_radius=3.5)
+                refine.write_pred(name+".pred", name, sites)
+                return sites
+            def refine_states(report, cancel):
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    state_sites = list(pool.map(refine_state, names))
+                consensus = ensemble.match_sites(state_sites)
+                ensemble.write_consensus(prot+"_ensemble.pred", prot, consensus)
+                if save_pdb:
+                    ensemble.write_states_pdb(prot+"-sites.pdb", state_sites)
+                    ensemble.write_consensus_pdb(prot+"-ensemble-sites.pdb", consensus)
+                return len(consensus)
+            def refined(nsites):
+                set_statusline("Created %d sites over %d states in %s_ensemble.pred"
+                               % (nsites, len(names), prot))
+            jobqueue.call("refinement", refine_states, done=refined)
+
+        def show_ensemble_sites(prot):
+            # the sites of every state follow the states of the object
+            names = ensemble_states(prot)
+            predfiles = [name+".pred" for name in names] + [prot+"_ensemble.pred"]
+            missing = [predfile for predfile in predfiles if not os.path.isfile(predfile)]
+            if missing:
+                set_statusline('Could not find %s in current directory' % ", ".join(missing))
+                return
+            with run_report(prot).stage('load_sites', read=predfiles) as stage:
+                state_sites = [refine.read_pred(name+".pred") for name in names]
+                # the empty sites of the R quirk are left out, as in the pdb files
+                state_sites = [sites[sites[:, 3] > 0] for sites in state_sites]
+                sites, occupancy = ensemble.consensus_sites(ensemble.read_consensus(prot+"_ensemble.pred"))
+                nsites = stage.call(display.load_sites, prot+"-sites", state_sites)
+                # consensus sites are labelled with their occupancy
+                nconsensus = stage.call(display.load_sites, prot+"-ensemble-sites", [sites], [occupancy], "q")
+                stage.count(sites=nsites+nconsensus)
+            set_statusline("Loaded %d sites over %d states and %d consensus sites" % (nsites, len(names), nconsensus))
+
         # launch on startup :
         import_objects()
         import_models()
@@ -519,11 +1336,12 @@ class Feature:
         self.form.pushButton_6.clicked.connect(get_Rscript_path)
         self.form.pushButton_7.clicked.connect(get_R_location)
         self.form.pushButton_11.clicked.connect(import_objects)
-        self.form.pushButton_10.clicked.connect(makegrid_object_selected)
-        self.form.pushButton_9.clicked.connect(run_feature)
-        self.form.pushButton_8.clicked.connect(refine_results)
+        self.form.pushButton_10.clicked.connect(lambda: jobqueue.step("grid", makegrid_object_selected))
+        self.form.pushButton_9.clicked.connect(lambda: jobqueue.step("featurize", run_feature))
+        self.form.pushButton_8.clicked.connect(lambda: jobqueue.step("refinement", refine_results))
+        self.form.pushButton_14.clicked.connect(cancel_jobs)
         self.form.pushButton_12.clicked.connect(save_plugin_config_file)
-        self.form.pushButton_13.clicked.connect(make_site_file)
+        self.form.pushButton_13.clicked.connect(lambda: jobqueue.step("site file", make_site_file))
 
         # ----------------------------------------------
 
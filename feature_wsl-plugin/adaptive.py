@@ -0,0 +1,104 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Coarse-to-fine grids for the Feature-plugin.
+#
+# Sites only show where a few gridpoints score high, while a uniform grid
+# at 0.48 A spends most of the featurize time far from any of them. With
+# adaptive_grid = 1, the grid is made with the coarse adaptive_spacing
+# (2 A : about 70 times fewer gridpoints), featurized and scored. The
+# coarse gridpoints scoring at least the provisional adaptive_cutoff, far
+# below the cutoffs of the refinement, are then surrounded by the
+# gridpoints of the fine spacing lying within adaptive_radius of them
+# (prot_fine.ptf, pruned and pre-screened as the grid). These are
+# featurized and scored in turn and their lines are appended to the hits
+# of the coarse grid, so the refinement sees both levels : the fine
+# gridpoints around every hotspot and the coarse ones elsewhere.
+#
+# The fine lattice goes through the coarse gridpoints, which are left out
+# of it as they have their line already. A site can be missed if none of
+# the coarse gridpoints around it reaches adaptive_cutoff : lower it (or
+# the coarse spacing) if sites of a uniform grid are lost.
+
+import os
+
+import numpy as np
+
+from . import grid
+from . import hits
+from . import incremental
+
+
+def grid_spacing(settings, spacing):
+    '''Returns the spacing of the grid made first, the coarse one with adaptive_grid = 1.'''
+    if int(settings['adaptive_grid']):
+        return float(settings['adaptive_spacing'])
+    return spacing
+
+
+def adaptive_key(settings):
+    '''Returns what the fine gridpoints depend on besides the fine spacing, None without adaptive grid.'''
+    if not int(settings['adaptive_grid']):
+        return None
+    return [float(settings[key]) for key in ('adaptive_spacing', 'adaptive_cutoff', 'adaptive_radius')]
+
+
+def coarse_centers(hitsfiles, cutoff):
+    '''Returns the coordinates of the gridpoints scoring at least cutoff in any of hitsfiles.'''
+    centers = [hits.read_hits(hitsfile, cutoff)[1] for hitsfile in hitsfiles]
+    return np.vstack(centers + [np.zeros((0, 3))])
+
+
+def fine_axes(centers, origin, spacing, radius):
+    '''Returns the axes of the fine lattice through origin around centers ((n, 3) array).'''
+    borders = grid.find_borders(centers, margin=radius)
+    return grid.grid_axes(grid.align_borders(borders, origin, spacing), spacing)
+
+
+def on_lattice(axes, origin, spacing):
+    '''Returns the mask of the gridpoints of axes lying on the lattice of spacing through origin.'''
+    on_axis = []
+    for axis, start in zip(axes, origin):
+        steps = (axis - start) / spacing
+        on_axis.append(np.abs(steps - np.rint(steps)) * spacing < 0.001)
+    return on_axis[0][:, None, None] & on_axis[1][None, :, None] & on_axis[2][None, None, :]
+
+
+def write_fine_ptf(filename, prot, coarse_ptf, hitsfiles, spacing, coarse_spacing, cutoff, radius, mask=None):
+    '''
+    Writes to filename the gridpoints of spacing within radius of the
+    gridpoints of coarse_ptf scoring at least cutoff in any of hitsfiles,
+    without the coarse gridpoints, and returns their number. mask(axes,
+    spacing) returns the lattice mask of the gridpoints kept by the pruning
+    and the pre-screen, None for all.
+    '''
+    origin = incremental.ptf_origin(coarse_ptf)
+    centers = coarse_centers(hitsfiles, cutoff)
+    if origin is None or len(centers) == 0:
+        open(filename, 'w').close()
+        return 0
+    axes = fine_axes(centers, origin, spacing, radius)
+    keep = grid.atom_mask(axes, spacing, centers, radius) & ~on_lattice(axes, origin, coarse_spacing)
+    extra = mask(axes, spacing) if mask is not None else None
+    if extra is not None:
+        keep &= extra
+    return grid.write_ptf(filename, prot, axes, keep)
+
+
+def merge_levels(coarse_file, fine_file):
+    '''
+    Appends the gridpoint lines of fine_file (hits or feature vectors of
+    the fine gridpoints) to coarse_file, returns the number of lines added.
+    '''
+    count = 0
+    with open(coarse_file, 'a') as outfile, open(fine_file, 'r') as infile:
+        for line in infile:
+            if line.strip() and not line.startswith('#'):
+                outfile.write(line)
+                count += 1
+    return count
+
+
+def remove_fine(fine, suffixes):
+    '''Removes the files fine+suffix of the fine gridpoints once merged.'''
+    for suffix in ('.ptf',) + tuple(suffixes):
+        if os.path.isfile(fine+suffix):
+            os.remove(fine+suffix)
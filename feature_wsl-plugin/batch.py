@@ -0,0 +1,532 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Headless batch runs of the Feature-plugin.
+#
+# Runs the same stages as the plugin (grid, dssp, featurize/scoreit,
+# refinement and site file) on whole directories of pdb files without
+# PyMol, one structure per worker process :
+#
+#   python -m feature_wsl-plugin.batch -m Ca.model -o results pdb_dir/
+#
+# Program locations and options are read from the plugin configuration
+# file, so a batch run finds the same sites as the plugin. With several
+# models, every structure is featurized once and scored with all of them.
+# With -b, the structures are featurized in batches : one bash and one
+# featurize run (loading the FEATURE data once) for many small structures.
+
+import os
+import sys
+import argparse
+import subprocess
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from . import CONFIG_FILE, bash_launch, bash_path, plugin_directory, read_config
+from . import adaptive
+from . import envelope
+from . import ffstore
+from . import grid
+from . import hits
+from . import instrument
+from . import prescreen
+from . import refine
+from . import runner
+from . import scoremap
+from . import scoring
+
+
+def read_pdb(filename):
+    '''
+    Returns the coordinates ((n, 3) array) and elements of the ATOM and
+    HETATM records of the first model in filename.
+    '''
+    coords, elements = [], []
+    with open(filename, 'r') as infile:
+        for line in infile:
+            if line.startswith('ENDMDL'):
+                break
+            if line.startswith(('ATOM  ', 'HETATM')):
+                coords.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+                element = line[76:78].strip()
+                if not element:
+                    # old files : the element starts the atom name
+                    element = line[12:16].strip().lstrip('0123456789')[:1]
+                elements.append(element.upper())
+    return np.array(coords, dtype=float).reshape(-1, 3), np.array(elements, dtype=str)
+
+
+def pdb_files(paths):
+    '''Returns the pdb files given as file names or directories, sorted.'''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if name.lower().endswith('.pdb')))
+        else:
+            files.append(path)
+    return files
+
+
+def grid_mask(coords, elements, settings, labels=(), stage=None):
+    '''
+    Returns mask(axes, spacing, frame=None, keep=None), the lattice mask of
+    the gridpoints of keep (all if None) kept by the pruning around the
+    atoms and the pre-screen for the models labels (see prescreen.py), None
+    if all of them are kept. The lattice is in frame if given (see
+    envelope.py). The gridpoints dropped by the pre-screen are counted in
+    stage if given.
+    '''
+    prescreened = 0
+    def mask(axes, spacing, frame=None, keep=None):
+        nonlocal prescreened
+        atoms = coords if frame is None else envelope.to_frame(coords, frame)
+        if int(settings['prune_grid']):
+            heavy = atoms[~np.isin(elements, ('H', 'D'))]
+            shell = grid.shell_mask(axes, spacing, heavy, float(settings['prune_min_dist']),
+                                    float(settings['prune_max_dist']))
+            keep = shell if keep is None else keep & shell
+        if prescreen.screen_key(labels, settings):
+            screen = prescreen.screen_mask(axes, spacing, atoms[elements == 'O'], atoms[elements == 'N'],
+                                           labels, settings)
+            before = screen.size if keep is None else int(keep.sum())
+            keep = screen if keep is None else keep & screen
+            prescreened += before - int(keep.sum())
+            if stage is not None:
+                stage.count(prescreened=prescreened)
+        return keep
+    return mask
+
+
+def make_grid(prot, coords, elements, spacing, settings, report=None, labels=()):
+    '''
+    Writes prot.ptf around the atoms and returns its number of gridpoints,
+    pre-screened for the models labels (see prescreen.py), in the envelope
+    of grid_envelope (see envelope.py). The findborders and write_ptf
+    stages are recorded in report.
+    '''
+    report = report or instrument.RunReport()
+    with report.stage('findborders') as stage:
+        frame, boxes = envelope.envelope_boxes(coords, grid.find_borders(coords, margin=1), spacing, settings)
+        stage.count(boxes=len(boxes))
+    def write_grid(stage):
+        mask = grid_mask(coords, elements, settings, labels, stage)
+        return envelope.write_envelope(prot+".ptf", os.path.basename(prot), frame, boxes, spacing, mask)
+    with report.stage('write_ptf', written=[prot+".ptf"]) as stage:
+        npoints = stage.call(write_grid, stage)
+        stage.count(gridpoints=npoints)
+    return npoints
+
+
+def run_dssp(pdbfile, prot, settings):
+    '''Writes prot.dssp, returns the exit code of dssp.'''
+    return subprocess.call([settings['dssp_exe'], '-i', pdbfile, '-o', prot+".dssp"],
+                           stdout=subprocess.DEVNULL)
+
+
+def model_label(model):
+    '''Returns the name of model used in the file names, "Ca" for Ca.model.'''
+    return os.path.splitext(os.path.basename(model))[0]
+
+
+def hits_names(prot, models):
+    '''
+    Returns the names (without suffix) of the hits, pred and site files of
+    every model : prot for a single model, prot_label for several ones.
+    '''
+    if len(models) == 1:
+        return [prot]
+    return ["%s_%s" % (prot, model_label(model)) for model in models]
+
+
+def run_featurize(pdbfile, prot, models, settings, times_file=None):
+    '''
+    Writes the hits files of the models with featurize/scoreit (see
+    hits_names), returns the exit code. Several models are scored with the
+    feature vectors of a single featurize run. With score_engine = python,
+    only prot_grid.ff is written here (see score_features). Every program
+    run is timed in times_file (in the directory of prot) if given.
+    '''
+    work_dir = os.path.dirname(os.path.abspath(prot))
+    name = os.path.basename(prot)
+    header = ['pushd %s > /dev/null' % bash_path(work_dir),
+              'export FEATURE_DIR=%s' % settings['feature_data_path'].replace("\\", "/"),
+              'export DSSP_DIR=%s' % bash_path(work_dir),
+              'export PDB_DIR=%s' % bash_path(os.path.dirname(os.path.abspath(pdbfile)))]
+    if times_file is not None:
+        header += runner.timing_header(os.path.basename(times_file))
+    if scoring.score_engine(settings) == 'python':
+        commands = runner.featurize_commands(name)
+    elif len(models) == 1:
+        stream = int(settings['stream_features'])
+        keep_ff = int(settings['keep_ff']) or not stream
+        commands = runner.feature_commands(name, bash_path(models[0]), stream, keep_ff)
+    else:
+        commands = runner.models_commands(name, [bash_path(model) for model in models],
+                                          [model_label(model) for model in models])
+    script = runner.write_script(prot+"_featurize.sh", header, commands)
+    with open(script, 'r') as infile:
+        return subprocess.call(bash_launch(settings), stdin=infile, stdout=subprocess.DEVNULL)
+
+
+def score_features(prot, models):
+    '''
+    Scores prot_grid.ff with the models in python, writing their hits
+    files. Returns the number of gridpoints.
+    '''
+    store = ffstore.open_store(prot+"_grid.ffs", prot+"_grid.ff")
+    for model, hitsname in zip(models, hits_names(prot, models)):
+        scores = scoring.score_store(scoring.read_model(model), store)
+        scoring.write_hits(hitsname+"_grid.hits", store, scores)
+    return len(store)
+
+
+def refine_hits(hitsname, name, precision):
+    '''
+    Refines hitsname_grid.hits into hitsname.pred, returns the number of
+    hits over the cutoff of precision and the sites.
+    '''
+    scores, xyz = hits.read_hits(hitsname+"_grid.hits", refine.score_cutoff(precision))
+    sites = refine.predict_sites(scores, xyz, precision=precision, refine_radius=3.5)
+    refine.write_pred(hitsname+".pred", name, sites)
+    return len(scores), sites
+
+
+def prepare_structure(pdbfile, prot, models, settings, report):
+    '''
+    Writes the grid and dssp files of pdbfile (prot.ptf and prot.dssp) for
+    the models, returns (number of gridpoints, error message or None).
+    '''
+    coords, elements = read_pdb(pdbfile)
+    if len(coords) == 0:
+        return 0, "no atoms"
+    spacing = adaptive.grid_spacing(settings, float(settings['spacing']))
+    npoints = make_grid(prot, coords, elements, spacing, settings, report, [model_label(model) for model in models])
+    with report.stage('dssp', read=[pdbfile], written=[prot+".dssp"]):
+        exit_code = run_dssp(pdbfile, prot, settings)
+    if exit_code != 0 or not os.path.isfile(prot+".dssp"):
+        return npoints, "dssp failed"
+    return npoints, None
+
+
+def finish_structure(prot, models, settings, report):
+    '''
+    Runs the stages after featurize/scoreit for prot, returns (number of
+    sites of every model, error message or None).
+    '''
+    name = os.path.basename(prot)
+    names = hits_names(prot, models)
+    nsites = []
+    if scoring.score_engine(settings) == 'python' and os.path.isfile(prot+"_grid.ff"):
+        with report.stage('scoring', read=[prot+"_grid.ff"],
+                          written=[hitsname+"_grid.hits" for hitsname in names]) as stage:
+            stage.count(gridpoints=stage.call(score_features, prot, models), models=len(models))
+    if not all(os.path.isfile(hitsname+"_grid.hits") for hitsname in names):
+        return nsites, "featurize/scoreit failed"
+    if int(settings['feature_store']) and os.path.isfile(prot+"_grid.ff"):
+        ffstore.convert_ff(prot+"_grid.ff", prot+"_grid.ffs")
+    if len(models) > 1 and int(settings['merge_model_hits']):
+        hits.merge_hits([hitsname+"_grid.hits" for hitsname in names],
+                        [model_label(model) for model in models], prot+"_models_grid.hits")
+    for hitsname in names:
+        with report.stage('refinement', read=[hitsname+"_grid.hits"], written=[hitsname+".pred"]) as stage:
+            nhits, sites = stage.call(refine_hits, hitsname, name, settings['precision'])
+            stage.count(hits=nhits, sites=len(sites))
+        with report.stage('write_site_file', read=[hitsname+".pred"],
+                          written=[hitsname+"-sites.pdb"]) as stage:
+            stage.call(refine.write_site_pdb, hitsname+"-sites.pdb", sites)
+            stage.count(sites=len(sites))
+        if int(settings['score_map']):
+            with report.stage('score_map', read=[hitsname+"_grid.hits"],
+                              written=[hitsname+"-scores.ccp4"]) as stage:
+                stage.count(gridpoints=stage.call(scoremap.write_score_map, hitsname+"_grid.hits",
+                                                  hitsname+"-scores.ccp4", float(settings['spacing'])))
+        nsites.append(len(sites))
+    return nsites, None
+
+
+def featurize_structure(pdbfile, name, npoints, models, settings, report):
+    '''Runs featurize/scoreit for the npoints gridpoints of name.ptf, returns the exit code.'''
+    with report.stage('featurize', read=[name+".ptf", pdbfile], written=batch_outputs(name, models, settings)) as stage:
+        if report.enabled:
+            stage.times_file = name+"_times.txt"
+        exit_code = run_featurize(pdbfile, name, models, settings, stage.times_file)
+        stage.count(gridpoints=npoints)
+    return exit_code
+
+
+def fine_grid(pdbfile, prot, models, settings, report):
+    '''
+    Writes prot_fine.ptf, the fine gridpoints around the best gridpoints of
+    the coarse grid prot.ptf (see adaptive.py), returns their number.
+    '''
+    names = hits_names(prot, models)
+    if scoring.score_engine(settings) == 'python':
+        # the coarse hits are scored here, all hits again once merged
+        with report.stage('scoring', read=[prot+"_grid.ff"],
+                          written=[hitsname+"_grid.hits" for hitsname in names]) as stage:
+            stage.count(gridpoints=stage.call(score_features, prot, models), models=len(models))
+    coords, elements = read_pdb(pdbfile)
+    mask = grid_mask(coords, elements, settings, [model_label(model) for model in models])
+    with report.stage('adaptive', read=[prot+".ptf"] + [hitsname+"_grid.hits" for hitsname in names],
+                      written=[prot+"_fine.ptf"]) as stage:
+        npoints = stage.call(adaptive.write_fine_ptf, prot+"_fine.ptf", os.path.basename(prot), prot+".ptf",
+                             [hitsname+"_grid.hits" for hitsname in names], float(settings['spacing']),
+                             float(settings['adaptive_spacing']), float(settings['adaptive_cutoff']),
+                             float(settings['adaptive_radius']), mask)
+        stage.count(gridpoints=npoints)
+    return npoints
+
+
+def merge_fine(prot, models, settings):
+    '''Appends the hits and feature vectors of prot_fine to the ones of prot, then removes its files.'''
+    fine = prot+"_fine"
+    outputs = batch_outputs(fine, models, settings)
+    for output in outputs:
+        if os.path.isfile(output) and os.path.isfile(prot+output[len(fine):]):
+            adaptive.merge_levels(prot+output[len(fine):], output)
+    adaptive.remove_fine(fine, [output[len(fine):] for output in outputs])
+
+
+def structure_report(prot, settings):
+    '''Returns the report of prot, written to prot_report.json with run_report = 1.'''
+    return instrument.RunReport(prot+"_report.json" if int(settings['run_report']) else None,
+                                os.path.basename(prot), settings, int(settings['profile_stages']))
+
+
+def structure_name(pdbfile, out_dir):
+    '''Returns the name (without suffix) of the files of pdbfile in out_dir.'''
+    return os.path.join(out_dir, os.path.splitext(os.path.basename(pdbfile))[0])
+
+
+def process_structure(pdbfile, models, out_dir, settings):
+    '''
+    Runs all stages for pdbfile in out_dir and returns (pdbfile, number of
+    gridpoints, number of sites of every model, error message or None).
+    With run_report = 1, the stages are recorded in prot_report.json.
+    '''
+    prot = structure_name(pdbfile, out_dir)
+    npoints = 0
+    nsites = []
+    report = structure_report(prot, settings)
+    try:
+        npoints, error = prepare_structure(pdbfile, prot, models, settings, report)
+        if error:
+            return pdbfile, npoints, nsites, error
+        exit_code = featurize_structure(pdbfile, prot, npoints, models, settings, report)
+        if exit_code == 0 and adaptive.adaptive_key(settings):
+            nfine = fine_grid(pdbfile, prot, models, settings, report)
+            if nfine:
+                exit_code = featurize_structure(pdbfile, prot+"_fine", nfine, models, settings, report)
+            npoints += nfine
+            merge_fine(prot, models, settings)
+        if exit_code != 0:
+            return pdbfile, npoints, nsites, "featurize/scoreit failed"
+        nsites, error = finish_structure(prot, models, settings, report)
+    except Exception as error:
+        return pdbfile, npoints, nsites, "%s: %s" % (type(error).__name__, error)
+    return pdbfile, npoints, nsites, error
+
+
+def batch_outputs(prot, models, settings):
+    '''Returns the suffixed names of the files written by run_featurize for prot.'''
+    if scoring.score_engine(settings) == 'python':
+        return [prot+"_grid.ff"]
+    return [prot+"_grid.ff"] + [hitsname+"_grid.hits" for hitsname in hits_names(prot, models)]
+
+
+def process_batch(pdbfiles, models, out_dir, settings):
+    '''
+    Runs all stages for the pdbfiles (all in the same directory) in
+    out_dir, with a single featurize/scoreit run for all of them, and
+    returns the results of process_structure in file order.
+
+    The grids of the structures are concatenated into one .ptf file named
+    after the first structure (prot_batch.ptf) : featurize finds the pdb
+    and dssp files of every gridpoint by the structure name starting its
+    line, so bash, featurize and the FEATURE data are only started once for
+    the whole batch. Its output files are then split back into the files
+    of every structure, by their numbers of gridpoints, and removed. With
+    adaptive_grid = 1, the fine gridpoints of all the structures go through
+    a second run. The batch runs are recorded in prot_batch_report.json
+    with run_report = 1.
+    '''
+    results = {}
+    prepared = []
+    for pdbfile in pdbfiles:
+        prot = structure_name(pdbfile, out_dir)
+        report = structure_report(prot, settings)
+        try:
+            npoints, error = prepare_structure(pdbfile, prot, models, settings, report)
+        except Exception as exception:
+            npoints, error = 0, "%s: %s" % (type(exception).__name__, exception)
+        if error:
+            results[pdbfile] = (pdbfile, npoints, [], error)
+        else:
+            prepared.append((pdbfile, prot, npoints, report))
+    if not prepared:
+        return [results[pdbfile] for pdbfile in pdbfiles]
+    prots = [prot for pdbfile, prot, npoints, report in prepared]
+    counts = [npoints for pdbfile, prot, npoints, report in prepared]
+    batch_report = structure_report(prots[0]+"_batch", settings)
+    try:
+        error = featurize_batch(prepared[0][0], prots, counts, models, settings, batch_report)
+        if not error and adaptive.adaptive_key(settings):
+            # the fine gridpoints of all structures in a second run
+            fine_counts = [fine_grid(pdbfile, prot, models, settings, report)
+                           for pdbfile, prot, npoints, report in prepared]
+            if sum(fine_counts):
+                error = featurize_batch(prepared[0][0], [prot+"_fine" for prot in prots], fine_counts, models,
+                                        settings, batch_report)
+            for prot in prots:
+                merge_fine(prot, models, settings)
+            counts = [count + fine_count for count, fine_count in zip(counts, fine_counts)]
+    except Exception as exception:
+        error = "%s: %s" % (type(exception).__name__, exception)
+    for (pdbfile, prot, coarse_points, report), npoints in zip(prepared, counts):
+        nsites = []
+        if error:
+            results[pdbfile] = (pdbfile, npoints, nsites, error)
+            continue
+        try:
+            nsites, structure_error = finish_structure(prot, models, settings, report)
+        except Exception as exception:
+            structure_error = "%s: %s" % (type(exception).__name__, exception)
+        results[pdbfile] = (pdbfile, npoints, nsites, structure_error)
+    return [results[pdbfile] for pdbfile in pdbfiles]
+
+
+def featurize_batch(pdbfile, names, counts, models, settings, report):
+    '''
+    Runs featurize/scoreit once for the gridpoints of all the name.ptf
+    files (counts of them), concatenated into names[0]_batch.ptf, and
+    splits the output files back into the files of every name. pdbfile is
+    one of the pdb files, all in the same directory. Returns an error
+    message or None.
+    '''
+    batch = names[0]+"_batch"
+    outputs = batch_outputs(batch, models, settings)
+    error = None
+    try:
+        with report.stage('featurize', read=[name+".ptf" for name in names], written=outputs) as stage:
+            if report.enabled:
+                stage.times_file = batch+"_times.txt"
+            runner.concat_files([name+".ptf" for name in names], batch+".ptf")
+            exit_code = run_featurize(pdbfile, batch, models, settings, stage.times_file)
+            stage.count(gridpoints=sum(counts), structures=len(names))
+        if exit_code != 0:
+            error = "featurize/scoreit failed"
+        for output in outputs:
+            if not error and os.path.isfile(output):
+                suffix = output[len(batch):]
+                runner.split_lines(output, counts, [name+suffix for name in names])
+    finally:
+        for filename in [batch+".ptf"] + outputs:
+            if os.path.isfile(filename):
+                os.remove(filename)
+    return error
+
+
+def make_batches(files, size):
+    '''
+    Returns the files in lists of at most size consecutive files of the
+    same directory, as featurize reads all the pdb files of a run from one
+    directory.
+    '''
+    batches = []
+    for pdbfile in files:
+        if (batches and len(batches[-1]) < size
+                and os.path.dirname(os.path.abspath(batches[-1][0])) == os.path.dirname(os.path.abspath(pdbfile))):
+            batches[-1].append(pdbfile)
+        else:
+            batches.append([pdbfile])
+    return batches
+
+
+def run_batch(files, models, out_dir, settings, workers=None, progress=None, batch_size=1):
+    '''
+    Processes the pdb files with a pool of worker processes (all cores by
+    default). With batch_size > 1, every worker processes batches of up to
+    batch_size structures with a single featurize run (see process_batch).
+    progress(done, total, result) is called for every finished structure.
+    Returns the results of process_structure in file order.
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    workers = workers or runner.default_workers()
+    results = {}
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        if batch_size > 1:
+            jobs = [pool.submit(process_batch, batch, models, out_dir, settings)
+                    for batch in make_batches(files, batch_size)]
+        else:
+            jobs = [pool.submit(process_structure, pdbfile, models, out_dir, settings) for pdbfile in files]
+        for job in as_completed(jobs):
+            job_results = job.result() if batch_size > 1 else [job.result()]
+            for result in job_results:
+                results[result[0]] = result
+                done += 1
+                if progress is not None:
+                    progress(done, len(files), result)
+    return [results[pdbfile] for pdbfile in files]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m %s" % __spec__.name if __spec__ else None,
+        description="Predicts sites with FEATURE for a batch of pdb files.")
+    parser.add_argument('pdb', nargs='+', help="pdb files or directories of pdb files")
+    parser.add_argument('-m', '--model', action='append', default=[],
+                        help="FEATURE model, a file or a name in models_dir_path "
+                             "(several models are scored with the same feature vectors)")
+    parser.add_argument('-a', '--all-models', action='store_true',
+                        help="scores with all models in models_dir_path")
+    parser.add_argument('-o', '--out', default=os.curdir, help="output directory")
+    parser.add_argument('-j', '--workers', type=int, default=0,
+                        help="structures processed in parallel (default: all cores)")
+    parser.add_argument('-b', '--batch', type=int, default=1,
+                        help="structures of the same directory featurized by a single featurize run")
+    parser.add_argument('-s', '--spacing', type=float, default=0.48, help="grid spacing")
+    parser.add_argument('-p', '--precision', default="99", help="precision of the sites (95 or 99)")
+    parser.add_argument('-c', '--config', default=os.path.join(plugin_directory(), CONFIG_FILE),
+                        help="plugin configuration file")
+    parser.add_argument('--set', action='append', default=[], metavar="KEY=VALUE",
+                        help="overrides a setting of the configuration file")
+    args = parser.parse_args(argv)
+
+    settings = read_config(args.config)
+    for item in args.set:
+        key, value = item.split('=', 1)
+        settings[key.strip()] = value.strip()
+    settings['spacing'] = str(args.spacing)
+    settings['precision'] = args.precision
+    models = []
+    for model in args.model:
+        if not os.path.isfile(model):
+            model = os.path.join(settings['models_dir_path'], model)
+        if not os.path.isfile(model):
+            parser.error("could not find model %s" % model)
+        models.append(os.path.abspath(model))
+    if args.all_models:
+        models += sorted(glob(os.path.join(os.path.abspath(settings['models_dir_path']), "*.model")))
+    models = list(dict.fromkeys(models))
+    if not models:
+        parser.error("no model given")
+    files = pdb_files(args.pdb)
+    if not files:
+        parser.error("no pdb files found")
+
+    def progress(done, total, result):
+        pdbfile, npoints, nsites, error = result
+        status = error if error else "%d gridpoints, %s" % (npoints, ", ".join(
+            "%d %s sites" % (count, model_label(model)) for count, model in zip(nsites, models)))
+        print("[%d/%d] %s : %s" % (done, total, pdbfile, status), flush=True)
+
+    results = run_batch(files, models, args.out, settings, args.workers, progress, args.batch)
+    failed = [result for result in results if result[3]]
+    print("Processed %d structures, %d failed" % (len(results), len(failed)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
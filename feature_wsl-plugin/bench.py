@@ -0,0 +1,588 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Benchmarks of the Feature-plugin pipeline.
+#
+# Times the stages of a batch run (see batch.py) on synthetic structures of
+# 1k to 500k atoms at several grid spacings, on any Linux or macOS box :
+# dssp, featurize and scoreit are replaced by deterministic stand-ins
+# written next to the results, so neither DSSP nor FEATURE are needed.
+#
+#   python -m feature_wsl-plugin.bench -o bench_results -n 1000 10000 100000 -s 2.0 1.0 0.48
+#
+# Every run is made in a fresh process with run_report = 1 (see
+# instrument.py). The results give for every size and spacing the wall
+# time and the throughput (gridpoints per second) of every stage, the peak
+# memory of the python process and of the programs, and the scaling of
+# every stage (the exponent b of time ~ gridpoints^b). They are written to
+# bench.json and bench.csv, and --compare prints the speedups over the
+# bench.json of an earlier run.
+#
+# The synthetic structures are spheres of about 4000 atoms on a jittered
+# lattice (2.4 A, so no gridpoint is left inside them), stacked on a cubic
+# lattice. Every sphere holds a calcium-like site : a pocket lined by the
+# six carboxylate oxygens of three ASP residues. The stand-in featurize
+# counts the C, N, O and S atoms in 6 cubic shells of 1.25 A around every
+# gridpoint and the stand-in model scores 4.5 for every oxygen of shells 1
+# and 2 : six of them are needed to reach the 99 % cutoff, so the sites
+# found lie in the pockets, almost none elsewhere.
+
+import os
+import sys
+import csv
+import json
+import stat
+import platform
+import argparse
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from . import CONFIG_DEFAULTS
+from . import batch
+from . import ffstore
+from . import grid
+from . import instrument
+from . import scoring
+
+# stand-in FEATURE properties and shells
+PROPERTIES = ('C', 'N', 'O', 'S')
+SHELLS = 6
+SHELL_WIDTH = 1.25
+
+# atoms per sphere of a synthetic structure and their lattice spacing
+DOMAIN_ATOMS = 4000
+LATTICE = 2.4
+
+# residues of the synthetic structures : name, atom names, elements and weight
+RESIDUES = [('ALA', ('N', 'CA', 'C', 'O', 'CB'), 'NCCOC', 30),
+            ('LEU', ('N', 'CA', 'C', 'O', 'CB', 'CG', 'CD1', 'CD2'), 'NCCOCCCC', 30),
+            ('LYS', ('N', 'CA', 'C', 'O', 'CB', 'CG', 'CD', 'CE', 'NZ'), 'NCCOCCCCN', 15),
+            ('SER', ('N', 'CA', 'C', 'O', 'CB', 'OG'), 'NCCOCO', 10),
+            ('VAL', ('N', 'CA', 'C', 'O', 'CB', 'CG1', 'CG2'), 'NCCOCCC', 10),
+            ('CYS', ('N', 'CA', 'C', 'O', 'CB', 'SG'), 'NCCOCS', 5)]
+ASP = ('ASP', ('N', 'CA', 'C', 'O', 'CB', 'CG', 'OD1', 'OD2'), 'NCCOCCOO')
+
+# pairs of the 6 octahedral directions holding the oxygens of each site ASP
+SITE_PAIRS = [((1, 0, 0), (0, 1, 0)), ((-1, 0, 0), (0, 0, 1)), ((0, -1, 0), (0, 0, -1))]
+SITE_DISTANCE = 2.4
+
+# stand-in model rows : property, shell, bin boundaries and bin scores
+MODEL_ROWS = [('O', 0, [1], [0, -4]),
+              ('O', 1, [1, 2, 3, 4], [0, 4.5, 9, 13.5, 18]),
+              ('O', 2, [1, 2, 3, 4, 5, 6, 7, 8], [0, 4.5, 9, 13.5, 18, 22.5, 27, 31.5, 36]),
+              ('O', 3, [3, 6], [0, 1, 2]),
+              ('C', 0, [1], [0, -6]),
+              ('S', 1, [1], [0, 1])]
+
+# stages of a batch run, in order
+STAGES = ('findborders', 'write_ptf', 'dssp', 'featurize', 'scoring', 'refinement', 'write_site_file')
+
+
+def synthetic_atoms(natoms, seed=0):
+    '''
+    Returns the residues (name, atom names, elements) and the coordinates
+    ((natoms, 3) array) of a synthetic structure of natoms atoms, the same
+    for the same natoms and seed. Each residue is a (name, chain, number,
+    atom names, elements, first atom) tuple.
+    '''
+    rng = np.random.RandomState(seed + natoms)
+    ndomains = max(1, -(-natoms // DOMAIN_ATOMS))
+    sizes = [natoms // ndomains + (1 if number < natoms % ndomains else 0) for number in range(ndomains)]
+    radius = LATTICE * (3 * max(sizes) / (4 * np.pi))**(1/3.)
+    side = int(np.ceil(ndomains**(1/3.) - 1e-9))
+    # lattice points of a sphere, nearest to the center first
+    reach = int(np.ceil(radius / LATTICE)) + 3
+    steps = np.arange(-reach, reach+1)
+    sphere = LATTICE * np.array(np.meshgrid(steps, steps, steps, indexing='ij')).reshape(3, -1).T
+    sphere = sphere[np.argsort(np.sum(sphere**2, axis=1), kind='stable')]
+    weights = np.array([residue[3] for residue in RESIDUES], dtype=float)
+    chains = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
+    numbers = {}
+    residues, coords = [], []
+    natoms_done = 0
+
+    def add_residue(template, chain, xyz):
+        name, atom_names, elements = template[:3]
+        count = min(len(xyz), natoms - natoms_done)
+        number = numbers[chain] = numbers.get(chain, 0) + 1
+        residues.append((name, chain, number, atom_names[:count], elements[:count], natoms_done))
+        coords.append(xyz[:count])
+        return count
+
+    for domain, size in enumerate(sizes):
+        center = (2 * radius + 6.0) * np.array(np.unravel_index(domain, (side, side, side)), dtype=float)
+        chain = chains[domain % len(chains)]
+        # the site lies in a pocket below the surface of the sphere
+        direction = rng.normal(size=3)
+        site = center + 0.75 * radius * direction / np.linalg.norm(direction)
+        site_atoms = []
+        for first, second in SITE_PAIRS:
+            first, second = np.array(first, dtype=float), np.array(second, dtype=float)
+            out = (first + second) / np.linalg.norm(first + second)
+            backbone = [site + (6.0 + 1.3*step) * out + rng.normal(scale=0.3, size=3) for step in range(4)]
+            site_atoms.append(np.array(backbone + [site + 4.7 * out, site + 3.3 * out,
+                                                   site + SITE_DISTANCE * first, site + SITE_DISTANCE * second]))
+        points = center + sphere + rng.uniform(-0.2, 0.2, size=sphere.shape)
+        points = points[np.sum((points - site)**2, axis=1) > 4.0**2][:max(size - 24, 0)]
+        # residues are runs of consecutive lattice points, sorted along the axes
+        points = points[np.lexsort(np.rint((points - center) / LATTICE).T[::-1])]
+        start = 0
+        while start < len(points) and natoms_done < natoms:
+            template = RESIDUES[rng.choice(len(RESIDUES), p=weights / weights.sum())]
+            count = add_residue(template, chain, points[start:start+len(template[1])])
+            start += count
+            natoms_done += count
+        for xyz in site_atoms:
+            if natoms_done < natoms:
+                natoms_done += add_residue(ASP, chain, xyz)
+    return residues, np.vstack(coords)
+
+
+def write_synthetic_pdb(filename, natoms, seed=0):
+    '''Writes a synthetic structure of natoms atoms (see synthetic_atoms) as a pdb file.'''
+    residues, coords = synthetic_atoms(natoms, seed)
+    lines = ["HEADER    SYNTHETIC STRUCTURE OF %d ATOMS\n" % natoms]
+    for name, chain, number, atom_names, elements, first in residues:
+        for offset, (atom, element) in enumerate(zip(atom_names, elements)):
+            x, y, z = coords[first + offset]
+            serial = (first + offset + 1) % 100000
+            lines.append("ATOM  %5d  %-3s %3s %1s%4d    %8.3f%8.3f%8.3f  1.00 20.00          %2s\n"
+                         % (serial, atom, name, chain, number % 10000, x, y, z, element))
+    lines.append("END\n")
+    with open(filename, 'w') as outfile:
+        outfile.writelines(lines)
+    return filename
+
+
+def write_model(filename):
+    '''Writes the stand-in model (MODEL_ROWS) in the .model layout read by scoring.read_model.'''
+    with open(filename, 'w') as outfile:
+        outfile.write("# stand-in model of the Feature-plugin benchmarks\n")
+        for prop, shell, bounds, scores in MODEL_ROWS:
+            outfile.write("\t".join([prop, str(shell)] + ['%g' % value for value in bounds + scores])+"\n")
+    return filename
+
+
+def read_structure(filename):
+    '''Returns the coordinates, elements and (chain, number, name) residues of a pdb file.'''
+    coords, elements = batch.read_pdb(filename)
+    residues = []
+    with open(filename, 'r') as infile:
+        for line in infile:
+            if line.startswith('ENDMDL'):
+                break
+            if line.startswith(('ATOM  ', 'HETATM')):
+                residue = (line[21], line[22:27].strip(), line[17:20].strip())
+                if not residues or residues[-1] != residue:
+                    residues.append(residue)
+    return coords, elements, residues
+
+
+def shell_counts(atoms, elements, points, chunk_size=grid.CHUNK_SIZE):
+    '''
+    Returns the number of atoms of every element of PROPERTIES in each of
+    the SHELLS cubic shells of SHELL_WIDTH around the points, as an
+    (n, SHELLS * len(PROPERTIES)) array, shell 0 first. Atoms are binned on
+    a lattice and counted with summed-area tables, 8 lookups per box. The
+    lattice is fixed (cells of SHELL_WIDTH from 0), so the counts of a point
+    do not depend on the other points : shards, batches and incremental or
+    adaptive runs get the same feature vectors as a single run.
+    '''
+    features = np.zeros((len(points), SHELLS * len(PROPERTIES)), dtype=np.int32)
+    if len(points) == 0 or len(atoms) == 0:
+        return features
+    pad = SHELLS + 1
+    atom_cells = np.floor(np.asarray(atoms) / SHELL_WIDTH).astype(np.int64)
+    point_cells = np.floor(np.asarray(points) / SHELL_WIDTH).astype(np.int64)
+    # the table only spans the cells in use, shifted by whole cells
+    low = np.minimum(atom_cells.min(axis=0), point_cells.min(axis=0)) - pad
+    atom_cells -= low
+    point_cells -= low
+    shape = np.maximum(atom_cells.max(axis=0), point_cells.max(axis=0)) + pad + 1
+    corners = [np.array(corner) for corner in np.ndindex(2, 2, 2)]
+    for column, element in enumerate(PROPERTIES):
+        # table[i, j, k] : atoms in the cells below (i, j, k)
+        table = np.zeros(shape + 1, dtype=np.int32)
+        cells = atom_cells[elements == element] + 1
+        np.add.at(table, tuple(cells.T), 1)
+        for axis in range(3):
+            np.cumsum(table, axis=axis, out=table)
+        for start in range(0, len(points), chunk_size):
+            cells = point_cells[start:start+chunk_size]
+            inner = 0
+            for shell in range(SHELLS):
+                box = np.zeros(len(cells), dtype=np.int32)
+                low, high = cells - shell, cells + shell + 1
+                for corner in corners:
+                    index = np.where(corner, high, low)
+                    sign = -1 if (3 - corner.sum()) % 2 else 1
+                    box += sign * table[index[:, 0], index[:, 1], index[:, 2]]
+                features[start:start+chunk_size, shell * len(PROPERTIES) + column] = box - inner
+                inner = box
+    return features
+
+
+def stub_dssp(argv):
+    '''
+    Stand-in for dssp -i file.pdb -o file.dssp : writes a DSSP file with
+    one line per residue and a helix, strand or loop chosen from the
+    residue number.
+    '''
+    parser = argparse.ArgumentParser(prog="dssp")
+    parser.add_argument('-i', dest='input', required=True)
+    parser.add_argument('-o', dest='output', required=True)
+    args = parser.parse_args(argv)
+    coords, elements, residues = read_structure(args.input)
+    if not residues:
+        print("dssp: no residues in %s" % args.input, file=sys.stderr)
+        return 1
+    codes = {'ALA': 'A', 'LEU': 'L', 'LYS': 'K', 'SER': 'S', 'VAL': 'V', 'CYS': 'C', 'ASP': 'D'}
+    lines = ["==== Secondary Structure Definition by the program DSSP (benchmark stand-in) ====\n",
+             "  #  RESIDUE AA STRUCTURE BP1 BP2  ACC\n"]
+    for number, (chain, resi, name) in enumerate(residues, 1):
+        position = int(resi) % 20 if resi.isdigit() else 0
+        structure = 'H' if position < 8 else 'E' if 10 <= position < 14 else ' '
+        lines.append("%5d%5s %1s %1s  %1s %18d\n" % (number, resi, chain, codes.get(name, 'X'),
+                                                    structure, 0))
+    with open(args.output, 'w') as outfile:
+        outfile.writelines(lines)
+    return 0
+
+
+def stub_featurize(argv):
+    '''
+    Stand-in for featurize -P file.ptf : writes to stdout the shell_counts
+    of every gridpoint as a .ff line (Env_name_n, the counts, '#' and the
+    coordinates). The pdb and dssp files of every structure named in the
+    .ptf file are read from PDB_DIR and DSSP_DIR, as featurize does.
+    '''
+    parser = argparse.ArgumentParser(prog="featurize")
+    parser.add_argument('-P', dest='points', required=True)
+    args = parser.parse_args(argv)
+    with open(args.points, 'r') as infile:
+        fields = np.array(infile.read().split(), dtype=object).reshape(-1, 4)
+    names, xyz = fields[:, 0].astype(str), fields[:, 1:].astype(float)
+    out = sys.stdout
+    out.write("# PROPERTIES\t"+"\t".join(PROPERTIES)+"\n")
+    for name in dict.fromkeys(names.tolist()):
+        pdbfile = os.path.join(os.environ.get('PDB_DIR', os.curdir), name+".pdb")
+        dsspfile = os.path.join(os.environ.get('DSSP_DIR', os.curdir), name+".dssp")
+        for filename in (pdbfile, dsspfile):
+            if not os.path.isfile(filename):
+                print("featurize: could not find %s" % filename, file=sys.stderr)
+                return 1
+        coords, elements = batch.read_pdb(pdbfile)
+        rows = np.flatnonzero(names == name)
+        for start in range(0, len(rows), ffstore.CHUNK_SIZE):
+            part = rows[start:start+ffstore.CHUNK_SIZE]
+            features = shell_counts(coords, elements, xyz[part])
+            out.writelines("Env_%s_%d\t%s\t#\t%.3f\t%.3f\t%.3f\n" % (name, row, "\t".join(map(str, values)), x, y, z)
+                           for row, values, (x, y, z) in zip(part.tolist(), features.tolist(), xyz[part].tolist()))
+    return 0
+
+
+def stub_scoreit(argv):
+    '''
+    Stand-in for scoreit file.model file.ff : scores the feature vectors
+    with scoring.Model and writes to stdout the name, score and coordinates
+    of every gridpoint, as scoreit does.
+    '''
+    parser = argparse.ArgumentParser(prog="scoreit")
+    parser.add_argument('model')
+    parser.add_argument('ff')
+    args = parser.parse_args(argv)
+    model = scoring.read_model(args.model)
+    out = sys.stdout
+    with open(args.ff, 'r') as infile:
+        comments = []
+        lines = (line for line in infile if line.strip())
+        for line in lines:
+            if not line.startswith('#'):
+                lines = [line] + list(islice(lines, ffstore.CHUNK_SIZE - 1))
+                break
+            comments.append(line)
+        else:
+            return 0
+        values = ffstore.parse_ff_line(lines[0])[1]
+        nfeatures = len(values.split('\t')) if values else 0
+        columns = model.columns(scoring.ff_properties(comments))
+        if len(columns) and columns.max() >= nfeatures:
+            print("scoreit: %s needs more features than the %d of %s" % (args.model, nfeatures, args.ff),
+                  file=sys.stderr)
+            return 1
+        while lines:
+            names, features, coords = ffstore.parse_ff_lines(lines, nfeatures)
+            scores = model.score(features, columns)
+            out.writelines(name+"\t"+'%g' % score+"\t"+"\t".join('%.3f' % value for value in xyz)+"\n"
+                           for name, score, xyz in zip(names, scores.tolist(), coords.tolist()))
+            lines = list(islice(infile, ffstore.CHUNK_SIZE))
+    return 0
+
+
+STUBS = {'dssp': 'stub_dssp', 'featurize': 'stub_featurize', 'scoreit': 'stub_scoreit'}
+
+
+def write_stubs(stub_dir):
+    '''
+    Writes the dssp, featurize and scoreit stand-ins to stub_dir as
+    executable scripts running the stub functions of this module with the
+    current python, plus the stand-in model bench.model. Returns stub_dir.
+    '''
+    os.makedirs(stub_dir, exist_ok=True)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    # run with python -m, this module is __main__
+    module = __spec__.name if __spec__ else __name__
+    for program, function in STUBS.items():
+        filename = os.path.join(stub_dir, program)
+        with open(filename, 'w') as outfile:
+            outfile.write("#!%s\n" % sys.executable)
+            outfile.write("# %s stand-in of the Feature-plugin benchmarks\n" % program)
+            outfile.write("import sys\nfrom importlib import import_module\n")
+            outfile.write("sys.path.insert(0, %r)\n" % root)
+            outfile.write("sys.exit(import_module(%r).%s(sys.argv[1:]))\n" % (module, function))
+        os.chmod(filename, os.stat(filename).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    write_model(os.path.join(stub_dir, "bench.model"))
+    return stub_dir
+
+
+def bench_settings(stub_dir, spacing, overrides=None):
+    '''Returns the batch settings of a benchmark run with the stand-ins of stub_dir.'''
+    settings = dict(CONFIG_DEFAULTS)
+    settings.update({'dssp_exe': os.path.join(stub_dir, 'dssp'),
+                     'feature_data_path': stub_dir,
+                     'models_dir_path': stub_dir,
+                     'spacing': str(spacing),
+                     'precision': "99",
+                     'run_report': '1'})
+    settings.update(overrides or {})
+    return settings
+
+
+def measure_run(pdbfile, model, run_dir, settings):
+    '''
+    Processes pdbfile in run_dir (see batch.process_structure) and returns
+    its result with the stage records of its run report and the peak
+    memory of this process and of its child processes. Meant to be run in
+    a fresh process, so that the peaks only hold this run.
+    '''
+    os.makedirs(run_dir, exist_ok=True)
+    pdbfile, npoints, nsites, error = batch.process_structure(pdbfile, [model], run_dir, settings)
+    name = os.path.splitext(os.path.basename(pdbfile))[0]
+    report_file = os.path.join(run_dir, name+"_report.json")
+    stages = []
+    if os.path.isfile(report_file):
+        with open(report_file, 'r') as infile:
+            stages = json.load(infile)['stages']
+    process, children = instrument.process_usage(), instrument.children_usage()
+    return {'gridpoints': npoints, 'sites': nsites[0] if nsites else 0, 'error': error,
+            'stages': stages,
+            'peak_rss': process[1] if process else None,
+            'children_peak_rss': children[1] if children else None}
+
+
+def stage_summary(result):
+    '''
+    Returns the wall time, throughput (gridpoints per second) and peak
+    memory of every stage of a measure_run result, stages run several
+    times being summed.
+    '''
+    summary = {}
+    for record in result['stages']:
+        entry = summary.setdefault(record['stage'], {'wall': 0.0, 'cpu': 0.0, 'child_cpu': 0.0, 'peak_rss': None})
+        entry['wall'] += record.get('wall') or 0.0
+        entry['cpu'] += record.get('cpu') or 0.0
+        entry['child_cpu'] += record.get('child_cpu') or 0.0
+        peaks = [record.get('child_peak_rss')] + [program.get('peak_rss')
+                                                 for program in record.get('programs', {}).values()]
+        peaks = [peak for peak in peaks if peak]
+        if peaks:
+            entry['peak_rss'] = max([entry['peak_rss'] or 0] + peaks)
+    for entry in summary.values():
+        entry['points_per_s'] = result['gridpoints'] / entry['wall'] if entry['wall'] > 0 else None
+    return summary
+
+
+def scaling(runs, key='gridpoints'):
+    '''
+    Returns for every spacing and stage the exponent b of wall ~ key^b,
+    fitted on the logarithms of the runs (None with less than 2 sizes).
+    '''
+    exponents = {}
+    for spacing in sorted(set(run['spacing'] for run in runs)):
+        same = [run for run in runs if run['spacing'] == spacing and not run['error']]
+        exponents[str(spacing)] = fits = {}
+        for stage in STAGES + ('total',):
+            points = [(run[key], run['summary'][stage]['wall']) for run in same
+                      if stage in run['summary'] and run[key] > 0 and run['summary'][stage]['wall'] > 0]
+            if len(set(size for size, wall in points)) < 2:
+                continue
+            size, wall = np.log(np.array(points, dtype=float)).T
+            fits[stage] = round(float(np.polyfit(size, wall, 1)[0]), 3)
+    return exponents
+
+
+def box_points(coords, spacing):
+    '''Returns the number of gridpoints of the box around coords before pruning.'''
+    axes = grid.grid_axes(grid.find_borders(coords, margin=1), spacing)
+    return int(np.prod([len(axis) for axis in axes], dtype=np.int64))
+
+
+def run_benchmark(sizes, spacings, out_dir, repeat=1, overrides=None, max_box=None, progress=None):
+    '''
+    Benchmarks the pipeline on synthetic structures of every size (number
+    of atoms) at every spacing, each run in a fresh process, and returns
+    the runs : atoms, spacing, gridpoints, sites, error, the summary of the
+    fastest of the repeat runs (see stage_summary) and the peak memory.
+    Sizes and spacings giving a box of more than max_box gridpoints are
+    skipped. progress(run) is called after every run.
+    '''
+    out_dir = os.path.abspath(out_dir)
+    stub_dir = write_stubs(os.path.join(out_dir, "stubs"))
+    model = os.path.join(stub_dir, "bench.model")
+    os.environ['PATH'] = stub_dir + os.pathsep + os.environ.get('PATH', '')
+    structure_dir = os.path.join(out_dir, "structures")
+    os.makedirs(structure_dir, exist_ok=True)
+    runs = []
+    for natoms in sizes:
+        pdbfile = os.path.join(structure_dir, "synthetic_%d.pdb" % natoms)
+        if not os.path.isfile(pdbfile):
+            write_synthetic_pdb(pdbfile, natoms)
+        coords = batch.read_pdb(pdbfile)[0]
+        for spacing in spacings:
+            run = {'atoms': natoms, 'spacing': spacing, 'box_points': box_points(coords, spacing)}
+            if max_box and run['box_points'] > max_box:
+                run.update({'gridpoints': 0, 'sites': 0, 'error': "skipped, box above %d points" % max_box,
+                            'summary': {}, 'peak_rss': None, 'children_peak_rss': None})
+                runs.append(run)
+                if progress is not None:
+                    progress(run)
+                continue
+            run_dir = os.path.join(out_dir, "runs", "%d_%g" % (natoms, spacing))
+            settings = bench_settings(stub_dir, spacing, overrides)
+            results = []
+            for number in range(repeat):
+                with ProcessPoolExecutor(max_workers=1) as pool:
+                    results.append(pool.submit(measure_run, pdbfile, model, run_dir, settings).result())
+            for result in results:
+                result['summary'] = stage_summary(result)
+                result['summary']['total'] = {'wall': sum(entry['wall'] for entry in result['summary'].values())}
+                result['summary']['total']['points_per_s'] = (
+                    result['gridpoints'] / result['summary']['total']['wall']
+                    if result['summary']['total']['wall'] > 0 else None)
+            best = min(results, key=lambda result: result['summary']['total']['wall'])
+            run.update({key: best[key] for key in ('gridpoints', 'sites', 'error', 'summary',
+                                                   'peak_rss', 'children_peak_rss')})
+            run['repeats'] = [result['summary']['total']['wall'] for result in results]
+            runs.append(run)
+            if progress is not None:
+                progress(run)
+    return runs
+
+
+def write_results(out_dir, runs, settings):
+    '''Writes the runs to bench.json and one row per run and stage to bench.csv, returns both names.'''
+    json_file = os.path.join(out_dir, "bench.json")
+    data = {'format': instrument.REPORT_FORMAT,
+            'host': platform.node(),
+            'platform': sys.platform,
+            'python': platform.python_version(),
+            'settings': instrument.public_settings(settings),
+            'runs': runs,
+            'scaling': {'gridpoints': scaling(runs, 'gridpoints'), 'atoms': scaling(runs, 'atoms')}}
+    with open(json_file, 'w') as outfile:
+        json.dump(data, outfile, indent=1, default=str)
+    csv_file = os.path.join(out_dir, "bench.csv")
+    with open(csv_file, 'w', newline='') as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(['atoms', 'spacing', 'gridpoints', 'stage', 'wall', 'cpu', 'child_cpu',
+                         'points_per_s', 'peak_rss'])
+        for run in runs:
+            for stage, entry in run['summary'].items():
+                writer.writerow([run['atoms'], run['spacing'], run['gridpoints'], stage]
+                                + [entry.get(key) for key in ('wall', 'cpu', 'child_cpu',
+                                                              'points_per_s', 'peak_rss')])
+    return json_file, csv_file
+
+
+def megabytes(value):
+    return "%.0f" % (value / 2**20) if value else "-"
+
+
+def format_run(run):
+    '''Returns the table line of a run : sizes, stage times (s), throughput and peak memory.'''
+    if run['error']:
+        return "%8d %7g  %s" % (run['atoms'], run['spacing'], run['error'])
+    summary = run['summary']
+    times = ["%9.3f" % summary[stage]['wall'] if stage in summary else "%9s" % "-" for stage in STAGES]
+    return ("%8d %7g %10d " % (run['atoms'], run['spacing'], run['gridpoints']) + " ".join(times)
+            + " %9.3f %10.0f %7s %7s" % (summary['total']['wall'], summary['total']['points_per_s'] or 0,
+                                       megabytes(run['peak_rss']), megabytes(run['children_peak_rss'])))
+
+
+def table_header():
+    return ("%8s %7s %10s " % ('atoms', 'spacing', 'points') + " ".join("%9s" % stage[:9] for stage in STAGES)
+            + " %9s %10s %7s %7s" % ('total', 'points/s', 'py MB', 'prog MB'))
+
+
+def compare(runs, previous):
+    '''Returns the lines comparing the total and stage times of the runs with the runs of an earlier bench.json.'''
+    before = {(run['atoms'], run['spacing']): run for run in previous['runs'] if not run['error']}
+    lines = []
+    for run in runs:
+        old = before.get((run['atoms'], run['spacing']))
+        if old is None or run['error']:
+            continue
+        ratios = []
+        for stage in STAGES + ('total',):
+            if stage in run['summary'] and stage in old['summary'] and run['summary'][stage]['wall'] > 0:
+                ratios.append("%s x%.2f" % (stage, old['summary'][stage]['wall'] / run['summary'][stage]['wall']))
+        lines.append("%8d %7g  %s" % (run['atoms'], run['spacing'], ", ".join(ratios)))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m %s" % __spec__.name if __spec__ else None,
+        description="Times the Feature-plugin pipeline on synthetic structures with stand-in programs.")
+    parser.add_argument('-o', '--out', default="bench_results", help="output directory")
+    parser.add_argument('-n', '--atoms', type=int, nargs='+', default=[1000, 10000, 100000, 500000],
+                        help="sizes of the synthetic structures (atoms)")
+    parser.add_argument('-s', '--spacing', type=float, nargs='+', default=[2.0, 1.0, 0.48],
+                        help="grid spacings")
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help="runs of every size and spacing, the fastest is kept")
+    parser.add_argument('--max-box', type=float, default=5e7,
+                        help="skips the runs whose box holds more gridpoints (0 runs everything)")
+    parser.add_argument('--compare', metavar="BENCH_JSON", help="bench.json of an earlier run to compare with")
+    parser.add_argument('--set', action='append', default=[], metavar="KEY=VALUE",
+                        help="overrides a setting of the runs (prune_grid=1 ...)")
+    args = parser.parse_args(argv)
+
+    overrides = {}
+    for item in args.set:
+        key, value = item.split('=', 1)
+        overrides[key.strip()] = value.strip()
+    previous = None
+    if args.compare:
+        with open(args.compare, 'r') as infile:
+            previous = json.load(infile)
+    os.makedirs(args.out, exist_ok=True)
+    print(table_header(), flush=True)
+    runs = run_benchmark(args.atoms, args.spacing, args.out, args.repeat, overrides, int(args.max_box),
+                         progress=lambda run: print(format_run(run), flush=True))
+    settings = bench_settings(os.path.join(os.path.abspath(args.out), "stubs"), "", overrides)
+    del settings['spacing']
+    json_file, csv_file = write_results(args.out, runs, settings)
+    print("\nScaling of the stage times with the number of gridpoints (time ~ points^b) :")
+    for spacing, fits in scaling(runs).items():
+        print("%7s  %s" % (spacing, ", ".join("%s %.2f" % item for item in fits.items())))
+    if previous is not None:
+        print("\nSpeedup over %s :" % args.compare)
+        for line in compare(runs, previous):
+            print(line)
+    print("\nResults written to %s and %s" % (json_file, csv_file))
+    return 1 if any(run['error'] and not run['error'].startswith("skipped") for run in runs) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
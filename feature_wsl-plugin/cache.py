@@ -0,0 +1,114 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Content-addressed cache of the files made by the Feature-plugin stages.
+#
+# Every stage result (grid, dssp, hits, pred and site files) is stored under
+# a key hashed from everything it depends on : the atom coordinates, the
+# grid spacing, the model file, the precision ... Entries are directories
+# named after their key; the least recently used ones are evicted once the
+# cache grows beyond its size limit.
+
+import os
+import shutil
+import hashlib
+
+import numpy as np
+
+
+def digest(*parts):
+    '''Returns a hex key for parts (strings, numbers or numpy arrays).'''
+    sha = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            sha.update(np.ascontiguousarray(part).tobytes())
+        else:
+            sha.update(repr(part).encode())
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+def coords_digest(coords):
+    '''Returns a key for atom coordinates, at the 0.001 A precision of pdb files.'''
+    if coords is None:
+        coords = np.zeros((0, 3))
+    return digest(np.round(np.asarray(coords, dtype=float), 3))
+
+
+def file_digest(filename, blocksize=2**20):
+    '''Returns a key for the content of filename.'''
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as infile:
+        for block in iter(lambda: infile.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def file_stamp(filename):
+    '''Returns (size, modification time) of filename, None if it is missing.'''
+    if not os.path.isfile(filename):
+        return None
+    stat = os.stat(filename)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+class ArtifactCache:
+    '''
+    Cache directory root holding at most max_size bytes.
+    Artifacts are passed as {name in the cache: file name} dictionaries.
+    '''
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+
+    def enabled(self):
+        return self.max_size > 0
+
+    def fetch(self, key, files):
+        '''
+        Copies the cached artifacts of key to their file names.
+        Returns False (and copies nothing) unless all of them are cached.
+        '''
+        if not self.enabled():
+            return False
+        entry = os.path.join(self.root, key)
+        if not all(os.path.isfile(os.path.join(entry, name)) for name in files):
+            return False
+        for name, filename in files.items():
+            shutil.copyfile(os.path.join(entry, name), filename)
+        # mark the entry as the most recently used one
+        os.utime(entry)
+        return True
+
+    def store(self, key, files):
+        '''Copies files into the cache under key and evicts old entries.'''
+        if not self.enabled():
+            return
+        entry = os.path.join(self.root, key)
+        os.makedirs(entry, exist_ok=True)
+        for name, filename in files.items():
+            shutil.copyfile(filename, os.path.join(entry, name))
+        os.utime(entry)
+        self.evict(keep=key)
+
+    def entries(self):
+        '''Returns (last use, size, key) for all cache entries, oldest first.'''
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        for key in os.listdir(self.root):
+            entry = os.path.join(self.root, key)
+            if os.path.isdir(entry):
+                size = sum(os.path.getsize(os.path.join(entry, name))
+                           for name in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, key))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        '''Removes the least recently used entries until the cache fits in max_size.'''
+        entries = self.entries()
+        total = sum(size for used, size, key in entries)
+        for used, size, key in entries:
+            if total <= self.max_size:
+                break
+            if key != keep:
+                shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+                total -= size
@@ -0,0 +1,114 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Checkpointed featurize runs for the Feature-plugin.
+#
+# A sharded run (see runner.py) can be resumed after featurize, PyMol or the
+# machine died : the shards stay in the shard directory with a manifest
+# (manifest.json) holding the key of the run (a digest of everything the
+# hits depend on and of the .ptf file), the checksum of every shard .ptf
+# and, for every finished shard, the checksums of its output files. The
+# manifest is rewritten after every finished shard. A run with the same key
+# finds the manifest, verifies the checksums and only runs the shards which
+# are not finished or whose files changed, then all shards are merged. A
+# run with another key starts from scratch.
+
+import os
+import json
+import threading
+from glob import glob
+
+from . import cache
+from . import runner
+
+MANIFEST = "manifest.json"
+MANIFEST_FORMAT = 1
+
+
+class Checkpoint:
+    '''
+    Manifest of the shards in shard_dir of the run key, whose shards write
+    the files shard+suffix for suffix in outputs (all needed) and in
+    optional (checked if written, like unkept .ff files).
+    '''
+    def __init__(self, shard_dir, key, outputs, optional=('_grid.ff',)):
+        self.shard_dir = shard_dir
+        self.filename = os.path.join(shard_dir, MANIFEST)
+        self.key = key
+        self.outputs = tuple(outputs)
+        self.suffixes = tuple(dict.fromkeys(tuple(optional) + self.outputs))
+        self.records = []
+        self.lock = threading.Lock()
+
+    def read(self):
+        '''Returns the shard records of the manifest if it belongs to the run, [] otherwise.'''
+        try:
+            with open(self.filename, 'r') as infile:
+                data = json.load(infile)
+        except (OSError, ValueError):
+            return []
+        if data.get('format') != MANIFEST_FORMAT or data.get('key') != self.key:
+            return []
+        return data.get('shards', [])
+
+    def write(self):
+        with self.lock:
+            data = {'format': MANIFEST_FORMAT, 'key': self.key, 'shards': self.records}
+            with open(self.filename+".part", 'w') as outfile:
+                json.dump(data, outfile, indent=1)
+            os.replace(self.filename+".part", self.filename)
+
+    def shard(self, record):
+        return os.path.join(self.shard_dir, record['name'])
+
+    def split(self, ptf_file, nshards):
+        '''
+        Returns the shards of ptf_file : the ones of the manifest if their
+        .ptf files are unchanged, else nshards new ones (see
+        runner.split_ptf), replacing the files of an earlier run.
+        '''
+        self.key = cache.digest(self.key, cache.file_digest(ptf_file))
+        records = self.read()
+        if records and all(os.path.isfile(self.shard(record)+".ptf")
+                           and cache.file_digest(self.shard(record)+".ptf") == record['ptf']
+                           for record in records):
+            self.records = records
+            return [self.shard(record) for record in records]
+        if os.path.isdir(self.shard_dir):
+            old = [os.path.splitext(name)[0] for name in glob(os.path.join(self.shard_dir, "*.ptf"))]
+            runner.remove_shards(old, ('.ptf', '.sh') + self.suffixes)
+        shards = runner.split_ptf(ptf_file, nshards, self.shard_dir)
+        self.records = [{'name': os.path.basename(shard), 'ptf': cache.file_digest(shard+".ptf"), 'outputs': None}
+                        for shard in shards]
+        self.write()
+        return shards
+
+    def finished(self, record):
+        '''Returns whether the shard of record is finished and its files are unchanged.'''
+        outputs = record.get('outputs')
+        if not outputs or any(suffix not in outputs for suffix in self.outputs):
+            return False
+        shard = self.shard(record)
+        return all(os.path.isfile(shard+suffix) and cache.file_digest(shard+suffix) == checksum
+                   for suffix, checksum in outputs.items())
+
+    def pending(self):
+        '''Returns the shards still to run.'''
+        return [self.shard(record) for record in self.records if not self.finished(record)]
+
+    def complete(self, shard):
+        '''Records shard as finished if it wrote all its outputs, returns whether it did.'''
+        if not all(os.path.isfile(shard+suffix) for suffix in self.outputs):
+            return False
+        outputs = {suffix: cache.file_digest(shard+suffix) for suffix in self.suffixes
+                   if os.path.isfile(shard+suffix)}
+        name = os.path.basename(shard)
+        with self.lock:
+            for record in self.records:
+                if record['name'] == name:
+                    record['outputs'] = outputs
+        self.write()
+        return True
+
+    def remove(self):
+        '''Removes the manifest, once the shards are merged.'''
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
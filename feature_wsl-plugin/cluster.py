@@ -0,0 +1,355 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Distributed featurize/scoreit workers for the Feature-plugin.
+#
+# The shards of a grid (see runner.split_ptf) can be run on other machines.
+# The plugin then runs a small coordinator (ClusterBackend) listening on a
+# TCP port for the time of a run, and workers started on any number of
+# nodes (see worker.py)
+#
+#   python -m feature_wsl-plugin.worker -s coordinator_host:8765 -j 8
+#
+# connect to it and pull shards one at a time : the shard .ptf, the pdb and
+# dssp files of the structure and the models are sent with the job, the
+# worker runs featurize/scoreit in a scratch directory through its own bash
+# (native, wsl or cygwin as set in its plugin configuration file, like the
+# batch runs) and sends the hits back. A shard whose worker fails or
+# disconnects is queued again, up to retries times. Workers keep
+# reconnecting, so they serve one run after the other.
+#
+# Workers build the commands of a shard themselves from the job (model
+# names and options) and only accept plain file names : a coordinator
+# cannot run other commands on them.
+#
+# Without a token (cluster_token), the coordinator only listens on
+# localhost : workers must run on the machine of the plugin. With a token
+# it listens on all interfaces, and the coordinator and every worker prove
+# to each other that they hold the token with an HMAC of a random
+# challenge of the other side, so the token itself is never sent. The
+# files and hits are not encrypted.
+#
+# Messages are a 4-byte length and a JSON header, followed by the bytes of
+# the files listed in the header.
+
+import os
+import re
+import hmac
+import json
+import secrets
+import time
+import socket
+import struct
+import itertools
+import threading
+import collections
+
+
+DEFAULT_PORT = 8765
+# headers are small, anything larger is not a message of a worker
+MAX_HEADER = 2**20
+BLOCK_SIZE = 2**20
+# seconds without any worker connected after which the waiting shards fail
+WAIT = 300
+
+FILE_NAME = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9_.+-]*$')
+
+
+def check_name(name):
+    '''Returns name if it is a plain file name, raises ValueError otherwise.'''
+    if not isinstance(name, str) or not FILE_NAME.match(name):
+        raise ValueError("invalid file name %r" % (name,))
+    return name
+
+
+def parse_address(address, default_host=''):
+    '''Returns (host, port) of "host:port", "host" or ":port".'''
+    host, colon, port = str(address).rpartition(':')
+    if not colon:
+        host, port = port, ''
+    return host or default_host, int(port) if port else DEFAULT_PORT
+
+
+def token_digest(token, role, challenge):
+    '''Returns the proof that the coordinator or worker (role) holds token for challenge.'''
+    message = ("%s:%s" % (role, challenge)).encode('utf-8')
+    return hmac.new(str(token).encode('utf-8'), message, 'sha256').hexdigest()
+
+
+def check_digest(digest, token, role, challenge):
+    '''Returns whether digest is the proof of token for role and challenge (see token_digest).'''
+    return isinstance(digest, str) and hmac.compare_digest(digest, token_digest(token, role, challenge))
+
+
+def new_challenge():
+    return secrets.token_hex(16)
+
+
+def listen(address):
+    '''Returns a server socket bound to address (host, port), '' for all interfaces.'''
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if os.name == 'posix':
+        # the port of the previous run can be bound again at once
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(address)
+    server.listen()
+    return server
+
+
+def receive_exact(sock, size):
+    '''Returns the next size bytes of sock, raises ConnectionError if it is closed before.'''
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, BLOCK_SIZE))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def send_message(sock, message, files=()):
+    '''Sends the dict message followed by files, a list of (file name, path).'''
+    files = [(check_name(name), path) for name, path in files]
+    message = dict(message, files=[[name, os.path.getsize(path)] for name, path in files])
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(struct.pack('!I', len(data)) + data)
+    for name, path in files:
+        with open(path, 'rb') as infile:
+            sock.sendfile(infile)
+
+
+def receive_message(sock, directory=None, names=None):
+    '''
+    Returns the next message of sock. Its files are written to directory,
+    under their names which must be in names if given, and are listed in
+    message['paths'].
+    '''
+    size = struct.unpack('!I', receive_exact(sock, 4))[0]
+    if size > MAX_HEADER:
+        raise ValueError("message header of %d bytes" % size)
+    message = json.loads(receive_exact(sock, size).decode('utf-8'))
+    if not isinstance(message, dict):
+        raise ValueError("message is not an object")
+    message['paths'] = []
+    for name, size in message.get('files', []):
+        check_name(name)
+        if directory is None or (names is not None and name not in names):
+            raise ValueError("unexpected file %s" % name)
+        path = os.path.join(directory, name)
+        try:
+            with open(path+".part", 'wb') as outfile:
+                while size:
+                    block = receive_exact(sock, min(int(size), BLOCK_SIZE))
+                    outfile.write(block)
+                    size -= len(block)
+            os.replace(path+".part", path)
+        finally:
+            if os.path.isfile(path+".part"):
+                os.remove(path+".part")
+        message['paths'].append(path)
+    return message
+
+
+class ClusterBackend:
+    '''
+    Runs the shards on the workers connecting to port (see runner for the
+    backends). The workers get the shard .ptf and files (the paths of the
+    pdb and dssp files of the structure), and run featurize alone or with
+    scoreit for the models (paths, sent as well) as set by job :
+    'labels' (the labels of several models, see runner.models_commands),
+    'stream' and 'keep_ff' (see runner.feature_commands). A failed shard is
+    run again up to retries times, on another worker as long as one of the
+    connected workers did not fail it. The waiting shards fail when no
+    worker has been connected for wait seconds. Without a token, only
+    workers on this machine can connect.
+    '''
+    def __init__(self, port, files, models=(), job=None, outputs=('_grid.hits',), nshards=64,
+                 retries=2, token="", wait=WAIT):
+        self.address = ('' if token else 'localhost', int(port))
+        self.files = list(files) + list(models)
+        self.job = dict(job or {}, models=[os.path.basename(model) for model in models])
+        self.job.setdefault('labels', [])
+        self.outputs = tuple(outputs)
+        # the feature vectors also come back when they are kept
+        self.returned = tuple(dict.fromkeys(self.outputs + (('_grid.ff',) if self.job.get('keep_ff') else ())))
+        self.nshards = max(1, int(nshards))
+        self.retries = int(retries)
+        self.token = str(token)
+        self.wait = wait
+        self.condition = threading.Condition()
+
+    def next_shard(self, worker):
+        '''Returns the next shard for worker, None once all shards are finished or the run is stopped.'''
+        with self.condition:
+            while not self.stopped:
+                for shard in self.pending:
+                    # a worker failing at once would otherwise take all the shards queued again
+                    if worker not in self.tried[shard] or self.live <= self.tried[shard]:
+                        self.pending.remove(shard)
+                        self.running += 1
+                        return shard
+                if not self.pending and self.running == 0:
+                    return None
+                self.condition.wait(0.5)
+        return None
+
+    def finish(self, shard, worker, returncode):
+        '''
+        Records the result of shard on worker (returncode is None if the
+        worker was lost) and queues it again if it failed.
+        '''
+        with self.condition:
+            self.running -= 1
+            if returncode != 0:
+                self.tried[shard].add(worker)
+                self.attempts[shard] += 1
+                if self.attempts[shard] <= self.retries and not self.stopped:
+                    self.report("Shard %s failed (%s), queued again"
+                                % (os.path.basename(shard), "worker lost" if returncode is None
+                                   else "exit code %d" % returncode))
+                    self.pending.append(shard)
+                    self.condition.notify_all()
+                    return
+                self.failed.append(shard)
+            self.finished += 1
+            finished = self.finished
+            self.condition.notify_all()
+        if self.progress is not None:
+            self.progress(finished, len(self.shards), shard, -1 if returncode is None else returncode)
+
+    def run_shard(self, conn, shard):
+        '''Runs shard on the worker of conn and returns its exit code, -1 if outputs are missing.'''
+        name = os.path.basename(shard)
+        for suffix in self.returned:
+            if os.path.isfile(shard+suffix):
+                os.remove(shard+suffix)
+        files = [(name+".ptf", shard+".ptf")] + [(os.path.basename(path), path) for path in self.files]
+        send_message(conn, dict(self.job, type='job', shard=name, returned=self.returned), files)
+        result = receive_message(conn, os.path.dirname(shard) or os.curdir,
+                                 names={name+suffix for suffix in self.returned})
+        if result.get('type') != 'result':
+            raise ValueError("unexpected %s message" % result.get('type'))
+        returncode = int(result.get('returncode', -1))
+        if returncode == 0 and not all(os.path.isfile(shard+suffix) for suffix in self.outputs):
+            returncode = -1
+        return returncode
+
+    def serve(self, conn, address):
+        '''Runs shards on the worker connected as conn until all are finished.'''
+        worker = "%s:%d" % address[:2]
+        connected = False
+        key = next(self.numbers)
+        try:
+            hello = receive_message(conn)
+            if hello.get('type') != 'hello' or not isinstance(hello.get('challenge'), str):
+                send_message(conn, {'type': 'refused'})
+                self.report("Worker %s refused" % worker)
+                return
+            challenge = new_challenge()
+            send_message(conn, {'type': 'challenge', 'challenge': challenge,
+                                'proof': token_digest(self.token, 'coordinator', hello['challenge'])})
+            answer = receive_message(conn)
+            if answer.get('type') != 'proof' or not check_digest(answer.get('proof'), self.token, 'worker', challenge):
+                send_message(conn, {'type': 'refused'})
+                self.report("Worker %s refused" % worker)
+                return
+            worker = "%s (%s)" % (hello.get('worker'), worker)
+            with self.condition:
+                self.live.add(key)
+                connected = True
+                self.condition.notify_all()
+            self.report("Worker %s connected" % worker)
+            while True:
+                shard = self.next_shard(key)
+                if shard is None:
+                    send_message(conn, {'type': 'done'})
+                    return
+                try:
+                    returncode = self.run_shard(conn, shard)
+                except (OSError, ValueError) as error:
+                    self.report("Worker %s lost : %s" % (worker, error))
+                    self.finish(shard, key, None)
+                    return
+                self.finish(shard, key, returncode)
+        except (OSError, ValueError) as error:
+            self.report("Worker %s : %s" % (worker, error))
+        finally:
+            conn.close()
+            with self.condition:
+                self.connections.discard(conn)
+                if connected:
+                    self.live.discard(key)
+                    if not self.live:
+                        self.idle = time.monotonic()
+                self.condition.notify_all()
+
+    def accept(self, server):
+        while not self.stopped:
+            try:
+                conn, address = server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            conn.settimeout(None)
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            with self.condition:
+                self.connections.add(conn)
+            thread = threading.Thread(target=self.serve, args=(conn, address), daemon=True)
+            self.threads.append(thread)
+            thread.start()
+
+    def run(self, shards, progress=None, cancel=None, report=None):
+        '''
+        Runs the shards on the workers connecting meanwhile, calling
+        progress(done, total, shard, returncode) for every finished shard
+        and report(message) for the workers connecting, refused or lost.
+        Setting the threading.Event cancel stops the run. Returns the shards
+        that failed or were not run.
+        '''
+        self.report = report or (lambda message: None)
+        self.shards = list(shards)
+        self.pending = collections.deque(self.shards)
+        self.attempts = dict.fromkeys(self.shards, 0)
+        self.tried = {shard: set() for shard in self.shards}
+        # the workers are told apart by the number of their connection
+        self.numbers = itertools.count()
+        self.live = set()
+        self.running = self.finished = 0
+        self.failed = []
+        self.progress = progress
+        self.stopped = False
+        self.connections = set()
+        self.threads = []
+        self.idle = time.monotonic()
+        server = listen(self.address)
+        server.settimeout(0.5)
+        self.report("Waiting for workers on port %d ..." % self.address[1])
+        acceptor = threading.Thread(target=self.accept, args=(server,), daemon=True)
+        acceptor.start()
+        try:
+            with self.condition:
+                while self.pending or self.running:
+                    if cancel is not None and cancel.is_set():
+                        break
+                    if not self.live and time.monotonic() - self.idle > self.wait:
+                        self.report("No worker connected for %d s" % self.wait)
+                        break
+                    self.condition.wait(0.5)
+        finally:
+            with self.condition:
+                self.stopped = True
+                self.condition.notify_all()
+            acceptor.join()
+            server.close()
+        # the workers still running a shard notice the closed connection and stop it
+        with self.condition:
+            connections = list(self.connections)
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for thread in self.threads:
+            thread.join()
+        unfinished = set(self.failed) | set(self.pending)
+        return [shard for shard in self.shards if shard in unfinished]
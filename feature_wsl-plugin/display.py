@@ -0,0 +1,107 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Loading of the predicted sites into PyMol for the Feature-plugin.
+#
+# The sites are built in memory as a chempy model, one CA atom per site
+# with the max score of the site in the B-factor column and its occupancy
+# (the fraction of the states having it for consensus sites), and loaded
+# with one cmd.load_model per state. The representations are then set once
+# for the whole object. No pdb file is written and parsed again, so the
+# sites of large complexes show at once; the pdb files are only written
+# when asked for (refine.write_site_pdb, in one pass).
+#
+# The score maps (see scoremap.py) go to PyMol as chempy bricks, through a
+# CCP4 file for PyMol versions without Brick.from_numpy, and show as an
+# isosurface at the score cutoff.
+
+import numpy as np
+
+from . import scoremap
+
+try:
+    from pymol import cmd
+    from chempy import Atom, models
+except ImportError:
+    # no PyMol : only the pipeline can be used, headless (see batch.py)
+    cmd = Atom = models = None
+
+try:
+    from chempy.brick import Brick
+except ImportError:
+    Brick = None
+
+
+def site_model(sites, occupancy=None):
+    '''
+    Returns a chempy model of sites (an (n, 10) array, see
+    refine.predict_sites) holding the CA atoms of refine.site_pdb_lines :
+    max score in the B-factor, occupancy (1.00 by default) in the
+    occupancy, both rounded as in the pdb files.
+    '''
+    sites = np.asarray(sites, dtype=float).reshape(-1, 10)
+    if occupancy is None:
+        occupancy = np.ones(len(sites))
+    # the empty sites of the R quirk have no score
+    scores = np.nan_to_num(np.round(sites[:, 9], 2)).tolist()
+    occupancy = np.round(np.asarray(occupancy, dtype=float), 2).tolist()
+    model = models.Indexed()
+    for count, (xyz, score, occ) in enumerate(zip(sites[:, :3].tolist(), scores, occupancy), 1):
+        atom = Atom()
+        atom.name = 'CA'
+        atom.resn = 'CA'
+        atom.chain = 'X'
+        atom.resi = str(count)
+        atom.resi_number = count
+        atom.symbol = 'C'
+        atom.coord = xyz
+        atom.b = score
+        atom.q = occ
+        model.atom.append(atom)
+    return model
+
+
+def show_sites(name, label=None):
+    '''Shows the sites of object name as transparent spheres colored by score, labelled with label if given.'''
+    cmd.show_as("spheres", name)
+    cmd.spectrum("b", selection=name)
+    cmd.set("sphere_transparency", value=0.6, selection=name)
+    if label:
+        cmd.label(name, label)
+
+
+def load_sites(name, state_sites, occupancy=None, label="b"):
+    '''
+    Loads the sites of every state (a list of (n, 10) arrays, a single one
+    for one structure) as the states of object name, replacing it, and
+    shows them (see show_sites). occupancy is None or a list of the
+    occupancies of every state. Returns the number of sites.
+    '''
+    cmd.delete(name)
+    nsites = 0
+    for state, sites in enumerate(state_sites, 1):
+        sites = np.asarray(sites, dtype=float).reshape(-1, 10)
+        if len(sites):
+            cmd.load_model(site_model(sites, None if occupancy is None else occupancy[state-1]),
+                           name, state=state)
+            nsites += len(sites)
+    if nsites:
+        show_sites(name, label)
+    return nsites
+
+
+def load_map(name, data, origin, spacing, level, filename):
+    '''
+    Loads the score map data (see scoremap.score_grid) as map object name,
+    replacing it, and shows its isosurface at level as name-surface. The
+    map is written to filename on the way only if PyMol cannot take it as
+    a brick. Returns whether filename was written.
+    '''
+    cmd.delete(name)
+    cmd.delete(name+"-surface")
+    written = Brick is None or not hasattr(Brick, 'from_numpy')
+    if written:
+        scoremap.write_ccp4(filename, data, origin, spacing)
+        cmd.load(filename, name, format="ccp4")
+    else:
+        cmd.load_brick(Brick.from_numpy(data, [spacing]*3, [float(value) for value in origin]), name)
+    cmd.isosurface(name+"-surface", name, level)
+    return written
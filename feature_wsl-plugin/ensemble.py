@@ -0,0 +1,144 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Multi-state (NMR ensembles, MD frames) scanning for the Feature-plugin.
+#
+# All states share one grid : the box covers the atoms of every state and a
+# gridpoint is kept if it lies in the pruning shell of any state. Every
+# state is then written, featurized and refined on its own under the name
+# prot_NNN, and the sites of the states are matched to each other : a
+# consensus site gathers at most one site per state within 3.5 A and gets
+# an occupancy (fraction of the states having it) and a persistence (the
+# longest run of consecutive states having it).
+
+import numpy as np
+
+from . import grid
+from . import prescreen
+from . import refine
+from . import spatial
+
+
+def state_name(prot, state):
+    '''Returns the name of the files of state (counted from 1) of prot.'''
+    return "%s_%03d" % (prot, state)
+
+
+def ensemble_borders(states, margin=1.0):
+    '''Returns the borders of the box around the atoms of all states.'''
+    return grid.find_borders(np.vstack(states), margin)
+
+
+def ensemble_mask(axes, spacing, states, min_dist, max_dist):
+    '''Returns the gridpoints lying in the shell_mask of any of the states.'''
+    keep = np.zeros(tuple(len(axis) for axis in axes), dtype=bool)
+    for atoms in states:
+        keep |= grid.shell_mask(axes, spacing, atoms, min_dist, max_dist)
+    return keep
+
+
+def ensemble_screen(axes, spacing, ligands, labels, settings):
+    '''
+    Returns the gridpoints passing the pre-screen (see prescreen.screen_mask)
+    in any of the states, ligands holding their (oxygens, nitrogens).
+    '''
+    keep = np.zeros(tuple(len(axis) for axis in axes), dtype=bool)
+    for oxygens, nitrogens in ligands:
+        keep |= prescreen.screen_mask(axes, spacing, oxygens, nitrogens, labels, settings)
+    return keep
+
+
+def write_state_ptfs(prot, nstates, axes, keep=None):
+    '''Writes the same gridpoints to the .ptf file of every state, returns their number.'''
+    npoints = 0
+    for state in range(1, nstates+1):
+        name = state_name(prot, state)
+        npoints = grid.write_ptf(name+".ptf", name, axes, keep)
+    return npoints
+
+
+def match_sites(state_sites, radius=refine.SITE_RADIUS):
+    '''
+    Matches the sites of the states (a list of (n, 10) arrays, see
+    refine.predict_sites) and returns the consensus sites as an (m, 9)
+    array, best first : mean x, y, z of the matched sites, number of
+    states, occupancy, persistence (longest run of consecutive states),
+    mean and max of the max scores and the first state (from 1).
+    Sites are taken by decreasing score, each one gathering the closest
+    unmatched site of every other state within radius.
+    '''
+    nstates = len(state_sites)
+    sites = [np.asarray(sites, dtype=float).reshape(-1, 10) for sites in state_sites]
+    states = np.concatenate([np.full(len(s), number) for number, s in enumerate(sites)]
+                            + [np.zeros(0, dtype=int)]).astype(int)
+    sites = np.vstack(sites + [np.zeros((0, 10))])
+    # the empty sites of the R quirk (see refine.predict_sites) are dropped
+    real = sites[:, 3] > 0
+    sites, states = sites[real], states[real]
+    order = np.argsort(-sites[:, 9], kind='stable')
+    sites, states = sites[order], states[order]
+    cells = spatial.CellList(sites[:, :3], radius)
+    matched = np.zeros(len(sites), dtype=bool)
+    consensus = []
+    for seed in range(len(sites)):
+        if matched[seed]:
+            continue
+        near = cells.within(sites[seed, :3], radius)
+        near = near[~matched[near]]
+        dist = np.sum((sites[near, :3] - sites[seed, :3])**2, axis=1)
+        members = [seed]
+        for state in np.unique(states[near]):
+            if state != states[seed]:
+                same = states[near] == state
+                members.append(near[same][np.argmin(dist[same])])
+        members = np.array(members)
+        matched[members] = True
+        present = np.zeros(nstates + 1, dtype=int)
+        present[states[members]] = 1
+        # longest run of consecutive states
+        runs = np.diff(np.flatnonzero(np.diff(np.concatenate([[0], present])) != 0))
+        persistence = runs[0::2].max() if len(runs) else 0
+        consensus.append(list(sites[members, :3].mean(axis=0))
+                         + [len(members), len(members) / nstates, persistence,
+                            sites[members, 9].mean(), sites[members, 9].max(),
+                            states[members].min() + 1])
+    return np.array(consensus, dtype=float).reshape(-1, 9)
+
+
+def write_consensus(filename, prot, consensus):
+    '''Writes the consensus sites as the .pred files : the name followed by the 9 columns.'''
+    with open(filename, 'w') as outfile:
+        for site in consensus:
+            outfile.write(prot+" "+" ".join('%.15g' % value for value in site)+"\n")
+    return filename
+
+
+def read_consensus(filename):
+    '''Returns the 9 columns of the consensus sites of filename (see write_consensus).'''
+    return np.loadtxt(filename, usecols=range(1, 10), ndmin=2).reshape(-1, 9)
+
+
+def consensus_sites(consensus):
+    '''Returns the consensus sites as site rows with their max score, and their occupancy.'''
+    sites = np.zeros((len(consensus), 10))
+    sites[:, :3] = consensus[:, :3]
+    sites[:, 9] = consensus[:, 7]
+    return sites, consensus[:, 4]
+
+
+def write_consensus_pdb(filename, consensus):
+    '''Writes the consensus sites as CA atoms, occupancy and max score in the occupancy and B columns.'''
+    sites, occupancy = consensus_sites(consensus)
+    return refine.write_site_pdb(filename, sites, occupancy=occupancy)
+
+
+def write_states_pdb(filename, state_sites):
+    '''Writes the sites of every state as one MODEL of a multi-state pdb file, in one pass.'''
+    lines = []
+    for state, sites in enumerate(state_sites, 1):
+        sites = np.asarray(sites, dtype=float).reshape(-1, 10)
+        lines.append("MODEL     "+'{:4d}'.format(state)+"\n")
+        lines.extend(refine.site_pdb_lines(sites[sites[:, 3] > 0]))
+        lines.append("ENDMDL\n")
+    lines.append("END\n")
+    with open(filename, 'w') as outfile:
+        outfile.writelines(lines)
+    return filename
@@ -0,0 +1,188 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Grid envelopes for the Feature-plugin.
+#
+# findborders puts the grid in the box of the atoms along the x, y and z
+# axes : an elongated protein lying diagonally, or domains hanging on
+# linkers, leave most of that box in the solvent, and every gridpoint of
+# the box is gone through (and written without pruning). grid_envelope
+# sets the envelope of the grid :
+#
+#   box    the box of findborders (default)
+#   pca    a box along the principal axes of the atoms if it is smaller
+#          than the box of findborders : the lattice is built in that frame
+#          and the gridpoints are written in the frame of the structure
+#          (off the x, y, z lattice then)
+#   boxes  up to envelope_boxes boxes, one around every cluster of atoms
+#          (domains), found by splitting a box of atoms in two where it
+#          shrinks their volume most, as long as it shrinks it by a tenth.
+#          The boxes lie on the lattice of the findborders box, within it,
+#          and a gridpoint of several boxes is only written with the first
+#          one. With pruning, the boxes reach prune_max_dist beyond their
+#          atoms, so the pruned grid keeps the same gridpoints (in box
+#          order) and only the empty parts of the box are skipped.
+#
+# The pruning and pre-screen masks are computed in the frame of the
+# lattice (see grid_mask in batch.py and in the plugin).
+
+import numpy as np
+
+from . import grid
+
+ENVELOPES = ('box', 'pca', 'boxes')
+# a box is split if its two parts take less than this fraction of its volume
+SPLIT_GAIN = 0.9
+
+
+def principal_frame(coords):
+    '''
+    Returns the frame (center, rotation) of the principal axes of coords
+    ((n, 3) array) : the rows of rotation are the axes, of decreasing
+    variance and right-handed, with their largest component positive.
+    '''
+    coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+    center = coords.mean(axis=0)
+    rotation = np.linalg.svd(coords - center, full_matrices=True)[2]
+    rotation *= np.sign(rotation[np.arange(3), np.abs(rotation).argmax(axis=1)])[:, None]
+    if np.linalg.det(rotation) < 0:
+        rotation[2] *= -1
+    return center, rotation
+
+
+def to_frame(coords, frame):
+    '''Returns the coordinates coords of the structure in frame (see principal_frame).'''
+    center, rotation = frame
+    return (np.asarray(coords, dtype=float).reshape(-1, 3) - center) @ rotation.T
+
+
+def border_volume(borders):
+    return float(np.prod([high - low for high, low in zip(borders[0::2], borders[1::2])]))
+
+
+def box_volume(coords, margin):
+    return float(np.prod(coords.max(axis=0) - coords.min(axis=0) + 2*margin))
+
+
+def best_split(coords, margin):
+    '''
+    Returns (volume of both parts, indices of the first part, indices of
+    the second part) of the cut of coords across an axis giving the
+    smallest boxes (extended by margin), None if the atoms cannot be split.
+    '''
+    best = None
+    for axis in range(3):
+        order = np.argsort(coords[:, axis], kind='stable')
+        ordered = coords[order]
+        # boxes of the first k and of the last n-k atoms for every cut k
+        first = np.prod(np.maximum.accumulate(ordered)[:-1] - np.minimum.accumulate(ordered)[:-1] + 2*margin,
+                        axis=1)
+        last = np.prod(np.maximum.accumulate(ordered[::-1])[::-1][1:]
+                       - np.minimum.accumulate(ordered[::-1])[::-1][1:] + 2*margin, axis=1)
+        # only cut between distinct coordinates
+        volume = np.where(ordered[1:, axis] > ordered[:-1, axis], first + last, np.inf)
+        if len(volume) == 0:
+            continue
+        cut = int(np.argmin(volume))
+        if np.isfinite(volume[cut]) and (best is None or volume[cut] < best[0]):
+            best = (float(volume[cut]), order[:cut+1], order[cut+1:])
+    return best
+
+
+def atom_clusters(coords, margin, max_boxes):
+    '''
+    Returns up to max_boxes clusters of coords ((n, 3) arrays) whose boxes,
+    extended by margin, hold less volume than the box of all of them.
+    '''
+    clusters = [np.asarray(coords, dtype=float).reshape(-1, 3)]
+    while len(clusters) < max_boxes:
+        best = None
+        for number, atoms in enumerate(clusters):
+            if len(atoms) < 2:
+                continue
+            split = best_split(atoms, margin)
+            if split is None:
+                continue
+            gain = box_volume(atoms, margin) - split[0]
+            if split[0] <= SPLIT_GAIN * box_volume(atoms, margin) and (best is None or gain > best[0]):
+                best = (gain, number, split)
+        if best is None:
+            break
+        gain, number, (volume, first, second) = best
+        atoms = clusters.pop(number)
+        clusters += [atoms[first], atoms[second]]
+    return clusters
+
+
+def cluster_boxes(coords, borders, spacing, margin, max_boxes):
+    '''
+    Returns the borders of the boxes around the clusters of coords (see
+    atom_clusters), extended by margin, within borders and on its lattice.
+    '''
+    boxes = []
+    origin = borders[1::2]
+    for atoms in atom_clusters(coords, margin, max_boxes):
+        box = grid.find_borders(atoms, margin)
+        box = [min(value, bound) if number % 2 == 0 else max(value, bound)
+               for number, (value, bound) in enumerate(zip(box, borders))]
+        boxes.append(grid.align_borders(box, origin, spacing))
+    return boxes
+
+
+def envelope_key(settings):
+    '''Returns what the gridpoints depend on besides the box of findborders, None for it.'''
+    if settings['grid_envelope'] == 'box':
+        return None
+    return [settings['grid_envelope'], int(settings['envelope_boxes'])]
+
+
+def envelope_boxes(coords, borders, spacing, settings):
+    '''
+    Returns (frame, boxes) for the grid of the atoms coords ((n, 3)
+    array) as set by grid_envelope : the frame of the lattice (see
+    principal_frame), None for the frame of the structure, and the borders
+    of its boxes in that frame. borders is the box of findborders.
+    '''
+    mode = settings['grid_envelope']
+    if mode not in ENVELOPES:
+        raise ValueError("unknown grid_envelope %s, expected one of %s" % (mode, ", ".join(ENVELOPES)))
+    coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+    if mode == 'box' or len(coords) == 0:
+        return None, [list(borders)]
+    if mode == 'pca':
+        frame = principal_frame(coords)
+        box = grid.find_borders(to_frame(coords, frame), margin=1)
+        # the principal axes of a globular structure can give a larger box
+        if border_volume(box) < border_volume(borders):
+            return frame, [box]
+        return None, [list(borders)]
+    # the boxes must hold every gridpoint the pruning keeps
+    margin = max(1.0, float(settings['prune_max_dist'])) if int(settings['prune_grid']) else 1.0
+    return None, cluster_boxes(coords, borders, spacing, margin, int(settings['envelope_boxes']))
+
+
+def box_mask(axes, box):
+    '''Returns the lattice mask of the gridpoints of axes lying in box (borders).'''
+    inside = [(axis >= low - 1e-6) & (axis <= high + 1e-6)
+              for axis, high, low in zip(axes, box[0::2], box[1::2])]
+    return inside[0][:, None, None] & inside[1][None, :, None] & inside[2][None, None, :]
+
+
+def write_envelope(filename, prot, frame, boxes, spacing, mask=None):
+    '''
+    Writes the gridpoints of the boxes in frame (see envelope_boxes) to
+    filename in the frame of the structure, a gridpoint in several boxes
+    only once, and returns their number. mask(axes, spacing, frame, keep)
+    returns the lattice mask of the gridpoints of keep (None for all) kept
+    by the pruning and the pre-screen, None for all.
+    '''
+    count = 0
+    with open(filename, 'w') as outfile:
+        for number, box in enumerate(boxes):
+            axes = grid.grid_axes(box, spacing)
+            keep = None
+            for earlier in boxes[:number]:
+                outside = ~box_mask(axes, earlier)
+                keep = outside if keep is None else keep & outside
+            if mask is not None:
+                keep = mask(axes, spacing, frame, keep)
+            count += grid.write_lattice(outfile, prot, axes, keep, frame)
+    return count
@@ -0,0 +1,183 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Binary store of the feature vectors for the Feature-plugin.
+#
+# featurize writes one text line per gridpoint : the environment name, the
+# feature values, then a '#' and the x, y, z coordinates of the point. The
+# store keeps them as .npy files in a directory (prot_grid.ffs) : features
+# as a float64 (points, features) array in column order, so every feature
+# is one contiguous column, the coordinates and the environment names. The
+# arrays are memory-mapped, so rescoring or filtering millions of points
+# works on numpy views without parsing text again.
+#
+# The values keep the precision of the text : float32 would move a value
+# next to a bin boundary of a model into the next bin. write_ff writes them
+# back as the shortest text read back as the same double, so .ff -> store
+# -> .ff keeps every value.
+
+import os
+import json
+from itertools import islice
+
+import numpy as np
+
+# number of .ff lines parsed at once
+CHUNK_SIZE = 50000
+
+# 2 : float64 features (float32 before)
+STORE_FORMAT = 2
+
+
+def parse_ff_line(line):
+    '''Returns (name, feature values, comment) of a .ff line, as strings.'''
+    values, sep, comment = line.rstrip('\r\n').partition('\t#\t')
+    name, sep, values = values.partition('\t')
+    return name, values, comment
+
+
+def parse_ff_lines(lines, nfeatures):
+    '''
+    Returns the names, features ((n, nfeatures) array) and coordinates
+    ((n, 3) array, nan if missing) of .ff lines. All feature values are
+    converted at once.
+    '''
+    parsed = [parse_ff_line(line) for line in lines]
+    names = [name for name, values, comment in parsed]
+    text = "\t".join(values for name, values, comment in parsed)
+    features = np.array(text.split('\t') if text else [], dtype=np.float64)
+    coords = []
+    for name, values, comment in parsed:
+        xyz = comment.split('\t')[:3]
+        coords.append(xyz if len(xyz) == 3 and xyz[-1] else [np.nan]*3)
+    return names, features.reshape(len(lines), nfeatures), np.array(coords, dtype=np.float64).reshape(-1, 3)
+
+
+def scan_ff(filename):
+    '''Returns the number of gridpoints, of features and the comment lines of filename.'''
+    npoints, nfeatures, comments = 0, None, []
+    with open(filename, 'r') as infile:
+        for line in infile:
+            if line.startswith('#'):
+                comments.append(line.rstrip('\r\n'))
+            elif line.strip():
+                if nfeatures is None:
+                    values = parse_ff_line(line)[1]
+                    nfeatures = len(values.split('\t')) if values else 0
+                npoints += 1
+    return npoints, nfeatures or 0, comments
+
+
+def convert_ff(ff_file, store_dir, chunk_size=CHUNK_SIZE):
+    '''
+    Converts the text feature vectors of ff_file into a store in
+    store_dir, parsing chunk_size lines at a time, and returns it opened.
+    '''
+    npoints, nfeatures, comments = scan_ff(ff_file)
+    os.makedirs(store_dir, exist_ok=True)
+    features = np.lib.format.open_memmap(os.path.join(store_dir, 'features.npy'), mode='w+',
+                                         dtype=np.float64, shape=(npoints, nfeatures),
+                                         fortran_order=True)
+    coords = np.lib.format.open_memmap(os.path.join(store_dir, 'coords.npy'), mode='w+',
+                                       dtype=np.float64, shape=(npoints, 3))
+    names = []
+    start = 0
+    with open(ff_file, 'r') as infile:
+        lines = (line for line in infile if line.strip() and not line.startswith('#'))
+        while start < npoints:
+            chunk = list(islice(lines, chunk_size))
+            if not chunk:
+                break
+            end = start + len(chunk)
+            chunk_names, features[start:end], coords[start:end] = parse_ff_lines(chunk, nfeatures)
+            names.extend(chunk_names)
+            start = end
+    features.flush()
+    coords.flush()
+    np.save(os.path.join(store_dir, 'names.npy'), np.array(names, dtype=bytes).reshape(-1))
+    with open(os.path.join(store_dir, 'store.json'), 'w') as outfile:
+        json.dump({'format': STORE_FORMAT, 'points': npoints, 'features': nfeatures,
+                   'comments': comments, 'source': os.path.basename(ff_file),
+                   'source_size': os.path.getsize(ff_file)}, outfile, indent=1)
+    del features, coords
+    return FeatureStore(store_dir)
+
+
+class FeatureStore:
+    '''
+    Memory-mapped feature vectors of store_dir : features ((n, k) float64),
+    coords ((n, 3) float64) and names ((n,) bytes).
+    '''
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'store.json'), 'r') as infile:
+            self.info = json.load(infile)
+        self.features = np.load(os.path.join(store_dir, 'features.npy'), mmap_mode='r')
+        self.coords = np.load(os.path.join(store_dir, 'coords.npy'), mmap_mode='r')
+        self.names = np.load(os.path.join(store_dir, 'names.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.features)
+
+    @property
+    def comments(self):
+        return self.info['comments']
+
+    def column(self, index):
+        '''Returns feature index of all points, a contiguous view.'''
+        return self.features[:, index]
+
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        '''Yields (start, features, coords) views of consecutive points.'''
+        for start in range(0, len(self), chunk_size):
+            yield (start, self.features[start:start+chunk_size],
+                   self.coords[start:start+chunk_size])
+
+    def write_ff(self, filename, index=None):
+        '''
+        Writes the points of index (all points by default) back as a .ff
+        text file, feature values written as integers when they are whole,
+        else as the shortest text read back as the same double. Only the
+        coordinates are kept from the comment after the features.
+        '''
+        rows = np.arange(len(self)) if index is None else np.asarray(index)
+        with open(filename, 'w') as outfile:
+            for line in self.comments:
+                outfile.write(line+"\n")
+            for start in range(0, len(rows), CHUNK_SIZE):
+                part = rows[start:start+CHUNK_SIZE]
+                block = self.features[part]
+                if np.all(block == np.round(block)):
+                    values = [map(str, row) for row in block.astype(np.int64).tolist()]
+                else:
+                    values = [map(repr, row) for row in block.tolist()]
+                for name, row, xyz in zip(self.names[part], values, self.coords[part].tolist()):
+                    outfile.write(name.decode()+"\t"+"\t".join(row)
+                                  +"\t#\t"+"\t".join(map(coordinate, xyz))+"\n")
+        return filename
+
+
+def coordinate(value):
+    '''Returns a coordinate as written by featurize (3 decimals), with more digits only if it has them.'''
+    text = '%.3f' % value
+    return text if float(text) == value else repr(value)
+
+
+def is_current(store_dir, ff_file):
+    '''True if store_dir holds a store converted from the present ff_file.'''
+    try:
+        with open(os.path.join(store_dir, 'store.json'), 'r') as infile:
+            info = json.load(infile)
+    except (OSError, ValueError):
+        return False
+    return (info.get('format') == STORE_FORMAT and os.path.isfile(ff_file)
+            and info.get('source_size') == os.path.getsize(ff_file)
+            and os.path.getmtime(os.path.join(store_dir, 'store.json')) >= os.path.getmtime(ff_file))
+
+
+def open_store(store_dir, ff_file=None):
+    '''
+    Returns the store of store_dir, converted first from ff_file if it is
+    missing or older than ff_file.
+    '''
+    if ff_file is not None and not is_current(store_dir, ff_file):
+        return convert_ff(ff_file, store_dir)
+    return FeatureStore(store_dir)
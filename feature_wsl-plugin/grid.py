@@ -0,0 +1,221 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Gridpoint generation for the Feature-plugin.
+#
+# The lattice is built per axis with numpy.arange and walked in chunks of a
+# fixed number of points, so memory stays bounded whatever the size of the
+# bounding box. Every axis value is formatted only once and the lines of the
+# .ptf file are assembled and written in bulk. Gridpoints can be pruned
+# with lattice masks stamped around the atoms (see shell_mask).
+
+import numpy as np
+
+# number of gridpoints held in memory at once
+CHUNK_SIZE = 200000
+
+
+def find_borders(coords, margin=1.0):
+    '''
+    Returns the borders [highx, lowx, highy, lowy, highz, lowz] of the box
+    around the (n, 3) atom coordinates, extended by margin on every side.
+    '''
+    coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+    high = coords.max(axis=0) + margin
+    low = coords.min(axis=0) - margin
+    return [float(value) for pair in zip(high, low) for value in pair]
+
+
+def align_borders(borders, origin, spacing):
+    '''
+    Returns the borders with every low border moved down by less than the
+    spacing onto the lattice going through origin (a gridpoint of an
+    earlier grid), so that both grids share their gridpoints.
+    '''
+    aligned = list(borders)
+    for axis in range(3):
+        low = borders[2*axis+1]
+        steps = np.ceil((origin[axis] - low) / spacing - 1e-9)
+        aligned[2*axis+1] = float(origin[axis] - steps*spacing)
+    return aligned
+
+
+def grid_axes(borders, spacing):
+    '''
+    Returns the x, y and z gridpoint coordinates for borders given as
+    [highx, lowx, highy, lowy, highz, lowz] (see findborders).
+    Values are computed as low + i*spacing, which avoids the drift of
+    summing up the spacing point after point.
+    '''
+    axes = []
+    for high, low in zip(borders[0::2], borders[1::2]):
+        npoints = int(np.floor((high - low) / spacing + 1e-9)) + 1
+        axes.append(low + spacing * np.arange(max(npoints, 0)))
+    return axes
+
+
+def iter_chunks(axes, chunk_size=CHUNK_SIZE):
+    '''
+    Yields (index, xyz) for consecutive chunks of the lattice, in the same
+    x, y, z order as the former nested loops of write_ptf. index is an
+    (n, 3) array of lattice indices and xyz the matching coordinates.
+    '''
+    shape = tuple(len(axis) for axis in axes)
+    total = int(np.prod(shape))
+    for start in range(0, total, chunk_size):
+        flat = np.arange(start, min(start + chunk_size, total))
+        index = np.column_stack(np.unravel_index(flat, shape))
+        xyz = np.column_stack([axes[i][index[:, i]] for i in range(3)])
+        yield index, xyz
+
+
+def ptf_labels(prot, axes):
+    '''
+    Returns the formatted pieces of a .ptf line for every axis value :
+    "prot    x.xxx ", "   y.yyy " and "   z.zzz\\n".
+    '''
+    xlabels = [prot+" "+'{:8.3f}'.format(x)+" " for x in axes[0]]
+    ylabels = ['{:8.3f}'.format(y)+" " for y in axes[1]]
+    zlabels = ['{:8.3f}'.format(z)+"\n" for z in axes[2]]
+    return [np.array(labels, dtype=object) for labels in (xlabels, ylabels, zlabels)]
+
+
+def format_lattice(labels, index):
+    '''Returns the .ptf text for the lattice points in index.'''
+    if len(index) == 0:
+        return ""
+    lines = labels[0][index[:, 0]] + labels[1][index[:, 1]] + labels[2][index[:, 2]]
+    return "".join(lines.tolist())
+
+
+def format_points(prot, xyz):
+    '''Returns the .ptf text for the (n, 3) gridpoint coordinates xyz.'''
+    # a single format of all the lines is faster than one per line
+    line = prot.replace("%", "%%")+" %8.3f %8.3f %8.3f\n"
+    return (line * len(xyz)) % tuple(xyz.ravel().tolist())
+
+
+def sphere_offsets(radius, spacing):
+    '''
+    Returns the lattice offsets that can hold a point within radius of an
+    atom, relative to the gridpoint nearest to that atom.
+    '''
+    reach = radius/spacing + np.sqrt(3)/2
+    n = int(np.ceil(reach))
+    steps = np.arange(-n, n+1)
+    offsets = np.array(np.meshgrid(steps, steps, steps, indexing='ij')).reshape(3, -1).T
+    return offsets[np.sum(offsets**2, axis=1) <= reach**2]
+
+
+def stamps(axes, spacing, atoms, radius):
+    '''
+    Yields (pad, padded shape) first, then the flat indices, in the lattice
+    padded by pad points on every side, of the gridpoints within radius of
+    each of the atoms ((n, 3) array), in blocks. Atoms are
+    binned to their nearest gridpoint and the sphere around them is stamped
+    onto the lattice with an exact distance test, so the cost only depends
+    on the number of atoms, not on the size of the box. A gridpoint is
+    yielded once for every atom it is close to.
+    '''
+    shape = np.array([len(axis) for axis in axes])
+    atoms = np.asarray(atoms, dtype=float).reshape(-1, 3)
+    origin = np.array([axis[0] if len(axis) else 0.0 for axis in axes])
+    offsets = sphere_offsets(radius, spacing)
+    # atoms up to the sphere reach outside the lattice still reach into it : padding
+    # the lattice by twice the reach leaves room for their whole sphere, without bound checks
+    reach = int(np.abs(offsets).max())
+    pad = 2*reach
+    padded = shape + 2*pad
+    yield pad, padded
+    if len(atoms) == 0 or 0 in shape:
+        return
+    nearest = np.rint((atoms - origin) / spacing).astype(np.int64)
+    inside = np.all((nearest >= -reach) & (nearest < shape + reach), axis=1)
+    if not inside.any():
+        return
+    nearest = nearest[inside]
+    shift = (atoms[inside] - origin)/spacing - nearest
+    strides = np.array([padded[1]*padded[2], padded[2], 1])
+    centers = (nearest + pad) @ strides
+    # squared distances in grid units : |o - f|^2 = |o|^2 - 2 o.f + |f|^2
+    limit = (radius/spacing)**2
+    shift2 = np.sum(shift**2, axis=1)
+    block = max(1, CHUNK_SIZE // len(centers))
+    for start in range(0, len(offsets), block):
+        stamp = offsets[start:start+block]
+        dist = np.sum(stamp**2, axis=1)[None, :] - 2*shift @ stamp.T + shift2[:, None]
+        index = centers[:, None] + (stamp @ strides)[None, :]
+        yield index[dist <= limit]
+
+
+def unpad(array, shape, pad):
+    '''Returns the lattice of shape out of the flat padded array (see stamps).'''
+    array = array.reshape(tuple(np.array(shape) + 2*pad))
+    return array[pad:pad+shape[0], pad:pad+shape[1], pad:pad+shape[2]].copy()
+
+
+def atom_mask(axes, spacing, atoms, radius):
+    '''
+    Returns a boolean array of the lattice shape, True for the gridpoints
+    within radius of at least one of the atoms ((n, 3) array).
+    '''
+    blocks = stamps(axes, spacing, atoms, radius)
+    pad, padded = next(blocks)
+    mask = np.zeros(np.prod(padded), dtype=bool)
+    for index in blocks:
+        mask[index] = True
+    return unpad(mask, [len(axis) for axis in axes], pad)
+
+
+def atom_counts(axes, spacing, atoms, radius):
+    '''
+    Returns an int32 array of the lattice shape holding the number of the
+    atoms ((n, 3) array) within radius of every gridpoint.
+    '''
+    blocks = stamps(axes, spacing, atoms, radius)
+    pad, padded = next(blocks)
+    counts = np.zeros(np.prod(padded), dtype=np.int32)
+    for index in blocks:
+        np.add.at(counts, index, 1)
+    return unpad(counts, [len(axis) for axis in axes], pad)
+
+
+def shell_mask(axes, spacing, atoms, min_dist, max_dist):
+    '''
+    Returns the lattice mask of the gridpoints whose nearest atom lies
+    between min_dist and max_dist : closer points clash with the protein,
+    farther points lie out in the solvent where no site can be found.
+    '''
+    keep = atom_mask(axes, spacing, atoms, max_dist)
+    if min_dist > 0:
+        keep &= ~atom_mask(axes, spacing, atoms, min_dist)
+    return keep
+
+
+def write_lattice(outfile, prot, axes, keep=None, frame=None, chunk_size=CHUNK_SIZE):
+    '''
+    Writes the gridpoints of the lattice axes to the open outfile and
+    returns their number (see write_ptf). With frame (center, rotation),
+    the lattice is in the frame of the rows of rotation around center and
+    the gridpoints are written as center + xyz @ rotation.
+    '''
+    labels = ptf_labels(prot, axes) if frame is None else None
+    count = 0
+    for index, xyz in iter_chunks(axes, chunk_size):
+        if keep is not None:
+            selected = keep[index[:, 0], index[:, 1], index[:, 2]]
+            index, xyz = index[selected], xyz[selected]
+        if frame is None:
+            outfile.write(format_lattice(labels, index))
+        else:
+            outfile.write(format_points(prot, xyz @ frame[1] + frame[0]))
+        count += len(index)
+    return count
+
+
+def write_ptf(filename, prot, axes, keep=None, chunk_size=CHUNK_SIZE):
+    '''
+    Writes the gridpoints of the lattice axes (see grid_axes) to filename
+    and returns the number of points written. keep is an optional boolean
+    array of the lattice shape selecting the points to write (see shell_mask).
+    '''
+    with open(filename, 'w') as outfile:
+        return write_lattice(outfile, prot, axes, keep, chunk_size=chunk_size)
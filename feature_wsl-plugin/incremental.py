@@ -0,0 +1,193 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Incremental recompute after local edits (mutations, rotamers) for the Feature-plugin.
+#
+# The atoms of a structure are saved with every run (prot.snapshot.npz). On
+# the next run, the atoms moved, added or removed since then are found by
+# their chain, residue and name, and only the gridpoints within the FEATURE
+# shell radius of their old or new positions are featurized and scored
+# again (prot_delta.ptf). All other gridpoints keep their line of the
+# previous _grid.hits, and the new lines are spliced in by coordinates, in
+# the order of the .ptf file. Gridpoints missing from the previous hits (a
+# grown or pruned grid) are featurized as well.
+
+import os
+
+import numpy as np
+
+from . import grid
+from . import ffstore
+
+# 6 shells of 1.25 A around every gridpoint (FEATURE defaults)
+FEATURE_RADIUS = 7.5
+
+# atoms moving less than this are unchanged (pdb files keep 3 decimals)
+TOLERANCE = 0.001
+
+
+def save_snapshot(filename, keys, coords, run, origin, spacing):
+    '''
+    Saves the atom keys and coordinates of a run, the key of the run
+    settings (model, FEATURE data ...), a gridpoint (origin) and the spacing
+    of its grid.
+    '''
+    with open(filename, 'wb') as outfile:
+        np.savez(outfile, keys=np.array(keys, dtype=str).reshape(-1),
+                 coords=np.asarray(coords, dtype=float).reshape(-1, 3), run=np.array(run),
+                 origin=np.asarray(origin, dtype=float), spacing=np.array(float(spacing)))
+    return filename
+
+
+def load_snapshot(filename):
+    '''Returns the snapshot of filename as a dict (see save_snapshot), None if there is none.'''
+    try:
+        with np.load(filename) as data:
+            return {'keys': data['keys'], 'coords': data['coords'], 'run': str(data['run']),
+                    'origin': data['origin'], 'spacing': float(data['spacing'])}
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def numbered(keys):
+    '''Returns the keys made unique by the number of their occurrence, "key#0", "key#1" ...'''
+    seen = {}
+    unique = []
+    for key in keys:
+        count = seen.get(key, 0)
+        seen[key] = count + 1
+        unique.append("%s#%d" % (key, count))
+    return np.array(unique, dtype=str)
+
+
+def changed_atoms(old_keys, old_coords, new_keys, new_coords, tolerance=TOLERANCE):
+    '''
+    Returns the positions ((m, 3) array) where the structure changed : the
+    old positions of the removed and moved atoms and the new positions of
+    the added and moved ones.
+    '''
+    old_coords = np.asarray(old_coords, dtype=float).reshape(-1, 3)
+    new_coords = np.asarray(new_coords, dtype=float).reshape(-1, 3)
+    common, old_index, new_index = np.intersect1d(numbered(old_keys), numbered(new_keys),
+                                                  return_indices=True)
+    same = np.sum((old_coords[old_index] - new_coords[new_index])**2, axis=1) <= tolerance**2
+    removed = np.ones(len(old_coords), dtype=bool)
+    removed[old_index[same]] = False
+    added = np.ones(len(new_coords), dtype=bool)
+    added[new_index[same]] = False
+    return np.vstack([old_coords[removed], new_coords[added]])
+
+
+def ptf_origin(filename):
+    '''Returns the coordinates of the first gridpoint of filename, None for an empty file.'''
+    with open(filename, 'r') as infile:
+        for line in infile:
+            fields = line.split()
+            if len(fields) >= 4:
+                return np.array(fields[1:4], dtype=float)
+    return None
+
+
+def read_ptf_coords(filename):
+    '''Returns the coordinates ((n, 3) array) of the gridpoints of filename.'''
+    with open(filename, 'r') as infile:
+        fields = infile.read().split()
+    return np.array(fields, dtype=object).reshape(-1, 4)[:, 1:].astype(float)
+
+
+def point_ids(*coords):
+    '''
+    Returns an integer id for every point of the (n, 3) coordinate arrays,
+    the same for points equal to 0.001 A whatever the array.
+    '''
+    ints = [np.rint(np.asarray(xyz, dtype=float).reshape(-1, 3)*1000).astype(np.int64) for xyz in coords]
+    inverse = np.unique(np.vstack(ints), axis=0, return_inverse=True)[1].ravel()
+    return np.split(inverse, np.cumsum([len(xyz) for xyz in ints])[:-1])
+
+
+def affected_points(xyz, changed, spacing, radius=FEATURE_RADIUS):
+    '''
+    Returns a boolean mask of the gridpoints xyz ((n, 3) array, on a lattice
+    of spacing) lying within radius of a changed position. Spheres are
+    stamped on the lattice as for the grid pruning (see grid.atom_mask).
+    '''
+    xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+    if len(xyz) == 0:
+        return np.zeros(0, dtype=bool)
+    origin = xyz.min(axis=0)
+    steps = (xyz - origin) / spacing
+    index = np.rint(steps).astype(np.int64)
+    if np.abs(steps - index).max() > 0.05:
+        # not made with this spacing : featurize everything again
+        return np.ones(len(xyz), dtype=bool)
+    axes = [origin[axis] + spacing*np.arange(index[:, axis].max()+1) for axis in range(3)]
+    mask = grid.atom_mask(axes, spacing, changed, radius)
+    return mask[index[:, 0], index[:, 1], index[:, 2]]
+
+
+def hits_coords(line):
+    return line.split('#')[0].split('\t')[2:5]
+
+
+def ff_coords(line):
+    return ffstore.parse_ff_line(line)[2].split('\t')[:3]
+
+
+def read_lines(filename, coords_of):
+    '''
+    Returns the comment lines, the lines holding coordinates and these
+    coordinates ((n, 3) array) of filename.
+    '''
+    comments, lines, coords = [], [], []
+    with open(filename, 'r') as infile:
+        for line in infile:
+            if line.startswith('#'):
+                comments.append(line)
+            elif line.strip():
+                xyz = coords_of(line)
+                if len(xyz) == 3 and xyz[-1].strip():
+                    lines.append(line)
+                    coords.append(xyz)
+    return comments, lines, np.array(coords, dtype=float).reshape(-1, 3)
+
+
+def select_points(ptf_file, hits_file, delta_file, changed, spacing, radius=FEATURE_RADIUS):
+    '''
+    Writes to delta_file the gridpoints of ptf_file within radius of the
+    changed positions or missing from hits_file, returns the number of
+    gridpoints and the number written.
+    '''
+    xyz = read_ptf_coords(ptf_file)
+    old = read_lines(hits_file, hits_coords)[2]
+    points, previous = point_ids(xyz, old)
+    keep = affected_points(xyz, changed, spacing, radius) | ~np.isin(points, previous)
+    with open(ptf_file, 'r') as infile, open(delta_file, 'w') as outfile:
+        outfile.writelines(line for line, selected in zip(infile, keep) if selected)
+    return len(xyz), int(keep.sum())
+
+
+def splice(ptf_file, old_file, delta_file, filename, coords_of=hits_coords):
+    '''
+    Writes filename with one line for every gridpoint of ptf_file, in its
+    order : the line of delta_file for the point if there is one, else the
+    line of old_file (points in neither are left out). The comment lines of
+    old_file are kept at the top. filename may be old_file, which is only
+    replaced once the new file is complete. Returns the number of lines
+    written.
+    '''
+    xyz = read_ptf_coords(ptf_file)
+    comments, old_lines, old_xyz = read_lines(old_file, coords_of)
+    delta_lines, delta_xyz = [], np.zeros((0, 3))
+    if os.path.isfile(delta_file):
+        delta_lines, delta_xyz = read_lines(delta_file, coords_of)[1:]
+    points, old_ids, delta_ids = point_ids(xyz, old_xyz, delta_xyz)
+    # row of the line of every point id, delta lines written over old ones
+    source = np.full(len(points) + len(old_ids) + len(delta_ids), -1, dtype=np.int64)
+    lines = old_lines + delta_lines
+    source[old_ids] = np.arange(len(old_lines))
+    source[delta_ids] = len(old_lines) + np.arange(len(delta_lines))
+    rows = source[points]
+    rows = rows[rows >= 0]
+    with open(filename+".part", 'w') as outfile:
+        outfile.writelines(comments)
+        outfile.writelines(lines[row] for row in rows.tolist())
+    os.replace(filename+".part", filename)
+    return len(rows)
@@ -0,0 +1,110 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Site refinement for the Feature-plugin.
+#
+# Python version of predictSites from findsites.R (W.Zhou, G.W.Tang and
+# R.B.Altman (2015) J Chem Inf Model,55(8),p1663-1672). The recursion of
+# getSites re-sorts the remaining hits and computes all distances for every
+# site; here the hits are sorted once and neighbours are looked up in a cell
+# list, without starting R.
+
+import numpy as np
+
+from . import spatial
+
+# score cutoffs benchmarked for a precision of 95 and 99 %
+SCORE_CUTOFFS = {'95': 2.08, '99': 25.67}
+# points within this distance of a site are assigned to it
+SITE_RADIUS = 3.5
+
+
+def score_cutoff(precision, cutoff=0):
+    '''Returns the score cutoff for precision, or cutoff for other values.'''
+    return SCORE_CUTOFFS.get(str(precision), cutoff)
+
+
+def predict_sites(scores, xyz, precision="99", cutoff=0, refine_radius=3.5):
+    '''
+    Returns the predicted sites of the hits (scores and (n, 3) coordinates)
+    as an (n, 10) array : x, y, z of the site, the number of hits within
+    3.5 A of it and the min, 1st quartile, median, mean, 3rd quartile and
+    max of their scores, best site first.
+    '''
+    keep = scores >= score_cutoff(precision, cutoff)
+    scores, xyz = scores[keep], xyz[keep]
+    # removing hits keeps the others sorted, so one (stable) sort is enough
+    order = np.argsort(-scores, kind='stable')
+    scores, xyz = scores[order], xyz[order]
+    cells = spatial.CellList(xyz, max(refine_radius, SITE_RADIUS))
+    alive = np.ones(len(scores), dtype=bool)
+    remaining = len(scores)
+    top = 0
+    sites = []
+    while remaining > 0:
+        while not alive[top]:
+            top += 1
+        if remaining == 1:
+            site = xyz[top]
+        else:
+            # mean position of the hits around the best one, weighted by exp(score)
+            near = cells.within(xyz[top], refine_radius)
+            near = near[alive[near]]
+            weights = np.exp(scores[near] - scores[near].max())
+            site = weights @ xyz[near] / weights.sum()
+        members = cells.within(site, SITE_RADIUS)
+        members = members[alive[members]]
+        if len(members) == 0:
+            # as dat[-ind,] in R, an empty index drops all remaining hits
+            sites.append(list(site) + [0] + [np.nan]*6)
+            break
+        values = scores[members]
+        q1, median, q3 = np.percentile(values, [25, 50, 75])
+        sites.append(list(site) + [len(members), values.min(), q1, median,
+                                   values.mean(), q3, values.max()])
+        alive[members] = False
+        remaining -= len(members)
+    return np.array(sites, dtype=float).reshape(-1, 10)
+
+
+def write_pred(filename, prot, sites):
+    '''
+    Writes sites to filename in the layout of the .pred files written by
+    the R script : the structure name followed by the 10 site columns.
+    '''
+    with open(filename, 'w') as outfile:
+        for site in sites:
+            values = ['NA' if np.isnan(value) else '%.15g' % value for value in site]
+            outfile.write(prot+" "+" ".join(values)+"\n")
+    return filename
+
+
+def read_pred(filename):
+    '''Returns the sites of a .pred file as an (n, 10) array.'''
+    sites = []
+    with open(filename, 'r') as infile:
+        for line in infile:
+            pred_data = line.split()
+            if pred_data:
+                sites.append([float('nan') if value == 'NA' else float(value)
+                              for value in pred_data[1:11]])
+    return np.array(sites, dtype=float).reshape(-1, 10)
+
+
+def site_pdb_lines(sites, occupancy=None):
+    '''
+    Returns the pdb ATOM lines of sites as CA atoms, the max score of a site
+    in the B-factor column and occupancy (1.00 by default) in the occupancy
+    column.
+    '''
+    if occupancy is None:
+        occupancy = np.ones(len(sites))
+    return ["ATOM   "+'{:4.0f}'.format(count)+"  CA  CA  X"+'{:4.0f}'.format(count)
+            +'{:12.3f}'.format(site[0])+'{:8.3f}'.format(site[1])+'{:8.3f}'.format(site[2])
+            +'{:6.2f}'.format(occ)+'{:6.2f}'.format(site[9])+"\n"
+            for count, (site, occ) in enumerate(zip(sites, occupancy), 1)]
+
+
+def write_site_pdb(filename, sites, occupancy=None):
+    '''Writes sites as CA atoms of a pdb file (see site_pdb_lines).'''
+    with open(filename, 'w') as outfile:
+        outfile.writelines(site_pdb_lines(sites, occupancy))
+    return filename
@@ -0,0 +1,146 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Vectorized scoring of feature vectors for the Feature-plugin.
+#
+# Python version of scoreit : a FEATURE model holds, for every property and
+# shell, the boundaries of the bins of the property value and the score of
+# every bin. The score of a gridpoint is the sum of the bin scores of all its
+# features. The model is read once into numpy arrays and the features of a
+# store (see ffstore) are scored in chunks, one property column at a time,
+# with numpy.searchsorted.
+#
+# Model lines (after '#' comment lines) : property name, shell, the k bin
+# boundaries then the k+1 bin scores, separated by white space.
+#
+# This layout has not been checked against real FEATURE 3.1 models and
+# scoreit output : until a fixture of a real model, .ff file and scoreit
+# hits shows the same scores, score_engine = python is not offered and the
+# feature vectors are always scored by scoreit (see score_engine). The
+# benchmark stand-ins (bench.py) still use this layout for their model.
+
+import os
+
+import numpy as np
+
+from . import ffstore
+
+# score_engine values offered, python is left out until it is checked (see above)
+ENGINES = ('scoreit',)
+
+
+class Model:
+    '''
+    A FEATURE model : for every (property, shell) row, the bin boundaries
+    (bounds, padded with +inf) and the bin scores (scores, padded with 0).
+    '''
+    def __init__(self, name, rows, bounds, scores):
+        self.name = name
+        self.rows = rows
+        self.bounds = bounds
+        self.scores = scores
+
+    def properties(self):
+        '''Returns the property names in the order of the model.'''
+        return list(dict.fromkeys(prop for prop, shell in self.rows))
+
+    def shells(self):
+        return max(shell for prop, shell in self.rows) + 1 if self.rows else 0
+
+    def columns(self, properties=None):
+        '''
+        Returns the feature column of every row, for feature vectors made of
+        all properties (the order of the model by default) for shell 0, then
+        for shell 1 ...
+        '''
+        properties = properties or self.properties()
+        index = {prop: number for number, prop in enumerate(properties)}
+        return np.array([shell * len(properties) + index[prop] for prop, shell in self.rows],
+                        dtype=np.int64)
+
+    def score(self, features, columns):
+        '''Returns the scores of the (n, k) feature array.'''
+        total = np.zeros(len(features), dtype=np.float64)
+        for row, column in enumerate(columns):
+            bins = np.searchsorted(self.bounds[row], features[:, column], side='right')
+            total += self.scores[row][bins]
+        return total
+
+
+def read_model(filename):
+    '''Reads a .model file into a Model.'''
+    rows, bounds, scores = [], [], []
+    with open(filename, 'r') as infile:
+        for line in infile:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            values = [float(value) for value in fields[2:]]
+            nbounds = (len(values) - 1) // 2
+            if len(values) != 2 * nbounds + 1:
+                raise ValueError("%s : bad model line for %s" % (filename, fields[0]))
+            rows.append((fields[0], int(fields[1])))
+            bounds.append(values[:nbounds])
+            scores.append(values[nbounds:])
+    width = max([len(row) for row in bounds] + [0])
+    bound_array = np.full((len(rows), width), np.inf)
+    score_array = np.zeros((len(rows), width + 1))
+    for row, (row_bounds, row_scores) in enumerate(zip(bounds, scores)):
+        bound_array[row, :len(row_bounds)] = row_bounds
+        score_array[row, :len(row_scores)] = row_scores
+    return Model(filename, rows, bound_array, score_array)
+
+
+def ff_properties(comments):
+    '''Returns the property names of a '# PROPERTIES' .ff comment line, None if missing.'''
+    for line in comments:
+        fields = line.lstrip('#').split()
+        if fields and fields[0].upper() == 'PROPERTIES':
+            return fields[1:]
+    return None
+
+
+def score_store(model, store, chunk_size=ffstore.CHUNK_SIZE):
+    '''Returns the scores of all points of the FeatureStore store.'''
+    columns = model.columns(ff_properties(store.comments))
+    if len(columns) and columns.max() >= store.features.shape[1]:
+        raise ValueError("%s needs more features than the %d of %s"
+                         % (model.name, store.features.shape[1], store.store_dir))
+    scores = np.zeros(len(store), dtype=np.float64)
+    for start, features, coords in store.chunks(chunk_size):
+        scores[start:start+len(features)] = model.score(features, columns)
+    return scores
+
+
+def score_engine(settings):
+    '''Returns the engine scoring the feature vectors with settings, scoreit for one not offered.'''
+    engine = settings.get('score_engine', 'scoreit')
+    return engine if engine in ENGINES else 'scoreit'
+
+
+def write_hits(filename, store, scores, keep=None):
+    '''
+    Writes the scores of the points of store in the _grid.hits layout of
+    scoreit : name, score, x, y, z separated by tabs. keep is an optional
+    boolean mask of the points to write.
+    '''
+    rows = np.arange(len(store)) if keep is None else np.flatnonzero(keep)
+    with open(filename, 'w') as outfile:
+        for start in range(0, len(rows), ffstore.CHUNK_SIZE):
+            part = rows[start:start+ffstore.CHUNK_SIZE]
+            for name, score, xyz in zip(store.names[part], scores[part].tolist(),
+                                        store.coords[part].tolist()):
+                outfile.write(name.decode()+"\t"+'%g' % score+"\t"
+                              +"\t".join('%.3f' % value for value in xyz)+"\n")
+    return len(rows)
+
+
+def score_ff(model_file, ff_file, hits_file, store_dir=None, cutoff=None):
+    '''
+    Scores the feature vectors of ff_file (kept in the store store_dir,
+    converted first if needed) with model_file and writes hits_file, only
+    the points scoring at least cutoff if given. Returns the number of
+    points written.
+    '''
+    store = ffstore.open_store(store_dir or os.path.splitext(ff_file)[0]+".ffs", ff_file)
+    scores = score_store(read_model(model_file), store)
+    keep = None if cutoff is None else scores >= cutoff
+    return write_hits(hits_file, store, scores, keep)
@@ -0,0 +1,58 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Spatial index over point coordinates for the Feature-plugin.
+#
+# A cell list : points are hashed into cubic cells and sorted by cell, so
+# the points of a cell are a contiguous slice found with numpy.searchsorted.
+# A query up to the cell size only has to look at the 27 surrounding cells.
+
+import numpy as np
+
+# the 27 cell offsets around (and including) a cell
+OFFSETS = np.array([(i, j, k) for i in (-1, 0, 1)
+                    for j in (-1, 0, 1) for k in (-1, 0, 1)])
+
+
+class CellList:
+    '''
+    Cell list over coords ((n, 3) array). Queries are valid for distances
+    up to cell_size.
+    '''
+    def __init__(self, coords, cell_size):
+        coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+        self.cell_size = float(cell_size)
+        self.origin = coords.min(axis=0) if len(coords) else np.zeros(3)
+        # cells are shifted by one so that every neighbour cell index is >= 0
+        cells = self.cells(coords)
+        if len(coords):
+            self.dims = cells.max(axis=0) + 2
+        else:
+            self.dims = np.ones(3, dtype=np.int64)
+        keys = self.keys(cells)
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+        self.coords = coords[self.order]
+
+    def __len__(self):
+        return len(self.coords)
+
+    def cells(self, points):
+        return np.floor((points - self.origin) / self.cell_size).astype(np.int64) + 1
+
+    def keys(self, cells):
+        return (cells[..., 0] * self.dims[1] + cells[..., 1]) * self.dims[2] + cells[..., 2]
+
+    def within(self, point, radius):
+        '''
+        Returns the indices (in the order of the coords given at creation)
+        of the points within radius (<= cell_size) of point, sorted.
+        '''
+        neighbours = self.cells(np.asarray(point, dtype=float)) + OFFSETS
+        valid = np.all((neighbours >= 0) & (neighbours < self.dims), axis=1)
+        keys = self.keys(neighbours[valid])
+        start = np.searchsorted(self.sorted_keys, keys, side='left')
+        end = np.searchsorted(self.sorted_keys, keys, side='right')
+        if not np.any(end > start):
+            return np.zeros(0, dtype=np.int64)
+        candidates = np.concatenate([np.arange(s, e) for s, e in zip(start, end) if e > s])
+        dist = np.sum((self.coords[candidates] - point)**2, axis=1)
+        return np.sort(self.order[candidates[dist <= radius**2]])
@@ -0,0 +1,109 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Tests of the resumable sharded runs (checkpoint.py) : the shards are
+# "run" by writing their hits files.
+
+import os
+from importlib import import_module
+
+PLUGIN = os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+checkpoint = import_module(PLUGIN + ".checkpoint")
+
+OUTPUTS = ('_grid.hits',)
+
+
+def write_ptf(filename, count=10):
+    with open(filename, 'w') as outfile:
+        for number in range(count):
+            outfile.write("prot %8.3f %8.3f %8.3f\n" % (number, 0.0, 0.0))
+    return filename
+
+
+def run_shards(resume, shards):
+    '''Writes the hits of shards (one line per gridpoint) and records them as finished.'''
+    for shard in shards:
+        with open(shard+".ptf", 'r') as infile, open(shard+"_grid.hits", 'w') as outfile:
+            for line in infile:
+                outfile.write("Env\t1\t"+"\t".join(line.split()[1:4])+"\n")
+        assert resume.complete(shard)
+
+
+def test_finished_run_has_nothing_pending(tmp_path):
+    ptf = write_ptf(str(tmp_path / "prot.ptf"))
+    shard_dir = str(tmp_path / "prot_shards")
+    resume = checkpoint.Checkpoint(shard_dir, 'key', OUTPUTS)
+    shards = resume.split(ptf, 3)
+    assert resume.pending() == shards and len(shards) == 3
+    run_shards(resume, shards[:2])
+    # a new run of the same job only runs the shard left
+    again = checkpoint.Checkpoint(shard_dir, 'key', OUTPUTS)
+    assert again.split(ptf, 3) == shards
+    assert again.pending() == shards[2:]
+    run_shards(again, shards[2:])
+    assert checkpoint.Checkpoint(shard_dir, 'key', OUTPUTS).split(ptf, 3) == shards
+    assert again.pending() == []
+
+
+def test_corrupt_shard_runs_again(tmp_path):
+    ptf = write_ptf(str(tmp_path / "prot.ptf"))
+    shard_dir = str(tmp_path / "prot_shards")
+    resume = checkpoint.Checkpoint(shard_dir, 'key', OUTPUTS)
+    shards = resume.split(ptf, 4)
+    with open(shards[3]+"_grid.ff", 'w') as outfile:
+        outfile.write("feature vectors\n")
+    run_shards(resume, shards)
+    # hits truncated by a crash, hits removed, a kept .ff changed
+    with open(shards[1]+"_grid.hits", 'a') as outfile:
+        outfile.write("Env\t1")
+    os.remove(shards[0]+"_grid.hits")
+    with open(shards[3]+"_grid.ff", 'a') as outfile:
+        outfile.write("more feature vectors\n")
+    # an optional .ff written after the shard finished is not checked
+    with open(shards[2]+"_grid.ff", 'w') as outfile:
+        outfile.write("feature vectors\n")
+    again = checkpoint.Checkpoint(shard_dir, 'key', OUTPUTS)
+    assert again.split(ptf, 4) == shards
+    assert again.pending() == [shards[0], shards[1], shards[3]]
+
+
+def test_missing_output_is_not_finished(tmp_path):
+    ptf = write_ptf(str(tmp_path / "prot.ptf"))
+    resume = checkpoint.Checkpoint(str(tmp_path / "prot_shards"), 'key', OUTPUTS)
+    shards = resume.split(ptf, 2)
+    assert not resume.complete(shards[0])
+    assert resume.pending() == shards
+
+
+def test_changed_shard_ptf_splits_again(tmp_path):
+    ptf = write_ptf(str(tmp_path / "prot.ptf"))
+    shard_dir = str(tmp_path / "prot_shards")
+    resume = checkpoint.Checkpoint(shard_dir, 'key', OUTPUTS)
+    shards = resume.split(ptf, 3)
+    run_shards(resume, shards)
+    with open(shards[0]+".ptf", 'a') as outfile:
+        outfile.write("prot   99.000    0.000    0.000\n")
+    again = checkpoint.Checkpoint(shard_dir, 'key', OUTPUTS)
+    assert again.split(ptf, 3) == shards
+    assert again.pending() == shards
+    # the outputs of the earlier run are removed with its shards
+    assert not any(os.path.exists(shard+"_grid.hits") for shard in shards)
+
+
+def test_other_run_or_bad_manifest_starts_from_scratch(tmp_path):
+    ptf = write_ptf(str(tmp_path / "prot.ptf"))
+    shard_dir = str(tmp_path / "prot_shards")
+    resume = checkpoint.Checkpoint(shard_dir, 'key', OUTPUTS)
+    shards = resume.split(ptf, 3)
+    run_shards(resume, shards)
+    other = checkpoint.Checkpoint(shard_dir, 'other key', OUTPUTS)
+    assert other.split(ptf, 2) != shards and len(other.pending()) == 2
+    run_shards(other, other.pending())
+    # a changed grid changes the key of the run
+    write_ptf(ptf, count=12)
+    again = checkpoint.Checkpoint(shard_dir, 'other key', OUTPUTS)
+    again.split(ptf, 2)
+    assert len(again.pending()) == 2
+    with open(os.path.join(shard_dir, checkpoint.MANIFEST), 'w') as outfile:
+        outfile.write('{"format": 1, "key": ')
+    assert again.read() == []
+    resume.remove()
+    assert not os.path.exists(os.path.join(shard_dir, checkpoint.MANIFEST))
@@ -0,0 +1,88 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Tests of the binary feature vector store (ffstore.py).
+
+import os
+import json
+from importlib import import_module
+
+import numpy as np
+
+PLUGIN = os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+ffstore = import_module(PLUGIN + ".ffstore")
+
+COMMENTS = ["#\tFEATURE 3.1", "#\tPROPERTIES\tA\tB\tC"]
+# values of featurize with more digits than float32 keeps, next to whole ones
+ROWS = [("Env_prot_0", ["0", "1", "0.30000000000000004"], ["1.000", "2.000", "3.000"]),
+        ("Env_prot_1", ["2.5", "0.1234567890123456", "-7.000000000000001"], ["-4.125", "0.000", "12.345"]),
+        ("Env_prot_2", ["1e-300", "16777217", "3.999999999999999"], ["0.001", "-0.001", "100.500"])]
+
+
+def write_ff(filename, rows=ROWS):
+    with open(filename, 'w') as outfile:
+        for line in COMMENTS:
+            outfile.write(line+"\n")
+        for name, values, xyz in rows:
+            outfile.write("\t".join([name] + values + ["#"] + xyz + ["#prot"])+"\n")
+    return filename
+
+
+def read_ff(filename):
+    '''Returns the comments, names, float64 features and coordinates of a .ff file.'''
+    comments, names, features, coords = [], [], [], []
+    with open(filename, 'r') as infile:
+        for line in infile:
+            if line.startswith('#'):
+                comments.append(line.rstrip('\n'))
+                continue
+            name, values, comment = ffstore.parse_ff_line(line)
+            names.append(name)
+            features.append([float(value) for value in values.split('\t')])
+            coords.append([float(value) for value in comment.split('\t')[:3]])
+    return comments, names, np.array(features), np.array(coords)
+
+
+def test_store_keeps_text_precision(tmp_path):
+    store = ffstore.convert_ff(write_ff(str(tmp_path / "prot_grid.ff")), str(tmp_path / "prot_grid.ffs"),
+                               chunk_size=2)
+    assert store.features.dtype == np.float64
+    expected = np.array([[float(value) for value in values] for name, values, xyz in ROWS])
+    assert np.array_equal(store.features, expected)
+    # float32 would merge these values with their neighbours
+    assert store.features[0, 2] != 0.3 and store.features[2, 1] == 16777217
+    assert [name.decode() for name in store.names] == [name for name, values, xyz in ROWS]
+    assert store.comments == COMMENTS
+
+
+def test_round_trip_is_lossless(tmp_path):
+    source = write_ff(str(tmp_path / "prot_grid.ff"))
+    store = ffstore.open_store(str(tmp_path / "prot_grid.ffs"), source)
+    copy = store.write_ff(str(tmp_path / "copy_grid.ff"))
+    comments, names, features, coords = read_ff(source)
+    copy_comments, copy_names, copy_features, copy_coords = read_ff(copy)
+    assert copy_comments == comments and copy_names == names
+    assert np.array_equal(copy_features, features)
+    assert np.array_equal(copy_coords, coords)
+    # and once more through a store of the copy
+    again = ffstore.convert_ff(copy, str(tmp_path / "copy_grid.ffs"))
+    assert np.array_equal(again.features, store.features)
+    assert np.array_equal(again.coords, store.coords)
+
+
+def test_whole_values_written_as_integers(tmp_path):
+    rows = [("Env_prot_0", ["0", "3", "12"], ["1.000", "2.000", "3.000"])]
+    store = ffstore.convert_ff(write_ff(str(tmp_path / "prot_grid.ff"), rows), str(tmp_path / "prot_grid.ffs"))
+    with open(store.write_ff(str(tmp_path / "copy_grid.ff")), 'r') as infile:
+        lines = [line for line in infile if not line.startswith('#')]
+    assert lines == ["Env_prot_0\t0\t3\t12\t#\t1.000\t2.000\t3.000\n"]
+
+
+def test_older_store_is_converted_again(tmp_path):
+    source = write_ff(str(tmp_path / "prot_grid.ff"))
+    store_dir = str(tmp_path / "prot_grid.ffs")
+    ffstore.convert_ff(source, store_dir)
+    assert ffstore.is_current(store_dir, source)
+    info = ffstore.FeatureStore(store_dir).info
+    info['format'] = 1
+    with open(str(tmp_path / "prot_grid.ffs" / "store.json"), 'w') as outfile:
+        json.dump(info, outfile)
+    assert not ffstore.is_current(store_dir, source)
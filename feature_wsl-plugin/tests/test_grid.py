@@ -0,0 +1,85 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Tests of the gridpoint generation and pruning (grid.py) against a brute
+# force distance matrix.
+
+import os
+from importlib import import_module
+
+import numpy as np
+
+PLUGIN = os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+grid = import_module(PLUGIN + ".grid")
+
+
+def lattice(atoms, spacing, margin=3.0):
+    axes = grid.grid_axes(grid.find_borders(atoms, margin), spacing)
+    xyz = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+    return axes, xyz, tuple(len(axis) for axis in axes)
+
+
+def distances(xyz, atoms):
+    return np.sqrt(np.sum((xyz[:, None, :] - atoms[None, :, :])**2, axis=2))
+
+
+def random_atoms(count, seed=1):
+    return np.random.default_rng(seed).uniform(-6.0, 6.0, size=(count, 3))
+
+
+def test_atom_mask_and_counts_match_brute_force():
+    atoms = random_atoms(40)
+    for spacing, radius in ((0.7, 2.2), (1.0, 4.0), (0.48, 1.3)):
+        axes, xyz, shape = lattice(atoms, spacing)
+        dist = distances(xyz, atoms)
+        mask = grid.atom_mask(axes, spacing, atoms, radius)
+        assert mask.shape == shape
+        assert np.array_equal(mask.ravel(), (dist <= radius).any(axis=1))
+        counts = grid.atom_counts(axes, spacing, atoms, radius)
+        assert np.array_equal(counts.ravel(), (dist <= radius).sum(axis=1))
+
+
+def test_atoms_outside_the_lattice_reach_into_it():
+    atoms = random_atoms(30, seed=2)
+    axes, xyz, shape = lattice(atoms, 0.8, margin=-2.0)
+    outside = atoms + [[8.0, 0.0, 0.0]]
+    both = np.vstack([atoms, outside])
+    mask = grid.atom_mask(axes, 0.8, both, 3.5)
+    assert np.array_equal(mask.ravel(), (distances(xyz, both) <= 3.5).any(axis=1))
+
+
+def test_shell_mask_matches_brute_force():
+    atoms = random_atoms(25, seed=3)
+    axes, xyz, shape = lattice(atoms, 0.6)
+    nearest = distances(xyz, atoms).min(axis=1)
+    for min_dist, max_dist in ((1.5, 3.0), (0.0, 2.0), (2.5, 2.6)):
+        keep = grid.shell_mask(axes, 0.6, atoms, min_dist, max_dist)
+        expected = (nearest <= max_dist) & ((nearest > min_dist) | (min_dist == 0))
+        assert np.array_equal(keep.ravel(), expected)
+
+
+def test_no_atom_masks_nothing():
+    axes = grid.grid_axes([2.0, 0.0, 2.0, 0.0, 2.0, 0.0], 1.0)
+    assert not grid.atom_mask(axes, 1.0, np.zeros((0, 3)), 5.0).any()
+    assert not grid.atom_counts(axes, 1.0, np.zeros((0, 3)), 5.0).any()
+
+
+def test_align_borders_shares_the_gridpoints():
+    spacing = 0.7
+    origin = [1.234, -5.678, 0.5]
+    borders = grid.align_borders([9.0, -3.1, 4.0, -7.2, 6.0, 0.05], origin, spacing)
+    for axis, values in enumerate(grid.grid_axes(borders, spacing)):
+        steps = (values - origin[axis]) / spacing
+        assert np.allclose(steps, np.round(steps))
+        # moved down by less than the spacing
+        assert 0 <= [-3.1, -7.2, 0.05][axis] - values[0] < spacing
+
+
+def test_write_ptf_writes_the_kept_points_in_order(tmp_path):
+    atoms = random_atoms(10, seed=4)
+    axes, xyz, shape = lattice(atoms, 1.1)
+    keep = grid.shell_mask(axes, 1.1, atoms, 1.0, 3.0)
+    filename = str(tmp_path / "prot.ptf")
+    count = grid.write_ptf(filename, "prot", axes, keep, chunk_size=97)
+    with open(filename, 'r') as infile:
+        lines = infile.readlines()
+    expected = ["prot %8.3f %8.3f %8.3f\n" % tuple(point) for point in xyz[keep.ravel()]]
+    assert count == len(expected) and lines == expected
@@ -0,0 +1,157 @@
+# This Python 3.x file uses the following encoding: utf-8
+# Featurize/scoreit worker of a Feature-plugin cluster.
+#
+# Runs the shards of the coordinator of a plugin (see cluster.py) with the
+# bash and the FEATURE installation of this machine, as set in the plugin
+# configuration file like for the batch runs :
+#
+#   python -m feature_wsl-plugin.worker -s coordinator_host:8765 -j 8
+#
+# Every one of the -j workers connects to the coordinator, runs one shard at
+# a time in a scratch directory and connects again after a run, so the
+# workers can be left running between runs. A shard is stopped when the
+# coordinator closes the connection (run cancelled).
+
+import os
+import sys
+import time
+import select
+import socket
+import argparse
+import platform
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from . import CONFIG_FILE, bash_launch, bash_path, plugin_directory, read_config
+from . import cluster
+from . import runner
+
+# seconds between the connection attempts of a worker
+RETRY_DELAY = 5
+
+
+class ConnectionWatch:
+    '''Set, like a threading.Event, once the coordinator closed the connection sock.'''
+    def __init__(self, sock):
+        self.sock = sock
+
+    def is_set(self):
+        # the coordinator sends nothing while a shard runs : readable means closed
+        try:
+            readable = select.select([self.sock], [], [], 0)[0]
+            return bool(readable) and self.sock.recv(1, socket.MSG_PEEK) == b''
+        except (OSError, ValueError):
+            return True
+
+
+def job_commands(job):
+    '''Returns the featurize/scoreit commands of job, run in the directory of its files.'''
+    name = cluster.check_name(job['shard'])
+    models = [cluster.check_name(model) for model in job.get('models', [])]
+    if not models:
+        return runner.featurize_commands(name)
+    if len(models) == 1:
+        return runner.feature_commands(name, models[0], bool(job.get('stream')), bool(job.get('keep_ff')))
+    labels = [cluster.check_name(label) for label in job['labels']]
+    return runner.models_commands(name, models, labels)
+
+
+def run_job(job, work_dir, settings, cancel=None):
+    '''Runs job in work_dir, which holds its files, and returns the exit code.'''
+    header = ['pushd %s > /dev/null' % bash_path(work_dir),
+              'export FEATURE_DIR=%s' % settings['feature_data_path'].replace("\\", "/"),
+              'export DSSP_DIR=%s' % bash_path(work_dir),
+              'export PDB_DIR=%s' % bash_path(work_dir)]
+    script = runner.write_script(os.path.join(work_dir, "featurize.sh"), header, job_commands(job))
+    return runner.run_program(bash_launch(settings), script, cancel)
+
+
+def serve_coordinator(address, settings, token="", name=None, scratch=None):
+    '''
+    Connects to the coordinator at address (host, port) and runs its shards
+    until it has none left. Returns the number of shards run.
+    '''
+    count = 0
+    with socket.create_connection(address) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        challenge = cluster.new_challenge()
+        cluster.send_message(sock, {'type': 'hello', 'challenge': challenge, 'worker': name or platform.node()})
+        reply = cluster.receive_message(sock)
+        if reply.get('type') == 'refused':
+            raise PermissionError("refused by the coordinator, check the token")
+        if reply.get('type') != 'challenge' or not cluster.check_digest(reply.get('proof'), token, 'coordinator',
+                                                                        challenge):
+            raise PermissionError("the coordinator does not hold the token")
+        cluster.send_message(sock, {'type': 'proof', 'proof': cluster.token_digest(token, 'worker',
+                                                                                   reply.get('challenge'))})
+        while True:
+            with tempfile.TemporaryDirectory(prefix="feature_", dir=scratch) as work_dir:
+                job = cluster.receive_message(sock, work_dir)
+                if job.get('type') == 'refused':
+                    raise PermissionError("refused by the coordinator, check the token")
+                if job.get('type') != 'job':
+                    return count
+                returncode = run_job(job, work_dir, settings, ConnectionWatch(sock))
+                returned = [cluster.check_name(job['shard']+suffix) for suffix in job.get('returned', [])]
+                files = [(filename, os.path.join(work_dir, filename)) for filename in returned
+                         if os.path.isfile(os.path.join(work_dir, filename))]
+                cluster.send_message(sock, {'type': 'result', 'returncode': returncode}, files)
+                count += 1
+
+
+def run_worker(address, settings, token="", name=None, scratch=None, once=False):
+    '''
+    Serves the coordinators at address one after the other (only one with
+    once). Returns the number of shards run, None if refused.
+    '''
+    while True:
+        try:
+            count = serve_coordinator(address, settings, token, name, scratch)
+            print("%s : ran %d shards" % (name, count), flush=True)
+            if once:
+                return count
+        except PermissionError as error:
+            print("%s : %s" % (name, error), flush=True)
+            return None
+        except ConnectionRefusedError:
+            # no run going on
+            pass
+        except (OSError, ValueError) as error:
+            print("%s : lost the coordinator at %s:%d (%s)" % (name, address[0], address[1], error), flush=True)
+            if once:
+                return 0
+        time.sleep(RETRY_DELAY)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m %s" % __spec__.name if __spec__ else None,
+        description="Runs featurize/scoreit shards for a Feature-plugin coordinator.")
+    parser.add_argument('-s', '--server', required=True, help="HOST:PORT of the coordinator")
+    parser.add_argument('-j', '--workers', type=int, default=0,
+                        help="shards run in parallel (default: all cores)")
+    parser.add_argument('-t', '--token', default=os.environ.get('FEATURE_CLUSTER_TOKEN', ''),
+                        help="token of the coordinator (default: $FEATURE_CLUSTER_TOKEN)")
+    parser.add_argument('--scratch', default=None, help="directory of the shard files (default: temporary)")
+    parser.add_argument('--once', action='store_true', help="stops after serving one coordinator")
+    parser.add_argument('-c', '--config', default=os.path.join(plugin_directory(), CONFIG_FILE),
+                        help="plugin configuration file")
+    parser.add_argument('--set', action='append', default=[], metavar="KEY=VALUE",
+                        help="overrides a setting of the configuration file")
+    args = parser.parse_args(argv)
+
+    settings = read_config(args.config)
+    for item in args.set:
+        key, value = item.split('=', 1)
+        settings[key.strip()] = value.strip()
+    address = cluster.parse_address(args.server, 'localhost')
+    workers = args.workers or runner.default_workers()
+    names = ["%s-%d" % (platform.node(), number) for number in range(workers)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        counts = list(pool.map(lambda name: run_worker(address, settings, args.token, name, args.scratch,
+                                                       args.once), names))
+    return 1 if None in counts else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())